@@ -0,0 +1,411 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Throughput benchmarks of the capture pipeline, run on the simulated backend (so
+no DAQ is needed). Two kinds of measurement are made:
+
+:stages: the sustainable rate (samples per port per second) of each stage in
+         isolation -- the handoff of sample buffers from the driver callback
+         into an ``AsyncWriter``, ``SampleProcessor.do_write``, port file output
+         and the transfer of port files to a client -- for each number of ports.
+:envelope: the full pipeline is run in real time for increasing sampling rates,
+           for each number of ports, until the writer queue grows, giving the
+           highest rate that can be sustained with that many ports.
+
+Results are reported as JSON, so that they can be compared across releases and
+hosts.
+
+"""
+# pylint: disable=no-member
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy
+
+if __name__ == '__main__':  # for debugging
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import daqpower
+from daqpower.log import start_logging
+from daqpower.config import DeviceConfiguration
+from daqpower.capture import CaptureWriter, CAPTURE_FILENAME
+from daqpower.client import DaqClient, FileReceiver
+from daqpower.daq import AsyncWriter, BufferPool, DaqRunner, PortWriter, SampleProcessor
+from daqpower.simulation import SyntheticSource
+from daqpower.portfile import MappedPortWriter, PORT_FILE_SUFFIX
+from daqpower.server import DaqServer, ThreadedXMLRPCServer
+from daqpower.timeindex import monotonic
+try:
+    from daqpower.dataplane import DataServer
+except (ImportError, SyntaxError):  # python2
+    DataServer = None
+
+
+STAGES = ['handoff', 'process', 'output', 'transfer']
+TRANSFER_METHODS = ['read_port_file', 'rpc', 'http']
+
+# Aggregate sampling rate of a DAQ 6363 across multiple channels.
+DEFAULT_MAX_AGGREGATE_RATE = 1000000
+
+logger = logging.getLogger(__name__)
+
+
+def get_rates(number_of_ports, max_aggregate_rate, min_rate=1000):
+    """Sampling rates to try (1, 2, 5 steps), up to the maximum rate of each of the two channels of every port."""
+    max_rate = max_aggregate_rate // (2 * number_of_ports)
+    rates = []
+    decade = 1
+    while True:
+        for step in (1, 2, 5):
+            rate = step * decade * min_rate
+            if rate >= max_rate:
+                return rates + [max_rate] if max_rate >= min_rate else rates
+            rates.append(rate)
+        decade *= 10
+
+
+def _make_config(number_of_ports, sampling_rate, output_format):
+    config = DeviceConfiguration(device_id='Dev1', v_range=None, dv_range=None, sampling_rate=sampling_rate,
+                                 resistor_values=[0.005] * number_of_ports, channel_map=None,
+                                 labels=['PORT_{}'.format(i) for i in range(number_of_ports)],
+                                 output_format=output_format)
+    config.validate()
+    return config
+
+
+def _make_samples(config, chunk_size):
+    """A buffer holding a chunk of simulated samples, laid out as the driver delivers them."""
+    scans = numpy.empty((chunk_size, config.number_of_ports, 2))
+    SyntheticSource(config, seed=0).fill(scans, 0)
+    return scans.ravel()
+
+
+class _NullWriter(AsyncWriter):
+    """Consumes sample tuples by returning their buffers to the pool."""
+
+    def __init__(self, buffer_pool):
+        super(_NullWriter, self).__init__(wait_period=0.01)
+        self.buffer_pool = buffer_pool
+
+    def do_write(self, stuff):
+        self.buffer_pool.release(stuff[0])
+
+    def count_samples(self, stuff):
+        return stuff[1]
+
+
+def benchmark_handoff(config, chunk_size, duration, directory):  # pylint: disable=unused-argument
+    """Acquire a buffer, read the driver's samples into it and hand it to the consumer, as EveryNCallback does."""
+    samples = _make_samples(config, chunk_size)
+    buffer_pool = BufferPool(samples.shape[0], 16)
+    writer = _NullWriter(buffer_pool)
+    writer.start()
+    processed = 0
+    start_time = monotonic()
+    while monotonic() - start_time < duration:
+        samples_buffer = buffer_pool.acquire()
+        samples_buffer[:samples.shape[0]] = samples  # stands in for ReadAnalogF64
+        writer.write((samples_buffer, chunk_size, time.time(), monotonic()))
+        processed += chunk_size
+    writer.stop()
+    writer.join()  # until the consumer has caught up
+    elapsed = monotonic() - start_time
+    return {'samples': processed, 'elapsed': elapsed, 'buffer_pool': buffer_pool.get_stats()}
+
+
+def benchmark_process(config, chunk_size, duration, directory):
+    """SampleProcessor.do_write: conversion to power, statistics, output and timestamp index."""
+    samples = _make_samples(config, chunk_size)
+    processor = SampleProcessor(config.resistor_values, directory, config.labels, config.output_format,
+                                chunk_size, sampling_rate=config.sampling_rate)
+    processor.start()
+    processed = 0
+    try:
+        start_time = monotonic()
+        while monotonic() - start_time < duration:
+            processor.do_write((samples, chunk_size, time.time(), monotonic()))
+            processed += chunk_size
+        elapsed = monotonic() - start_time
+    finally:
+        processor.stop()
+    return {'samples': processed, 'elapsed': elapsed, 'bytes': _get_output_size(directory)}
+
+
+def benchmark_output(config, chunk_size, duration, directory):
+    """Writing blocks of power and voltage columns out to port files (CSV or mapped) or the capture container."""
+    scans = _make_samples(config, chunk_size).reshape((chunk_size, config.number_of_ports, 2))
+    power = scans[:, :, 0] * (scans[:, :, 1] / numpy.array(config.resistor_values))
+    voltage = scans[:, :, 0].copy()
+    if config.output_format == 'binary':
+        writers = [CaptureWriter(os.path.join(directory, CAPTURE_FILENAME), config.labels, chunk_size)]
+        write = lambda: writers[0].write(power, voltage)
+    elif config.output_format == 'mapped':
+        writers = [MappedPortWriter(os.path.join(directory, label + PORT_FILE_SUFFIX)) for label in config.labels]
+        write = lambda: [writer.write_block(power[:, j], voltage[:, j]) for j, writer in enumerate(writers)]
+    else:
+        writers = [PortWriter(os.path.join(directory, label + '.csv')) for label in config.labels]
+        write = lambda: [writer.write_block(power[:, j], voltage[:, j]) for j, writer in enumerate(writers)]
+    processed = 0
+    try:
+        start_time = monotonic()
+        while monotonic() - start_time < duration:
+            write()
+            processed += chunk_size
+    finally:
+        for writer in writers:
+            writer.close()
+    elapsed = monotonic() - start_time
+    return {'samples': processed, 'elapsed': elapsed, 'bytes': _get_output_size(directory)}
+
+
+def benchmark_transfer(config, number_of_samples, directory):
+    """
+    Capture ``number_of_samples`` on each port (as fast as they can be processed)
+    on a local server, then time downloading the port files with each transfer
+    method. Returns a result for each method.
+    """
+    data_server = DataServer(0) if DataServer else None
+    if data_server:
+        data_server.start()
+    simulation = {'waveform': 'sine', 'replay': None, 'speed': 0}
+    daq_server = DaqServer(os.path.join(directory, 'server'), max_queue_size=4, data_server=data_server,
+                           simulation=simulation)
+    server = ThreadedXMLRPCServer(('127.0.0.1', 0), allow_none=True, logRequests=False)
+    server.register_instance(daq_server)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    port = server.server_address[1]
+    results = []
+    try:
+        client = DaqClient('127.0.0.1', port)
+        client.configure(config.__dict__)
+        client.start()
+        while client.get_port_stats()[config.labels[0]]['samples'] < number_of_samples:
+            time.sleep(0.1)
+        client.stop()
+        captured = int(client.get_port_stats()[config.labels[0]]['samples'])
+        for method in TRANSFER_METHODS:
+            if method == 'http' and not data_server:
+                continue
+            output_directory = tempfile.mkdtemp(dir=directory)
+            start_time = monotonic()
+            if method == 'read_port_file':
+                # Plain text, over the original open/read/close protocol, one port file at a time.
+                for port_file in client.list_port_files():
+                    with FileReceiver(client, port_file) as fin:
+                        with open(os.path.join(output_directory, port_file), 'w') as fout:
+                            for chunk in iter(lambda: fin.read(1048576), ''):
+                                fout.write(chunk)
+            else:
+                method_client = DaqClient('127.0.0.1', port, use_data_plane=(method == 'http'),
+                                          session_id=client.session_id)
+                method_client.get_data(output_directory)
+            elapsed = monotonic() - start_time
+            results.append({'method': method, 'samples': captured, 'elapsed': elapsed,
+                            'bytes': _get_output_size(output_directory)})
+            shutil.rmtree(output_directory)
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if data_server:
+            data_server.stop()
+    return results
+
+
+def run_stages(stages, port_counts, formats, chunk_size, duration, transfer_samples, directory):
+    stage_functions = {'handoff': benchmark_handoff, 'process': benchmark_process, 'output': benchmark_output}
+    results = []
+    for number_of_ports in port_counts:
+        for output_format in formats:
+            config = _make_config(number_of_ports, chunk_size * 2, output_format)
+            for stage in stages:
+                if stage == 'handoff' and output_format != formats[0]:
+                    continue  # does not depend on the output format
+                stage_directory = tempfile.mkdtemp(dir=directory)
+                try:
+                    if stage == 'transfer':
+                        measurements = benchmark_transfer(config, transfer_samples, stage_directory)
+                    else:
+                        measurements = [stage_functions[stage](config, chunk_size, duration, stage_directory)]
+                finally:
+                    shutil.rmtree(stage_directory)
+                for measurement in measurements:
+                    result = {'stage': stage, 'ports': number_of_ports, 'output_format': output_format}
+                    result.update(measurement)
+                    result['samples_per_second'] = measurement['samples'] / measurement['elapsed']
+                    if 'bytes' in measurement:
+                        result['bytes_per_second'] = measurement['bytes'] / measurement['elapsed']
+                    logger.info('%-9s %-15s %d port(s) %-6s: %12.0f samples/s', stage, result.get('method', ''),
+                                number_of_ports, output_format, result['samples_per_second'])
+                    results.append(result)
+    return results
+
+
+def measure_sustained(number_of_ports, sampling_rate, output_format, duration, max_backlog, directory):
+    """
+    Capture in real time from the simulated backend for ``duration`` seconds and
+    report whether the sample processor kept up: i.e. no more than
+    ``max_backlog`` chunks were ever waiting to be written out, and the
+    simulated source itself managed to deliver samples at the requested rate.
+    """
+    config = _make_config(number_of_ports, sampling_rate, output_format)
+    output_directory = tempfile.mkdtemp(dir=directory)
+    simulation = {'waveform': 'sine', 'replay': None, 'speed': 1.0}
+    try:
+        runner = DaqRunner(config, output_directory, simulation=simulation)
+        runner.start()
+        start_time = monotonic()
+        time.sleep(duration)
+        runner.task.StopTask()
+        elapsed = monotonic() - start_time
+        delivered = runner.task.samples_delivered
+        backlog = runner.get_overrun_stats()['queue_depth']
+        runner.processor.stop()
+        overrun_stats = runner.get_overrun_stats()
+        pool_stats = runner.get_buffer_pool_stats()
+    finally:
+        shutil.rmtree(output_directory)
+    # Allow for the chunk that was due just as the source was stopped.
+    source_keeping_up = delivered + runner.task.chunk_size >= sampling_rate * elapsed * 0.95
+    return {
+        'ports': number_of_ports,
+        'sampling_rate': sampling_rate,
+        'output_format': output_format,
+        'elapsed': elapsed,
+        'samples_delivered': delivered,
+        'max_queue_depth': overrun_stats['max_queue_depth'],
+        'final_queue_depth': backlog,
+        'buffer_pool_exhausted': pool_stats['exhausted'],
+        'source_keeping_up': source_keeping_up,
+        'sustained': source_keeping_up and overrun_stats['max_queue_depth'] <= max_backlog,
+    }
+
+
+def run_envelope(port_counts, formats, max_aggregate_rate, min_rate, duration, max_backlog, directory):
+    results = []
+    limits = []
+    for output_format in formats:
+        for number_of_ports in port_counts:
+            best = None
+            for rate in get_rates(number_of_ports, max_aggregate_rate, min_rate):
+                result = measure_sustained(number_of_ports, rate, output_format, duration, max_backlog, directory)
+                logger.info('envelope  %d port(s) %-6s %8d Hz: max queue depth %d%s', number_of_ports,
+                            output_format, rate, result['max_queue_depth'],
+                            '' if result['sustained'] else ' -- not sustained')
+                results.append(result)
+                if not result['sustained']:
+                    break  # higher rates will not be either
+                best = rate
+            limits.append({'ports': number_of_ports, 'output_format': output_format,
+                           'max_sampling_rate': best,
+                           'max_aggregate_rate': best * number_of_ports if best else None})
+    return results, limits
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description='Measure the throughput of the DAQ server capture pipeline.')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Write the results (JSON) to this file, rather than to stdout.')
+    parser.add_argument('-d', '--directory', metavar='DIR',
+                        help='Directory for temporary files (defaults to the system temporary directory).')
+    parser.add_argument('--ports', type=int, nargs='+', default=list(range(1, 9)), metavar='N',
+                        help='Numbers of ports to benchmark.')
+    parser.add_argument('--formats', nargs='+', choices=DeviceConfiguration.valid_output_formats,
+                        default=DeviceConfiguration.valid_output_formats,
+                        help='Output formats to benchmark.')
+    parser.add_argument('--stages', nargs='*', choices=STAGES, default=STAGES,
+                        help='Stages to benchmark in isolation (none to only measure the envelope).')
+    parser.add_argument('--stage-duration', type=float, default=2.0, metavar='SECONDS',
+                        help='How long to run each stage for.')
+    parser.add_argument('--chunk-size', type=int, default=DeviceConfiguration.default_sampling_rate // 2,
+                        metavar='SAMPLES', help='Samples per port in each chunk handed to the stages.')
+    parser.add_argument('--transfer-samples', type=int, default=200000, metavar='SAMPLES',
+                        help='Samples per port to capture for the transfer stage.')
+    parser.add_argument('--skip-envelope', action='store_true', default=False,
+                        help='Do not measure the highest sustainable sampling rates.')
+    parser.add_argument('--envelope-duration', type=float, default=5.0, metavar='SECONDS',
+                        help='How long to capture for at each sampling rate.')
+    parser.add_argument('--max-aggregate-rate', type=int, default=DEFAULT_MAX_AGGREGATE_RATE, metavar='RATE',
+                        help='Maximum aggregate sampling rate of the DAQ (across all channels).')
+    parser.add_argument('--min-rate', type=int, default=1000, metavar='RATE',
+                        help='Lowest sampling rate to try.')
+    parser.add_argument('--max-backlog', type=int, default=2, metavar='CHUNKS',
+                        help="""
+                        Most chunks (about half a second of samples each) that may be waiting
+                        to be written out for a sampling rate to count as sustained.
+                        """)
+    parser.add_argument('--verbose', help='Produce verobose output.', action='store_true', default=False)
+    args = parser.parse_args()
+
+    start_logging('DEBUG' if args.verbose else 'INFO')
+    if not args.verbose:
+        # Only the benchmark's own progress; not that of every session it creates.
+        logging.getLogger('daqpower.server').setLevel(logging.WARNING)
+        logging.getLogger('daqpower.daq').setLevel(logging.ERROR)
+
+    directory = tempfile.mkdtemp(dir=args.directory)
+    results = {
+        'version': daqpower.__version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'cpus': multiprocessing.cpu_count(),
+        },
+        'parameters': dict((k, v) for k, v in vars(args).items() if k not in ('output', 'directory', 'verbose')),
+    }
+    try:
+        results['stages'] = run_stages(args.stages, args.ports, args.formats, args.chunk_size,
+                                       args.stage_duration, args.transfer_samples, directory)
+        if not args.skip_envelope:
+            results['envelope'], results['limits'] = run_envelope(args.ports, args.formats,
+                                                                  args.max_aggregate_rate, args.min_rate,
+                                                                  args.envelope_duration, args.max_backlog,
+                                                                  directory)
+            sustained = [limit for limit in results['limits'] if limit['max_aggregate_rate']]
+            if sustained:
+                best = max(sustained, key=lambda limit: limit['max_aggregate_rate'])
+                logger.info('Highest sustained: %d port(s) at %d Hz (%s)', best['ports'],
+                            best['max_sampling_rate'], best['output_format'])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=4, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+def _get_output_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory)
+               if os.path.isfile(os.path.join(directory, f)))
+
+
+if __name__ == '__main__':
+    run_benchmark()
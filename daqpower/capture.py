@@ -0,0 +1,307 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Binary capture container. A single file per session holds the power and voltage
+columns of every port in fixed-size chunks, followed by an index of those chunks
+that allows seeking to any sample range without scanning the file::
+
+    +------------------------------------------------------------+
+    | MAGIC | header length (uint32) | JSON header               |
+    +------------------------------------------------------------+
+    | chunk 0: power[port 0], voltage[port 0], power[port 1] ... |
+    | chunk 1: ...                                               |
+    +------------------------------------------------------------+
+    | index: (sample offset, file offset, samples) per chunk     |
+    | footer: index offset, number of chunks, INDEX_MAGIC        |
+    +------------------------------------------------------------+
+
+All numbers are little-endian; columns are float64. The columns stored for each
+port are listed in the header (``power`` and ``voltage``, plus per-window extrema
+for downsampled captures). Every chunk except the last
+holds exactly ``chunk_size`` samples, so a container that has not been closed
+yet (and so has no index) can still be read up to its last complete chunk.
+
+"""
+import os
+import json
+import hashlib
+import struct
+
+import numpy
+
+
+CAPTURE_FILENAME = 'capture.daqbin'
+
+MAGIC = b'DAQCAP1\0'
+INDEX_MAGIC = b'DAQIDX1\0'
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_COLUMNS = ('power', 'voltage')
+CHECKSUM_SUFFIX = '.sha256'
+
+_header_length = struct.Struct('<I')
+_footer = struct.Struct('<QQ8s')
+_index_dtype = numpy.dtype([('sample_offset', '<u8'), ('file_offset', '<u8'), ('samples', '<u4')])
+_column_dtype = numpy.dtype('<f8')
+
+
+class CaptureFormatError(Exception):
+    pass
+
+
+class CaptureWriter(object):
+    """Accumulates per-port column blocks (power, voltage, ...) into fixed-size chunks."""
+
+    def __init__(self, path, labels, chunk_size=DEFAULT_CHUNK_SIZE, metadata=None, columns=DEFAULT_COLUMNS):
+        self.path = path
+        self.labels = list(labels)
+        self.columns = list(columns)
+        self.number_of_ports = len(self.labels)
+        self.chunk_size = int(chunk_size)
+        self.samples_written = 0
+        self._index = []
+        self._pending = numpy.empty((len(self.columns), self.chunk_size, self.number_of_ports),
+                                    dtype=_column_dtype)
+        self._pending_count = 0
+        header = {'labels': self.labels, 'columns': self.columns, 'chunk_size': self.chunk_size,
+                  'metadata': metadata or {}}
+        header = json.dumps(header).encode('utf-8')
+        self.fh = open(path, 'wb')
+        self.fh.write(MAGIC)
+        self.fh.write(_header_length.pack(len(header)))
+        self.fh.write(header)
+        # So that the container can be opened as soon as the capture has started.
+        self.fh.flush()
+
+    def write(self, *columns):
+        """Append a block of samples; one (samples, ports) array for each of self.columns."""
+        offset = 0
+        total = columns[0].shape[0]
+        while offset < total:
+            count = min(self.chunk_size - self._pending_count, total - offset)
+            end = self._pending_count + count
+            for i, column in enumerate(columns):
+                self._pending[i, self._pending_count:end] = column[offset:offset + count]
+            self._pending_count = end
+            offset += count
+            if self._pending_count == self.chunk_size:
+                self._flush_chunk()
+
+    def flush(self):
+        self.fh.flush()
+
+    def close(self):
+        if self.fh.closed:
+            return
+        if self._pending_count:
+            self._flush_chunk()
+        index = numpy.array(self._index, dtype=_index_dtype)
+        index_offset = self.fh.tell()
+        self.fh.write(index.tobytes())
+        self.fh.write(_footer.pack(index_offset, len(self._index), INDEX_MAGIC))
+        self.fh.close()
+
+    def _flush_chunk(self):
+        count = self._pending_count
+        self._index.append((self.samples_written, self.fh.tell(), count))
+        # Stored per port as a column after column, e.g. power then voltage.
+        columns = self._pending[:, :count].transpose(2, 0, 1)
+        self.fh.write(numpy.ascontiguousarray(columns).tobytes())
+        self.samples_written += count
+        self._pending_count = 0
+
+    def __del__(self):
+        self.close()
+
+
+class CaptureReader(object):
+    """Random access to the samples stored in a capture container."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'rb')
+        if self.fh.read(len(MAGIC)) != MAGIC:
+            raise CaptureFormatError('{} is not a capture file.'.format(path))
+        length, = _header_length.unpack(self.fh.read(_header_length.size))
+        header = json.loads(self.fh.read(length).decode('utf-8'))
+        self.labels = header['labels']
+        self.columns = header.get('columns', list(DEFAULT_COLUMNS))
+        self.chunk_size = header['chunk_size']
+        self.metadata = header['metadata']
+        self.number_of_ports = len(self.labels)
+        self.data_offset = self.fh.tell()
+        self.index = self._read_index()
+        if len(self.index):
+            last = self.index[-1]
+            self.number_of_samples = int(last['sample_offset']) + int(last['samples'])
+        else:
+            self.number_of_samples = 0
+
+    def read(self, port_id, start=0, stop=None):
+        """
+        Return a tuple of arrays, one for each of self.columns (so ``(power, voltage)``
+        unless downsampled with extrema), for samples in ``[start, stop)`` of the
+        specified port (either a label or a port index).
+
+        """
+        port = self._port_index(port_id)
+        if stop is None or stop > self.number_of_samples:
+            stop = self.number_of_samples
+        start = min(start, stop)
+        result = tuple(numpy.empty((stop - start,), dtype=_column_dtype) for _ in self.columns)
+        for entry in self._chunks_for(start, stop):
+            chunk_start = int(entry['sample_offset'])
+            chunk_samples = int(entry['samples'])
+            lo = max(start, chunk_start) - chunk_start
+            hi = min(stop, chunk_start + chunk_samples) - chunk_start
+            column_bytes = chunk_samples * _column_dtype.itemsize
+            port_offset = int(entry['file_offset']) + port * len(self.columns) * column_bytes
+            dest = slice(chunk_start + lo - start, chunk_start + hi - start)
+            for i, column in enumerate(result):
+                column[dest] = self._read_column(port_offset + i * column_bytes, lo, hi)
+        return result
+
+    def iter_chunks(self, port_id):
+        """Yield the column arrays (see read()) for each stored chunk of the specified port."""
+        for entry in self.index:
+            start = int(entry['sample_offset'])
+            yield self.read(port_id, start, start + int(entry['samples']))
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _port_index(self, port_id):
+        if port_id in self.labels:
+            return self.labels.index(port_id)
+        if isinstance(port_id, int) and 0 <= port_id < self.number_of_ports:
+            return port_id
+        raise CaptureFormatError('Invalid port ID: {}'.format(port_id))
+
+    def _chunks_for(self, start, stop):
+        offsets = self.index['sample_offset']
+        first = max(int(numpy.searchsorted(offsets, start, side='right')) - 1, 0)
+        last = int(numpy.searchsorted(offsets, stop, side='left'))
+        return self.index[first:last]
+
+    def _read_column(self, offset, lo, hi):
+        self.fh.seek(offset + lo * _column_dtype.itemsize)
+        data = self.fh.read((hi - lo) * _column_dtype.itemsize)
+        return numpy.frombuffer(data, dtype=_column_dtype)
+
+    def _read_index(self):
+        self.fh.seek(0, 2)
+        file_size = self.fh.tell()
+        if file_size - self.data_offset >= _footer.size:
+            self.fh.seek(file_size - _footer.size)
+            index_offset, number_of_chunks, magic = _footer.unpack(self.fh.read(_footer.size))
+            if magic == INDEX_MAGIC:
+                self.fh.seek(index_offset)
+                data = self.fh.read(number_of_chunks * _index_dtype.itemsize)
+                return numpy.frombuffer(data, dtype=_index_dtype)
+        # Container is still being written (or was not closed cleanly); every chunk
+        # present on disk is full size, so the index can be reconstructed.
+        chunk_bytes = self.chunk_size * self.number_of_ports * len(self.columns) * _column_dtype.itemsize
+        number_of_chunks = (file_size - self.data_offset) // chunk_bytes if chunk_bytes else 0
+        index = numpy.zeros((number_of_chunks,), dtype=_index_dtype)
+        index['sample_offset'] = numpy.arange(number_of_chunks) * self.chunk_size
+        index['file_offset'] = self.data_offset + numpy.arange(number_of_chunks) * chunk_bytes
+        index['samples'] = self.chunk_size
+        return index
+
+
+def format_csv_rows(*columns):
+    """Format matching column arrays (e.g. power and voltage) as CSV port file rows."""
+    # Floats never need quoting, so this produces exactly what csv.writer would, but
+    # without going through the csv module one row at a time.
+    row_format = ','.join(['%r'] * len(columns)) + '\n'
+    return ''.join([row_format % row for row in zip(*[column.tolist() for column in columns])])
+
+
+class ChecksumFile(object):
+    """
+    Binary file opened for writing that keeps track of the size and SHA-256 of
+    everything written into it. Text is written encoded as UTF-8 (so that it can
+    be used with csv.writer).
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._fh = open(path, 'wb')
+
+    @property
+    def closed(self):
+        return self._fh.closed
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self._hash.update(data)
+        self.size += len(data)
+        self._fh.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def flush(self):
+        self._fh.flush()
+
+    def close(self):
+        self._fh.close()
+
+
+def save_checksum(path, digest):
+    """Record the checksum of the file at path, alongside it."""
+    with open(path + CHECKSUM_SUFFIX, 'w') as wfh:
+        wfh.write(digest + '\n')
+
+
+def load_checksum(path):
+    """Return the recorded checksum of the file at path, computing it if it has not been recorded."""
+    try:
+        with open(path + CHECKSUM_SUFFIX) as fh:
+            return fh.read().strip()
+    except (IOError, OSError):
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1048576), b''):
+                file_hash.update(block)
+        digest = file_hash.hexdigest()
+        save_checksum(path, digest)
+        return digest
+
+
+def transcode_to_csv(capture_path, port_id, csv_path):
+    """Write the samples of a single port from a capture container into a CSV port file."""
+    temp_path = csv_path + '.tmp'
+    with CaptureReader(capture_path) as reader:
+        wfh = ChecksumFile(temp_path)
+        try:
+            wfh.write(','.join(reader.columns) + '\n')
+            for columns in reader.iter_chunks(port_id):
+                wfh.write(format_csv_rows(*columns))
+        finally:
+            wfh.close()
+    save_checksum(csv_path, wfh.hexdigest())
+    # Only expose the CSV once it is complete.
+    os.rename(temp_path, csv_path)
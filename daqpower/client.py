@@ -16,28 +16,137 @@
 
 # pylint: disable=E1101,E1103
 import os
+import hashlib
+import json
 import logging
+import shutil
 import sys
+import tempfile
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
 try:
-    from xmlrpc.client import ServerProxy
+    from xmlrpc.client import ServerProxy, Fault
 except ImportError:
     # In python2 it was called xmlrpclib
-    from xmlrpclib import ServerProxy
+    from xmlrpclib import ServerProxy, Fault
+try:
+    from urllib.request import urlopen, Request
+    from urllib.parse import quote
+except ImportError:
+    # In python2 these were in urllib2 and urllib
+    from urllib2 import urlopen, Request
+    from urllib import quote
+try:
+    import lzma
+except ImportError:  # python2
+    lzma = None
 
 
 if __name__ == '__main__':  # for debugging
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from daqpower.log import start_logging
-from daqpower.config import get_config_parser
+from daqpower.config import get_config_parser, SESSION_METHODS
 
 
 __all__ = ['DaqClient']
 
+DECOMPRESSORS = {
+    'none': lambda data: data,
+    'zlib': zlib.decompress,
+}
+if lzma:
+    DECOMPRESSORS['lzma'] = lzma.decompress
+
+# How long each follow_port_file() call may wait on the server for new data.
+FOLLOW_TIMEOUT = 5.0
+
+# Until a download is complete, the remote file (and session) it comes from is recorded
+# in <local file>.download.
+DOWNLOAD_SUFFIX = '.download'
+
+
+class TransferError(Exception):
+    pass
+
+
+class _Download(object):
+    """
+    Local destination of a port file download, tracking its offset and checksum.
+    While the download is incomplete, its ``source`` (a dict identifying the remote
+    file) is recorded next to local_file, and only a download from the same source
+    ever resumes it, so that a file left by something else (e.g. an earlier capture
+    downloaded to the same directory) is never taken for the start of this one.
+    """
+    def __init__(self, local_file, source):
+        self.local_file = local_file
+        self.record_file = local_file + DOWNLOAD_SUFFIX
+        self.source = source
+        self.offset = 0
+        self._hash = hashlib.sha256()
+        self._fh = None
+
+    def can_resume(self, max_size=None):
+        """Whether there is a partial download of this source, of at most max_size bytes."""
+        try:
+            with open(self.record_file) as fh:
+                source = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return False
+        if source != self.source or not os.path.isfile(self.local_file):
+            return False
+        return max_size is None or os.path.getsize(self.local_file) <= max_size
+
+    def resume(self):
+        """Continue from the end of the partial download."""
+        with open(self.local_file, 'rb') as fh:
+            for block in iter(lambda: fh.read(1048576), b''):
+                self._hash.update(block)
+                self.offset += len(block)
+        self._fh = open(self.local_file, 'ab')
+
+    def write(self, data):
+        if self._fh is None:
+            self._open()
+        self._hash.update(data)
+        self.offset += len(data)
+        self._fh.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        if self._fh is None:
+            self._open()  # empty remote file
+        self._fh.close()
+
+    def finish(self):
+        """Mark the download as complete."""
+        if os.path.isfile(self.record_file):
+            os.remove(self.record_file)
+
+    def discard(self):
+        for path in (self.local_file, self.record_file):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _open(self):
+        with open(self.record_file, 'w') as fh:
+            json.dump(self.source, fh)
+        self._fh = open(self.local_file, 'wb')
+
+
 class FileReceiver(object):
-    """Context manager to receive a port file using the daq server's open/read/close protocol"""
-    def __init__(self, daq_client, remote_file):
+    """
+    Context manager to receive a port file using the daq server's open/read/close protocol.
+    If encoding is specified, chunks are transferred as compressed binary data and read()
+    returns bytes; otherwise it returns text.
+    """
+    def __init__(self, daq_client, remote_file, encoding=None, level=None):
         self.daq_client = daq_client
         self.remote_file = remote_file
+        self.encoding = encoding
+        self.level = level
         self.port_descriptor = None
 
     def __enter__(self):
@@ -49,40 +158,349 @@ class FileReceiver(object):
 
     def read(self, size):
         """Read size bytes from the file"""
-        return self.daq_client.read_port_file(self.port_descriptor, size)
+        if not self.encoding:
+            return self.daq_client.read_port_file(self.port_descriptor, size)
+        args = [self.port_descriptor, size, self.encoding]
+        if self.level is not None:
+            args.append(self.level)  # None cannot be marshalled by the client
+        chunk = self.daq_client.read_port_file_binary(*args)
+        if not chunk.data:
+            return b''
+        return DECOMPRESSORS[self.encoding](chunk.data)
 
 
 # Multiple inheritance with object is needed for python2, as ServerProxy is not
 # a new-style class and inheritance with super() doesn't work out of the box.
 class DaqClient(ServerProxy, object):
-    """Interface with the remote DAQ server"""
-    def __init__(self, host, port):
+    """
+    Interface with the remote DAQ server. Port files are transferred compressed with
+    the specified encoding ('zlib', 'lzma' or None to disable compression) and level,
+    if the server supports it. get_data() downloads up to ``parallelism`` port files
+    at a time, each over its own connection. If ``use_data_plane`` is set and the
+    server exposes an HTTP data endpoint, port files are downloaded from it instead.
+
+    Session methods apply to the session with the specified ``session_id``; this is
+    set by configure() to the ID of the new session. If it is None (e.g. with older
+    servers), they apply to the most recently configured session on the server.
+    """
+    def __init__(self, host, port, encoding='zlib', compression_level=None, parallelism=4,
+                 use_data_plane=True, session_id=None):
         self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
+        self.host = host
+        self.port = port
+        self.session_id = session_id
+        self.encoding = encoding
+        self.compression_level = compression_level
+        self.parallelism = parallelism
+        self.use_data_plane = use_data_plane
+        self._negotiated_encoding = None
+        self._data_url = None
+        self._local = threading.local()
         server_uri = 'http://{}:{}'.format(host, port)
         super(DaqClient, self).__init__(server_uri)
 
-    def get_data(self, output_directory):
-        """Get all the port files after capturing"""
+    def __getattr__(self, name):
+        if name in SESSION_METHODS and self.__dict__.get('session_id'):
+            name = '{}.{}'.format(self.session_id, name)
+        return ServerProxy.__getattr__(self, name)
+
+    def configure(self, config):
+        """Configure a new session on the server; subsequent session methods apply to it."""
+        session_id = ServerProxy.__getattr__(self, 'configure')(config)
+        if session_id:  # older servers do not return one
+            self.session_id = session_id
+        return session_id
+
+    def get_data(self, output_directory, follow=False):
+        """
+        Get all the port files after capturing. If follow is set, this may be called
+        while the capture is running: the port files are downloaded as they are
+        written, and this returns once the session has been stopped (see pull()).
+        """
         port_files = self.list_port_files()
         if port_files == []:
             self.logger.warning('No ports were returned')
-        for port_file in port_files:
-            output_fname = os.path.join(output_directory, port_file)
-            self.pull(port_file, output_fname)
+        # Ports are followed until the end of the session, so all at once.
+        parallelism = len(port_files) if follow else self.parallelism
+        if parallelism <= 1 or len(port_files) <= 1:
+            for port_file in port_files:
+                output_fname = os.path.join(output_directory, port_file)
+                self.pull(port_file, output_fname, follow=follow)
+            return
+        # Once, rather than in every worker
+        self._negotiate_encoding()
+        self._get_data_url()
+        pool = ThreadPool(min(parallelism, len(port_files)))
+        try:
+            pool.map(lambda port_file: self._get_worker_client().pull(
+                port_file, os.path.join(output_directory, port_file), follow=follow), port_files)
+        finally:
+            pool.close()
+            pool.join()
 
-    def pull(self, remote_file, local_file):
+    def get_arrays(self, mmap_directory=None):
+        """
+        Get the samples of all ports after capturing as NumPy arrays, keyed on port
+        label, with a float64 field for each column (e.g. ``arrays['A0']['power']``).
+        If mmap_directory is specified, each array is backed by a .npy file in it
+        (<label>.npy), so that captures larger than memory can be loaded. See
+        get_array().
+        """
+        ports = self.list_port_files()
+        if self.parallelism <= 1 or len(ports) <= 1:
+            arrays = [self.get_array(port, mmap_directory) for port in ports]
+        else:
+            self._negotiate_encoding()
+            self._get_data_url()
+            pool = ThreadPool(min(self.parallelism, len(ports)))
+            try:
+                arrays = pool.map(lambda port: self._get_worker_client().get_array(port, mmap_directory), ports)
+            finally:
+                pool.close()
+                pool.join()
+        return dict(zip(ports, arrays))
+
+    def get_array(self, port_id, mmap_directory=None):
+        """
+        Get the samples of a port as a NumPy array (see get_arrays()). Sessions
+        recorded in the binary or mapped output format are transferred as binary rows
+        that are copied straight into the array; otherwise (or with older servers) the
+        CSV port file is downloaded and decoded.
+        """
+        from daqpower import loader  # requires numpy
+        path = os.path.join(mmap_directory, port_id + '.npy') if mmap_directory else None
+        layout = self._get_port_layout(port_id)
+        if layout and layout['binary']:
+            return loader.load_rows(lambda first_row, count: self._read_rows(port_id, first_row, count),
+                                    layout['columns'], int(layout['rows']), path)
+        temp_directory = tempfile.mkdtemp(dir=mmap_directory)
+        try:
+            csv_path = os.path.join(temp_directory, port_id)
+            self.pull(port_id, csv_path)
+            return loader.load_csv(csv_path, path)
+        finally:
+            shutil.rmtree(temp_directory)
+
+    def stream(self):
+        """
+        Subscribe to live samples of the configured session. Returns a
+        daqpower.stream.StreamReceiver; iterating over it yields
+        ``(first_sample, block)`` tuples until the capture is stopped.
+        """
+        from daqpower.stream import StreamReceiver  # requires numpy
+        stream_port = self.get_stream_port()
+        if stream_port is None:
+            raise ValueError('Server does not support streaming.')
+        return StreamReceiver(self.host, stream_port, session_id=self.session_id)
+
+    def pull(self, remote_file, local_file, resume=True, follow=False):
         """
         Download a remote port file from the server. You can use list_port_files() to get a list
-        of valid remote_files
+        of valid remote_files. Any existing local_file is replaced, unless it was left by an
+        interrupted download of the same remote file (from the same session): if the server
+        supports it, that is resumed rather than restarted (unless resume is False), and the
+        downloaded file is verified against the checksum computed by the server. If follow is
+        set, the file is downloaded as it is written while the capture is running, until the
+        session has been stopped and the whole file has been received.
+        """
+        if follow:
+            self._follow(remote_file, local_file, resume)
+            return
+        info = self._get_port_file_info(remote_file)
+        if info is None:
+            self._pull_sequential(remote_file, local_file)
+            return
+        remote_size = int(info['size'])
+        download = _Download(local_file, self._get_download_source(remote_file))
+        resumed = False
+        if resume and download.can_resume(remote_size):
+            download.resume()
+            resumed = True
+            self.logger.info('Resuming download of %s at byte %d', remote_file, download.offset)
+        try:
+            data_url = self._get_data_url()
+            if data_url and download.offset < remote_size:
+                try:
+                    self._download_http(data_url, remote_file, download)
+                except (IOError, OSError) as e:
+                    self.logger.warning('HTTP download of %s failed (%s); falling back to RPC.', remote_file, e)
+            self._download_rpc(remote_file, download)
+        finally:
+            download.close()
+        if not self._check_download(remote_file, download, info['sha256'], resumed):
+            self.pull(remote_file, local_file, resume=False)
+
+    def _follow(self, remote_file, local_file, resume):
+        """Download a port file as it is written, until the end of the session."""
+        encoding = self._negotiate_encoding() or 'none'
+        decompress = DECOMPRESSORS[encoding]
+        download = _Download(local_file, self._get_download_source(remote_file))
+        resumed = resume and download.can_resume(self._get_followed_size(remote_file))
+        if resumed:
+            download.resume()
+            self.logger.info('Resuming download of %s at byte %d', remote_file, download.offset)
+        try:
+            while True:
+                args = [remote_file, str(download.offset), 1048576, FOLLOW_TIMEOUT, encoding]
+                if self.compression_level is not None:
+                    args.append(self.compression_level)
+                result = self.follow_port_file(*args)
+                if result['data'].data:
+                    download.write(decompress(result['data'].data))
+                if result['ended']:
+                    break
+        finally:
+            download.close()
+        if not self._check_download(remote_file, download, result['sha256'], resumed):
+            self.pull(remote_file, local_file, resume=False)
+
+    def _check_download(self, remote_file, download, sha256, resumed):
         """
-        with FileReceiver(self, remote_file) as fin:
-            with open(local_file, 'w') as fout:
+        Verify a completed download against the checksum computed by the server (if
+        any), and mark it as complete if it matches. Returns False if a resumed download
+        has to be restarted.
+        """
+        if not sha256 or download.hexdigest() == sha256:
+            download.finish()
+            return True
+        download.discard()
+        if resumed:
+            # The local file was not part of this remote file (e.g. it came from an earlier snapshot).
+            self.logger.info('Checksum mismatch for resumed download of %s; downloading again.', remote_file)
+            return False
+        message = 'Checksum mismatch for {} (expected {}, got {}); the download has been removed.'
+        raise TransferError(message.format(remote_file, sha256, download.hexdigest()))
+
+    def _pull_sequential(self, remote_file, local_file):
+        """Download using the open/read/close protocol (for servers without offset-addressed reads)."""
+        data_url = self._get_data_url()
+        if data_url:
+            download = _Download(local_file, self._get_download_source(remote_file))
+            try:
+                self._download_http(data_url, remote_file, download)
+                download.close()
+                download.finish()
+                return
+            except (IOError, OSError) as e:
+                self.logger.warning('HTTP download of %s failed (%s); falling back to RPC.', remote_file, e)
+                download.close()
+                download.discard()
+        encoding = self._negotiate_encoding()
+        with FileReceiver(self, remote_file, encoding, self.compression_level) as fin:
+            with open(local_file, 'wb' if encoding else 'w') as fout:
                 while True:
                     chunk = fin.read(1048576)
                     if not chunk:
                         break
                     fout.write(chunk)
 
+    def _download_http(self, data_url, remote_file, download):
+        if self.session_id:
+            request = Request('{}/sessions/{}/ports/{}'.format(data_url, self.session_id, quote(remote_file)))
+        else:
+            request = Request('{}/ports/{}'.format(data_url, quote(remote_file)))
+        if download.offset:
+            request.add_header('Range', 'bytes={}-'.format(download.offset))
+        response = urlopen(request)
+        try:
+            if download.offset and response.getcode() != 206:
+                raise IOError('Server ignored range request')
+            for chunk in iter(lambda: response.read(1048576), b''):
+                download.write(chunk)
+        finally:
+            response.close()
+
+    def _download_rpc(self, remote_file, download):
+        encoding = self._negotiate_encoding() or 'none'
+        decompress = DECOMPRESSORS[encoding]
+        while True:
+            args = [remote_file, str(download.offset), 1048576, encoding]
+            if self.compression_level is not None:
+                args.append(self.compression_level)
+            chunk = self.read_port_file_at(*args)
+            if not chunk.data:
+                break
+            download.write(decompress(chunk.data))
+
+    def _get_followed_size(self, remote_file):
+        """Return the size of a remote file written so far, or None if the server cannot tell yet."""
+        try:
+            info = self._get_port_file_info(remote_file)
+        except Fault:
+            return None  # e.g. the port file of a binary capture, until it has been stopped
+        return int(info['size']) if info else None
+
+    def _get_download_source(self, remote_file):
+        return {'server': '{}:{}'.format(self.host, self.port), 'session_id': self.session_id or '',
+                'remote_file': remote_file}
+
+    def _get_port_file_info(self, remote_file):
+        """Return the size and checksum of a remote file, or None if the server does not support it."""
+        try:
+            return self.get_port_file_info(remote_file)
+        except Fault as e:
+            if 'get_port_file_info' not in e.faultString:
+                raise
+            return None
+
+    def _get_port_layout(self, port_id):
+        """Return the layout of the samples of a port, or None if the server does not support it."""
+        try:
+            return self.get_port_layout(port_id)
+        except Fault as e:
+            if 'get_port_layout' not in e.faultString:
+                raise
+            return None
+
+    def _read_rows(self, port_id, first_row, count):
+        encoding = self._negotiate_encoding() or 'none'
+        args = [port_id, str(first_row), str(count), encoding]
+        if self.compression_level is not None:
+            args.append(self.compression_level)
+        return DECOMPRESSORS[encoding](self.read_port_rows(*args).data)
+
+    def _get_worker_client(self):
+        """Return a client for use by the calling thread (ServerProxy is not thread-safe)."""
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = DaqClient(self.host, self.port, self.encoding, self.compression_level, parallelism=1,
+                               use_data_plane=self.use_data_plane, session_id=self.session_id)
+            client._negotiated_encoding = self._negotiated_encoding  # pylint: disable=protected-access
+            client._data_url = self._data_url  # pylint: disable=protected-access
+            self._local.client = client
+        return client
+
+    def _get_data_url(self):
+        """Return the base URL of the server's HTTP data endpoint, or None if there isn't one."""
+        if self._data_url is None:
+            self._data_url = ''
+            if self.use_data_plane:
+                try:
+                    data_port = self.get_data_port()
+                except Fault:
+                    self.logger.debug('Server does not have an HTTP data endpoint.')
+                    data_port = None
+                if data_port:
+                    self._data_url = 'http://{}:{}'.format(self.host, data_port)
+        return self._data_url or None
+
+    def _negotiate_encoding(self):
+        """Pick the transfer encoding to use, falling back to plain text for older servers."""
+        if self._negotiated_encoding is None:
+            self._negotiated_encoding = ''
+            if self.encoding:
+                try:
+                    supported = self.get_transfer_encodings()
+                except Fault:
+                    self.logger.debug('Server does not support binary transfers.')
+                    supported = {}
+                if self.encoding in DECOMPRESSORS and self.encoding in supported:
+                    self._negotiated_encoding = self.encoding
+                elif supported:
+                    self.logger.warning('Transfer encoding %s not supported; using zlib.', self.encoding)
+                    self._negotiated_encoding = 'zlib'
+        return self._negotiated_encoding or None
+
 
 def run_send_command():
     """Main entry point when running as a script -- should not be invoked form another module."""
@@ -91,6 +509,18 @@ def run_send_command():
     parser.add_argument('arguments', nargs='*')
     parser.add_argument('-o', '--output-directory', metavar='DIR', default='.',
                         help='Directory used to output data files (defaults to the current directory).')
+    parser.add_argument('--transfer-encoding', choices=['none', 'zlib', 'lzma'], default='zlib',
+                        help='Compression used when transferring data files (if supported by the server).')
+    parser.add_argument('--compression-level', type=int, metavar='LEVEL',
+                        help='Compression level for --transfer-encoding (defaults to the server\'s choice).')
+    parser.add_argument('-j', '--parallel', type=int, default=4, metavar='N',
+                        help='Number of port files to download concurrently.')
+    parser.add_argument('--follow', action='store_true', default=False,
+                        help='With get_data, download the port files while the capture is running, '
+                             'returning once it has been stopped.')
+    parser.add_argument('-s', '--session', metavar='ID',
+                        help='ID of the session (as returned by configure) to send the command to; '
+                             'defaults to the most recently configured session.')
     parser.add_argument('--verbose', help='Produce verobose output.', action='store_true',
                         default=False)
     args = parser.parse_args()
@@ -102,13 +532,15 @@ def run_send_command():
     else:
         start_logging('INFO', fmt='%(levelname)-8s %(message)s')
 
-    daq_client = DaqClient(args.host, args.port)
+    encoding = args.transfer_encoding if args.transfer_encoding != 'none' else None
+    daq_client = DaqClient(args.host, args.port, encoding, args.compression_level, args.parallel,
+                           session_id=args.session)
 
     if args.command == 'configure':
         args.device_config.validate()
         result = daq_client.configure(args.device_config)
     elif args.command == 'get_data':
-        daq_client.get_data(output_directory=args.output_directory)
+        daq_client.get_data(output_directory=args.output_directory, follow=args.follow)
         result = None
     else:
         result = daq_client.__getattr__(args.command)(*args.arguments)
@@ -16,6 +16,17 @@
 
 import argparse
 import json
+import re
+
+
+# Methods of a server-side session (daqpower.server.DaqSession), which are called over
+# XML-RPC as <session_id>.<method> once a session has been configured. Shared by the
+# server and the client, which must agree on them.
+SESSION_METHODS = ['start', 'stop', 'list_ports', 'get_buffer_pool_stats', 'get_overrun_stats', 'get_port_stats',
+                   'list_port_files', 'open_port_file', 'read_port_file', 'read_port_file_binary',
+                   'get_port_file_info', 'read_port_file_at', 'read_port_window', 'close_port_file', 'snapshot',
+                   'get_trigger_status', 'get_port_layout', 'read_port_rows', 'follow_port_file',
+                   'get_pipeline_results', 'close']
 
 
 class ConfigurationError(Exception):
@@ -27,12 +38,30 @@ class DeviceConfiguration:
     """Encapulates configuration for the DAQ, typically, passed from
     the client."""
 
-    valid_settings = ['device_id', 'v_range', 'dv_range', 'sampling_rate', 'resistor_values', 'labels']
+    valid_settings = ['device_id', 'v_range', 'dv_range', 'sampling_rate', 'resistor_values', 'labels',
+                      'output_format', 'downsample', 'downsample_mode', 'expected_duration', 'ring_duration', 'ring_storage',
+                      'trigger_port', 'trigger_level', 'trigger_edge', 'trigger_hold', 'pre_trigger', 'post_trigger',
+                      'pipeline']
+    valid_output_formats = ['csv', 'binary', 'mapped']
+    valid_downsample_modes = ['mean', 'mean_min_max']
+    valid_ring_storages = ['memory', 'disk']
+    valid_trigger_edges = ['rising', 'falling']
+    # Options of each type of analysis stage (see daqpower.pipeline), mapped onto their types.
+    valid_pipeline_stages = {
+        'statistics': {'name': str, 'window': float},
+        'events': {'name': str, 'port': str, 'level': float, 'edge': str, 'hold': int, 'max_events': int},
+    }
 
     default_device_id = 'Dev1'
     default_v_range = 2.5
     default_dv_range = 0.2
     default_sampling_rate = 10000
+    default_output_format = 'csv'
+    default_downsample = 1
+    default_downsample_mode = 'mean'
+    default_ring_storage = 'memory'
+    default_trigger_edge = 'rising'
+    default_trigger_hold = 1
     # Channel map used in DAQ 6363 and similar.
     default_channel_map = (0, 1, 2, 3, 4, 5, 6, 7, 16, 17, 18, 19, 20, 21, 22, 23)
 
@@ -50,6 +79,25 @@ class DeviceConfiguration:
             self.channel_map = kwargs.pop('channel_map') or self.default_channel_map
             self.labels = (kwargs.pop('labels') or
                            ['PORT_{}.csv'.format(i) for i in range(len(self.resistor_values))])
+            # Optional settings -- may not be sent by older clients.
+            self.output_format = kwargs.pop('output_format', None) or self.default_output_format
+            self.downsample = int(kwargs.pop('downsample', None) or self.default_downsample)
+            self.downsample_mode = kwargs.pop('downsample_mode', None) or self.default_downsample_mode
+            # Seconds (0 if not known); used to preallocate mapped port files.
+            self.expected_duration = float(kwargs.pop('expected_duration', None) or 0)
+            # Seconds of samples kept by the flight recorder (0 to write out all samples).
+            self.ring_duration = float(kwargs.pop('ring_duration', None) or 0)
+            self.ring_storage = kwargs.pop('ring_storage', None) or self.default_ring_storage
+            # Label of the port whose power triggers the capture ('' to capture from start()).
+            self.trigger_port = kwargs.pop('trigger_port', None) or ''
+            self.trigger_level = float(kwargs.pop('trigger_level', None) or 0)
+            self.trigger_edge = kwargs.pop('trigger_edge', None) or self.default_trigger_edge
+            self.trigger_hold = int(kwargs.pop('trigger_hold', None) or self.default_trigger_hold)
+            self.pre_trigger = float(kwargs.pop('pre_trigger', None) or 0)
+            self.post_trigger = float(kwargs.pop('post_trigger', None) or 0)
+            # Analysis stages fed with the samples alongside the port files, as
+            # '<type>[:<option>=<value>,...]' (see get_pipeline_stages()).
+            self.pipeline = list(kwargs.pop('pipeline', None) or [])
         except KeyError as e:
             raise ConfigurationError('Missing config: {}'.format(e.message))
         if kwargs:
@@ -66,6 +114,87 @@ class DeviceConfiguration:
         if len(self.labels) > len(self.channel_map) / 2:
             message = "The number of labels cannot exceed half the number of channels in the channel map"
             raise ConfigurationError(message)
+        if self.output_format not in self.valid_output_formats:
+            message = "'output_format' must be one of {}; got '{}'"
+            raise ConfigurationError(message.format(self.valid_output_formats, self.output_format))
+        if self.downsample < 1:
+            raise ConfigurationError("'downsample' must be at least 1; got {}".format(self.downsample))
+        if self.downsample_mode not in self.valid_downsample_modes:
+            message = "'downsample_mode' must be one of {}; got '{}'"
+            raise ConfigurationError(message.format(self.valid_downsample_modes, self.downsample_mode))
+        if self.expected_duration < 0:
+            message = "'expected_duration' must not be negative; got {}"
+            raise ConfigurationError(message.format(self.expected_duration))
+        if self.ring_duration < 0:
+            raise ConfigurationError("'ring_duration' must not be negative; got {}".format(self.ring_duration))
+        if self.ring_duration and self.output_format != 'csv':
+            message = "'ring_duration' requires the 'csv' output format; got '{}'"
+            raise ConfigurationError(message.format(self.output_format))
+        if self.ring_storage not in self.valid_ring_storages:
+            message = "'ring_storage' must be one of {}; got '{}'"
+            raise ConfigurationError(message.format(self.valid_ring_storages, self.ring_storage))
+        if self.trigger_port:
+            if self.trigger_port not in self.labels:
+                message = "'trigger_port' must be one of {}; got '{}'"
+                raise ConfigurationError(message.format(self.labels, self.trigger_port))
+            if self.ring_duration:
+                raise ConfigurationError("'trigger_port' cannot be used with 'ring_duration'")
+        if self.trigger_edge not in self.valid_trigger_edges:
+            message = "'trigger_edge' must be one of {}; got '{}'"
+            raise ConfigurationError(message.format(self.valid_trigger_edges, self.trigger_edge))
+        if self.trigger_hold < 1:
+            raise ConfigurationError("'trigger_hold' must be at least 1; got {}".format(self.trigger_hold))
+        if self.pre_trigger < 0 or self.post_trigger < 0:
+            message = "'pre_trigger' and 'post_trigger' must not be negative; got {} and {}"
+            raise ConfigurationError(message.format(self.pre_trigger, self.post_trigger))
+        names = set()
+        for stage_type, options in self.get_pipeline_stages():
+            if options['name'] in names:
+                message = "Duplicate pipeline stage name '{}'; use the 'name' option to tell stages apart"
+                raise ConfigurationError(message.format(options['name']))
+            names.add(options['name'])
+            if not re.match(r'^[\w-]+$', options['name']):
+                raise ConfigurationError("Invalid pipeline stage name: '{}'".format(options['name']))
+            if options.get('window', 1) <= 0:
+                raise ConfigurationError("'window' of stage '{}' must be positive".format(options['name']))
+            if stage_type == 'events':
+                if options.get('port') not in self.labels:
+                    message = "'port' of stage '{}' must be one of {}; got '{}'"
+                    raise ConfigurationError(message.format(options['name'], self.labels, options.get('port')))
+                if options.get('edge', self.default_trigger_edge) not in self.valid_trigger_edges:
+                    message = "'edge' of stage '{}' must be one of {}; got '{}'"
+                    raise ConfigurationError(message.format(options['name'], self.valid_trigger_edges,
+                                                            options['edge']))
+                if options.get('hold', 1) < 1 or options.get('max_events', 1) < 1:
+                    message = "'hold' and 'max_events' of stage '{}' must be at least 1"
+                    raise ConfigurationError(message.format(options['name']))
+
+    def get_pipeline_stages(self):
+        """
+        Parse the 'pipeline' setting into a list of ``(type, options)`` tuples, one
+        for each stage, e.g. ``'events:port=A0,level=2.5'`` into ``('events',
+        {'name': 'events', 'port': 'A0', 'level': 2.5})``. A stage is named after its
+        type unless a 'name' is specified.
+        """
+        stages = []
+        for spec in self.pipeline:
+            stage_type, _, option_specs = spec.partition(':')
+            if stage_type not in self.valid_pipeline_stages:
+                message = "Pipeline stage type must be one of {}; got '{}'"
+                raise ConfigurationError(message.format(sorted(self.valid_pipeline_stages), stage_type))
+            option_types = self.valid_pipeline_stages[stage_type]
+            options = {'name': stage_type}
+            for option_spec in filter(None, option_specs.split(',')):
+                option, _, value = option_spec.partition('=')
+                if option not in option_types:
+                    message = "Invalid option '{}' for pipeline stage '{}' (must be one of {})"
+                    raise ConfigurationError(message.format(option, stage_type, sorted(option_types)))
+                try:
+                    options[option] = option_types[option](value)
+                except ValueError:
+                    raise ConfigurationError("Invalid value for '{}' in pipeline stage '{}'".format(option, spec))
+            stages.append((stage_type, options))
+        return stages
 
     def __str__(self):
         return json.dumps(self.__dict__)
@@ -93,6 +222,19 @@ class ConfigNamespace(object):
             self.resistor_values = None
             self.labels = None
             self.channel_map = None
+            self.output_format = None
+            self.downsample = None
+            self.downsample_mode = None
+            self.expected_duration = None
+            self.ring_duration = None
+            self.ring_storage = None
+            self.trigger_port = None
+            self.trigger_level = None
+            self.trigger_edge = None
+            self.trigger_hold = None
+            self.pre_trigger = None
+            self.post_trigger = None
+            self.pipeline = None
 
     @property
     def device_config(self):
@@ -118,6 +260,23 @@ def get_config_parser(device=True):
         parser.add_argument('--sampling-rate', action=UpdateDeviceConfig, type=int)
         parser.add_argument('--resistor-values', action=UpdateDeviceConfig, type=float, nargs='*')
         parser.add_argument('--labels', action=UpdateDeviceConfig, nargs='*')
+        parser.add_argument('--output-format', action=UpdateDeviceConfig,
+                            choices=DeviceConfiguration.valid_output_formats)
+        parser.add_argument('--downsample', action=UpdateDeviceConfig, type=int)
+        parser.add_argument('--downsample-mode', action=UpdateDeviceConfig,
+                            choices=DeviceConfiguration.valid_downsample_modes)
+        parser.add_argument('--expected-duration', action=UpdateDeviceConfig, type=float)
+        parser.add_argument('--ring-duration', action=UpdateDeviceConfig, type=float)
+        parser.add_argument('--ring-storage', action=UpdateDeviceConfig,
+                            choices=DeviceConfiguration.valid_ring_storages)
+        parser.add_argument('--trigger-port', action=UpdateDeviceConfig)
+        parser.add_argument('--trigger-level', action=UpdateDeviceConfig, type=float)
+        parser.add_argument('--trigger-edge', action=UpdateDeviceConfig,
+                            choices=DeviceConfiguration.valid_trigger_edges)
+        parser.add_argument('--trigger-hold', action=UpdateDeviceConfig, type=int)
+        parser.add_argument('--pre-trigger', action=UpdateDeviceConfig, type=float)
+        parser.add_argument('--post-trigger', action=UpdateDeviceConfig, type=float)
+        parser.add_argument('--pipeline', action=UpdateDeviceConfig, nargs='*', metavar='STAGE')
 
     parser.add_argument('--host', default='127.0.0.1')
     parser.add_argument('--port', default=45677, type=int)
@@ -47,33 +47,56 @@ import os
 import sys
 import csv
 import logging
+import struct
 import time
 import threading
+import traceback
+from collections import deque
 import numpy
 if sys.version_info[0] == 3:
-    from queue import Queue, Empty
+    from queue import Queue, Empty, Full
 else:
-    from Queue import Queue, Empty
+    from Queue import Queue, Empty, Full
+
+try:
+    from PyDAQmx import Task, DAQError
+    from PyDAQmx.DAQmxTypes import int32, byref, create_string_buffer
+    from PyDAQmx.DAQmxConstants import (DAQmx_Val_Diff, DAQmx_Val_Volts, DAQmx_Val_GroupByScanNumber,
+                                        DAQmx_Val_Auto, DAQmx_Val_Rising, DAQmx_Val_ContSamps)
+    PYDAQMX_IMPORT_ERROR = None
+except (ImportError, NotImplementedError) as e:
+    # No driver; only the simulated backend (see daqpower.simulation) may be used.
+    PYDAQMX_IMPORT_ERROR = e
+    Task = object
+    int32 = byref = create_string_buffer = None
+
+    class DAQError(Exception):
+        pass
 
-from PyDAQmx import Task, DAQError
 try:
     from PyDAQmx.DAQmxFunctions import DAQmxGetSysDevNames
     CAN_ENUMERATE_DEVICES = True
-except ImportError:  # earlier driver version
+except (ImportError, NotImplementedError):  # earlier driver version
     DAQmxGetSysDevNames = None
     CAN_ENUMERATE_DEVICES = False
 
-from PyDAQmx.DAQmxTypes import int32, byref, create_string_buffer
-from PyDAQmx.DAQmxConstants import (DAQmx_Val_Diff, DAQmx_Val_Volts, DAQmx_Val_GroupByScanNumber, DAQmx_Val_Auto,
-                                    DAQmx_Val_Rising, DAQmx_Val_ContSamps)
-
 try:
     from PyDAQmx.DAQmxConstants import DAQmx_Val_Acquired_Into_Buffer
     callbacks_supported = True
-except ImportError:  # earlier driver version
+except (ImportError, NotImplementedError):  # earlier driver version
     DAQmx_Val_Acquired_Into_Buffer = None
     callbacks_supported = False
 
+from daqpower.config import DeviceConfiguration
+from daqpower.stats import PortStatistics
+from daqpower.timeindex import TimestampIndexWriter, monotonic, TIMESTAMPS_FILENAME
+from daqpower.simulation import SimulatedTask
+from daqpower.metrics import ReadTimer, RateMeter
+from daqpower.portfile import MappedPortWriter, PORT_FILE_SUFFIX
+from daqpower.recorder import FlightRecorder, RING_FILENAME
+from daqpower.capture import (CaptureWriter, ChecksumFile, format_csv_rows, save_checksum,
+                              CAPTURE_FILENAME, DEFAULT_COLUMNS)
+
 
 def list_available_devices():
     """Returns the list of DAQ devices visible to the driver."""
@@ -93,14 +116,135 @@ def list_available_devices():
         return []
 
 
+def get_task_fingerprint(config, simulation=None):
+    """
+    Return a key for the settings a DAQ task is created with (channels, ranges and
+    sample clock); tasks with the same fingerprint are interchangeable.
+    """
+    settings = [config.device_id, list(config.channel_map[:2 * config.number_of_ports]),
+                config.v_range, config.dv_range, config.sampling_rate]
+    if simulation is not None:
+        # Simulated readings also depend on the resistors, and replayed ones on the labels.
+        settings += [list(config.resistor_values), list(config.labels), sorted(simulation.items())]
+    return repr(settings)
+
+
+class TaskCache(object):
+    """
+    Keeps the DAQ task of each device once the runner using it has been closed, so
+    that the next runner with the same fingerprint (see get_task_fingerprint())
+    can reuse it, rather than create the task, its channels and sample clock
+    afresh. At most one task is kept for each device; it is cleared once a runner
+    with a different fingerprint is created for the device.
+
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
+        self.hits = 0
+        self.misses = 0
+        self._tasks = {}  # device ID -> (fingerprint, task)
+        self._lock = threading.Lock()
+
+    def acquire(self, device_id, fingerprint, create):
+        """
+        Return ``(task, reused)``: the cached task for the device if it has the
+        specified fingerprint, or else a new one from create().
+        """
+        with self._lock:
+            cached = self._tasks.pop(device_id, None)
+        if cached:
+            cached_fingerprint, task = cached
+            if cached_fingerprint == fingerprint:
+                self.hits += 1
+                self.logger.debug('Reusing DAQ task for %s', device_id)
+                return task, True
+            self._clear(task)
+        self.misses += 1
+        return create(), False
+
+    def release(self, device_id, fingerprint, task):
+        """Keep a task that is no longer in use (and has been stopped) for reuse."""
+        task.attach(None, None)
+        with self._lock:
+            previous = self._tasks.pop(device_id, None)
+            self._tasks[device_id] = (fingerprint, task)
+        if previous and previous[1] is not task:
+            self._clear(previous[1])
+
+    def clear(self):
+        """Clear all cached tasks, releasing their resources in the driver."""
+        with self._lock:
+            tasks = [task for _, task in self._tasks.values()]
+            self._tasks.clear()
+        for task in tasks:
+            self._clear(task)
+
+    def get_stats(self):
+        with self._lock:
+            cached = len(self._tasks)
+        return {'hits': self.hits, 'misses': self.misses, 'cached': cached}
+
+    def _clear(self, task):
+        try:
+            task.ClearTask()
+        except Exception:  # pylint: disable=broad-except
+            self.logger.warning('Could not clear cached DAQ task:\n%s', traceback.format_exc())
+
+
+class BufferPool(object):
+    """
+    A fixed-capacity pool of sample buffers shared between the DAQ task (which
+    acquires buffers to read into) and the consumer (which releases them once
+    the samples have been written out). If all buffers are in use, a transient
+    buffer is allocated instead and the exhaustion is counted.
+
+    """
+
+    def __init__(self, buffer_size, capacity):
+        self.buffer_size = buffer_size
+        self.capacity = capacity
+        self.allocated = 0
+        self.exhausted = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            if self.allocated < self.capacity:
+                self.allocated += 1
+            else:
+                self.exhausted += 1
+        # Not zeroed: only the first samples_read scans of a buffer are ever looked at.
+        return numpy.empty((self.buffer_size,), dtype=numpy.float64)
+
+    def release(self, buffer):
+        if buffer.shape[0] != self.buffer_size or not buffer.flags.owndata or not buffer.flags.writeable:
+            # Not one of ours: e.g. reconstructed from a spill file, which may happen to be
+            # the same size, but is a read-only view of the bytes read back from it.
+            return
+        with self._lock:
+            if len(self._free) < self.capacity:
+                self._free.append(buffer)
+
+    def get_stats(self):
+        with self._lock:
+            return {'capacity': self.capacity, 'allocated': self.allocated,
+                    'free': len(self._free), 'exhausted': self.exhausted}
+
+
 class ReadSamplesBaseTask(Task):
 
-    def __init__(self, config, consumer):
+    def __init__(self, config, consumer, buffer_pool):
         Task.__init__(self)
         self.config = config
         self.consumer = consumer
         self.sample_buffer_size = (self.config.sampling_rate + 1) * self.config.number_of_ports * 2
+        self.buffer_pool = buffer_pool
         self.samples_read = int32()
+        self.read_timer = ReadTimer()
         self.remainder = []
         # create voltage channels
         for i in range(0, 2 * self.config.number_of_ports, 2):
@@ -119,6 +263,12 @@ class ReadSamplesBaseTask(Task):
                               DAQmx_Val_ContSamps,
                               self.config.sampling_rate)
 
+    def attach(self, consumer, buffer_pool):
+        """Deliver samples to another consumer, e.g. when the task is reused by a new runner."""
+        self.consumer = consumer
+        self.buffer_pool = buffer_pool
+        self.read_timer = ReadTimer()
+
 
 class ReadSamplesCallbackTask(ReadSamplesBaseTask):
     """
@@ -126,23 +276,21 @@ class ReadSamplesCallbackTask(ReadSamplesBaseTask):
 
     """
 
-    def __init__(self, config, consumer):
-        ReadSamplesBaseTask.__init__(self, config, consumer)
+    def __init__(self, config, consumer, buffer_pool):
+        ReadSamplesBaseTask.__init__(self, config, consumer, buffer_pool)
         # register callbacks
         self.AutoRegisterEveryNSamplesEvent(DAQmx_Val_Acquired_Into_Buffer, self.config.sampling_rate // 2, 0)
         self.AutoRegisterDoneEvent(0)
 
     def EveryNCallback(self):
-        # Note to future self: do NOT try to "optimize" this but re-using the same array and just
-        # zeroing it out each time. The writes happen asynchronously and if your zero it out too soon,
-        # you'll see a whole bunch of 0.0's in the output. If you wanna go down that route, you'll need
-        # cycler through several arrays and have the code that's actually doing the writing zero them out
-        # mark them as available to be used by this call. But, honestly, numpy array allocation does not
-        # appear to be a bottleneck at the moment, so the current solution is "good enough".
-        samples_buffer = numpy.zeros((self.sample_buffer_size,), dtype=numpy.float64)
+        # The writes happen asynchronously, so the buffer must not be reused until the
+        # consumer has released it back into the pool.
+        read_start = self.read_timer.start()
+        samples_buffer = self.buffer_pool.acquire()
         self.ReadAnalogF64(DAQmx_Val_Auto, 0.0, DAQmx_Val_GroupByScanNumber, samples_buffer,
                            self.sample_buffer_size, byref(self.samples_read), None)
-        self.consumer.write((samples_buffer, self.samples_read.value))
+        self.read_timer.stop(read_start, self.samples_read.value)
+        self.consumer.write((samples_buffer, self.samples_read.value, time.time(), monotonic()))
 
     def DoneCallback(self, status):  # pylint: disable=W0613,R0201
         return 0  # The function should return an integer
@@ -155,16 +303,20 @@ class ReadSamplesThreadedTask(ReadSamplesBaseTask):
 
     """
 
-    def __init__(self, config, consumer):
-        ReadSamplesBaseTask.__init__(self, config, consumer)
-        self.poller = DaqPoller(self)
+    def __init__(self, config, consumer, buffer_pool):
+        ReadSamplesBaseTask.__init__(self, config, consumer, buffer_pool)
+        self.poller = None
 
     def StartTask(self):
         ReadSamplesBaseTask.StartTask(self)
+        # A new thread each time, as the task may be restarted.
+        self.poller = DaqPoller(self)
         self.poller.start()
 
     def StopTask(self):
-        self.poller.stop()
+        if self.poller:
+            self.poller.stop()
+            self.poller = None
         ReadSamplesBaseTask.StopTask(self)
 
 
@@ -175,51 +327,141 @@ class DaqPoller(threading.Thread):
         self.task = task
         self.wait_period = wait_period
         self._stop_signal = threading.Event()
-        self.samples_buffer = numpy.zeros((self.task.sample_buffer_size,), dtype=numpy.float64)
 
     def run(self):
         while not self._stop_signal.is_set():
-            # Note to future self: see the comment inside EventNCallback() above
-            samples_buffer = numpy.zeros((self.task.sample_buffer_size,), dtype=numpy.float64)
+            # See the comment inside EveryNCallback() above
+            read_start = self.task.read_timer.start()
+            samples_buffer = self.task.buffer_pool.acquire()
             try:
                 self.task.ReadAnalogF64(DAQmx_Val_Auto, self.wait_period, DAQmx_Val_GroupByScanNumber, samples_buffer,
                                         self.task.sample_buffer_size, byref(self.task.samples_read), None)
             except DAQError:
-                pass
-            self.task.consumer.write((samples_buffer, self.task.samples_read.value))
+                # Buffer contents are undefined (it is not zeroed), so nothing to pass on.
+                self.task.buffer_pool.release(samples_buffer)
+                continue
+            self.task.read_timer.stop(read_start, self.task.samples_read.value)
+            self.task.consumer.write((samples_buffer, self.task.samples_read.value, time.time(), monotonic()))
 
     def stop(self):
         self._stop_signal.set()
         self.join()
 
 
+OVERRUN_POLICIES = ['block', 'drop_oldest', 'spill']
+
+
 class AsyncWriter(threading.Thread):
+    """
+    Consumes items written into it on a separate thread. If ``max_queue_size``
+    is set, the queue is bounded and ``overrun_policy`` determines what happens
+    when it is full:
+
+    :block: ``write()`` blocks until the consumer catches up.
+    :drop_oldest: the oldest queued item is discarded to make room.
+    :spill: items are appended to a file at ``spill_path`` until the consumer
+            has caught up with everything queued before them.
+
+    The number of samples affected by each policy is tracked and returned by
+    ``get_overrun_stats()``.
+
+    """
 
-    def __init__(self, wait_period=1):
+    def __init__(self, wait_period=1, max_queue_size=0, overrun_policy='block', spill_path=None):
         super(AsyncWriter, self).__init__()
         self.daemon = True
         self.wait_period = wait_period
         self.running = threading.Event()
         self._stop_signal = threading.Event()
-        self._queue = Queue()
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError('Invalid overrun policy: {}'.format(overrun_policy))
+        if overrun_policy == 'spill' and max_queue_size and not spill_path:
+            raise ValueError('spill_path must be specified for the spill overrun policy.')
+        self.max_queue_size = max_queue_size
+        self.overrun_policy = overrun_policy
+        self.spill_path = spill_path
+        self._queue = Queue(max_queue_size)
+        self._spill_lock = threading.Lock()
+        self._spill_file = None
+        self._spilled = deque()  # (offset, size) of each spilled item, oldest first
+        self.max_queue_depth = 0
+        self.blocked_samples = 0
+        self.dropped_samples = 0
+        self.spilled_samples = 0
 
     def write(self, stuff):
         if self._stop_signal.is_set():
             raise IOError('Attempting to writer to {} after it has been closed.'.format(self.__class__.__name__))
-        self._queue.put(stuff)
+        if self.overrun_policy == 'spill':
+            with self._spill_lock:
+                # Once spilling has started, everything goes to the spill file until it has
+                # been drained, otherwise items would be consumed out of order.
+                if self._spilled or self._queue.full():
+                    self._spill(stuff)
+                else:
+                    self._queue.put_nowait(stuff)
+        else:
+            try:
+                self._queue.put_nowait(stuff)
+            except Full:
+                if self.overrun_policy == 'block':
+                    self.blocked_samples += self.count_samples(stuff)
+                    self._queue.put(stuff)
+                else:  # drop_oldest
+                    try:
+                        dropped = self._queue.get_nowait()
+                        self.dropped_samples += self.count_samples(dropped)
+                        self.discard(dropped)
+                    except Empty:
+                        pass  # consumer got there first
+                    self._queue.put(stuff)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
 
     def do_write(self, stuff):
         raise NotImplementedError()
 
+    def count_samples(self, stuff):  # pylint: disable=unused-argument,no-self-use
+        """Number of samples in an item; used for overrun accounting."""
+        return 1
+
+    def discard(self, stuff):
+        """Called for an item that is dropped or spilled rather than passed to do_write()."""
+        pass
+
+    def encode(self, stuff):
+        """Serialize an item into bytes for the spill file."""
+        raise NotImplementedError()
+
+    def decode(self, data):
+        """Reconstruct an item from the bytes produced by encode()."""
+        raise NotImplementedError()
+
+    def get_overrun_stats(self):
+        return {
+            'max_queue_size': self.max_queue_size,
+            'overrun_policy': self.overrun_policy,
+            'queue_depth': self._queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'blocked_samples': self.blocked_samples,
+            'dropped_samples': self.dropped_samples,
+            'spilled_samples': self.spilled_samples,
+        }
+
     def run(self):
         self.running.set()
         while True:
-            if self._stop_signal.is_set() and self._queue.empty():
+            if self._stop_signal.is_set() and self._queue.empty() and not self._spilled:
                 break
             try:
-                self.do_write(self._queue.get(block=True, timeout=self.wait_period))
+                stuff = self._queue.get_nowait()
             except Empty:
-                pass  # carry on
+                stuff = self._unspill()
+                if stuff is None:
+                    try:
+                        stuff = self._queue.get(block=True, timeout=self.wait_period)
+                    except Empty:
+                        continue  # carry on
+            self.do_write(stuff)
         self.running.clear()
 
     def stop(self):
@@ -228,70 +470,494 @@ class AsyncWriter(threading.Thread):
     def wait(self):
         while self.running.is_set():
             time.sleep(self.wait_period)
+        with self._spill_lock:
+            if self._spill_file:
+                self._spill_file.close()
+                self._spill_file = None
+                os.remove(self.spill_path)
+
+    def _spill(self, stuff):
+        if not self._spill_file:
+            self._spill_file = open(self.spill_path, 'w+b')
+        data = self.encode(stuff)
+        self._spill_file.seek(0, os.SEEK_END)
+        self._spilled.append((self._spill_file.tell(), len(data)))
+        self._spill_file.write(data)
+        self.spilled_samples += self.count_samples(stuff)
+        self.discard(stuff)
+
+    def _unspill(self):
+        with self._spill_lock:
+            if not self._spilled:
+                return None
+            offset, size = self._spilled.popleft()
+            self._spill_file.seek(offset)
+            data = self._spill_file.read(size)
+            if not self._spilled:
+                # Fully drained -- start from the beginning next time.
+                self._spill_file.seek(0)
+                self._spill_file.truncate()
+        return self.decode(data)
 
 
 class PortWriter(object):
 
-    def __init__(self, path):
+    def __init__(self, path, columns=DEFAULT_COLUMNS):
         self.path = path
-        self.fh = open(path, 'w')
+        self.fh = ChecksumFile(path)
         self.writer = csv.writer(self.fh, lineterminator="\n")
-        self.writer.writerow(['power', 'voltage'])
+        self.writer.writerow(columns)
 
     def write(self, row):
         self.writer.writerow(row)
 
+    @property
+    def size(self):
+        return self.fh.size
+
+    @property
+    def closed(self):
+        return self.fh.closed
+
+    def write_block(self, *columns):
+        """Write a block of samples; one 1D array of equal length for each column (e.g. power, voltage)."""
+        self.fh.write(format_csv_rows(*columns))
+
+    def flush(self):
+        self.fh.flush()
+
     def close(self):
-        self.fh.close()
+        if not self.fh.closed:
+            self.fh.close()
+            save_checksum(self.path, self.fh.hexdigest())
 
     def __del__(self):
         self.close()
 
 
+class Downsampler(object):
+    """
+    Combines every ``factor`` consecutive power/voltage samples into one point,
+    reporting the mean (and, if ``extrema`` is set, the min and max) of each
+    window. Samples of an incomplete window at the end of a chunk are carried
+    over to the next one.
+
+    """
+
+    @property
+    def columns(self):
+        if self.extrema:
+            return ['power', 'voltage', 'power_min', 'power_max', 'voltage_min', 'voltage_max']
+        return ['power', 'voltage']
+
+    def __init__(self, factor, extrema=False):
+        self.factor = factor
+        self.extrema = extrema
+        self._carry = None
+
+    def process(self, power, voltage):
+        """Return a list of (windows, ports) arrays, one for each of self.columns."""
+        data = numpy.stack((power, voltage), axis=-1)
+        if self._carry is not None:
+            data = numpy.concatenate((self._carry, data))
+        number_of_windows = data.shape[0] // self.factor
+        end = number_of_windows * self.factor
+        # Copy, as the source buffer is recycled as soon as this chunk has been processed.
+        self._carry = data[end:].copy() if end < data.shape[0] else None
+        windows = data[:end].reshape((number_of_windows, self.factor) + data.shape[1:])
+        return self._aggregate(windows)
+
+    def flush(self):
+        """Aggregate any carried-over samples into a final (partial) window."""
+        if self._carry is None:
+            return None
+        windows = self._carry[numpy.newaxis]
+        self._carry = None
+        return self._aggregate(windows)
+
+    def _aggregate(self, windows):
+        mean = windows.mean(axis=1)
+        result = [mean[:, :, 0], mean[:, :, 1]]
+        if self.extrema:
+            minimum = windows.min(axis=1)
+            maximum = windows.max(axis=1)
+            result.extend([minimum[:, :, 0], maximum[:, :, 0], minimum[:, :, 1], maximum[:, :, 1]])
+        return result
+
+
+class Trigger(object):
+    """
+    Detects the point at which the power of a port crosses ``level`` (going up,
+    for a 'rising' edge, or down, for a 'falling' one) and stays past it for
+    ``hold`` consecutive samples. The power must have been on the other side of
+    the level first, so that a capture is not triggered just because the power is
+    already past it when armed. Runs carry over from one chunk to the next.
+
+    """
+
+    def __init__(self, port, level, edge='rising', hold=1):
+        self.port = port
+        self.level = level
+        self.edge = edge
+        self.hold = max(int(hold), 1)
+        self._run = None  # samples past the level at the end of the last chunk; None until it has been crossed
+
+    def find(self, power):
+        """
+        Return the index, within the (samples, ports) power array of a chunk, of the
+        first sample of the run that fires the trigger (negative if the run started in
+        an earlier chunk), or None if it does not fire.
+        """
+        port_power = power[:, self.port]
+        past = port_power > self.level if self.edge == 'rising' else port_power < self.level
+        positions = numpy.arange(past.shape[0])
+        # Position of the last sample (up to each sample) that was not past the level.
+        last_before = numpy.maximum.accumulate(numpy.where(past, -1, positions))
+        runs = positions - last_before
+        carried = last_before < 0
+        if self._run is None:
+            runs[carried] = 0
+        else:
+            runs[carried] += self._run
+        fired = numpy.flatnonzero(runs >= self.hold)
+        if fired.size:
+            return int(fired[0]) - self.hold + 1
+        if not carried[-1] or self._run is not None:
+            self._run = int(runs[-1])
+        return None
+
+
+def get_power_and_voltage(samples, number_of_samples, resistors):
+    """
+    Return the power and voltage of each port, as (samples, ports) arrays, for the
+    first number_of_samples scans of a raw sample buffer, given the resistor value
+    of each port.
+    """
+    # Samples are grouped by scan number, i.e. V0, DV0, V1, DV1, ... for each scan.
+    scans = samples[:number_of_samples * resistors.shape[0] * 2].reshape((number_of_samples, resistors.shape[0], 2))
+    voltage = scans[:, :, 0]
+    return voltage * (scans[:, :, 1] / resistors), voltage
+
+
 class SamplePorcessorError(Exception):
     pass
 
 
-class SampleProcessor(AsyncWriter):
+def get_port_file_path(output_directory, labels, port_id, suffix='.csv'):
+    """Return the path of the file (with the specified suffix) of a port in the output directory of a session."""
+    if port_id not in labels:
+        raise SamplePorcessorError('Invalid port ID: {}'.format(port_id))
+    return os.path.join(output_directory, port_id + suffix)
+
+
+SPILL_FILENAME = 'writer.spill'
+
+_timestamps = struct.Struct('<dd')
+
+
+class RawSampleWriter(AsyncWriter):
+    """
+    Consumes the raw sample tuples delivered by a DAQ task, i.e. ``(buffer,
+    number_of_samples, wall_time, monotonic_time)``, where buffer holds the
+    samples of each port grouped by scan, and is returned to ``buffer_pool``
+    once it has been consumed.
+
+    """
+
+    def __init__(self, number_of_ports, buffer_pool=None, **kwargs):
+        super(RawSampleWriter, self).__init__(**kwargs)
+        self.number_of_ports = number_of_ports
+        self.buffer_pool = buffer_pool
+
+    def count_samples(self, sample_tuple):
+        return sample_tuple[1]
+
+    def discard(self, sample_tuple):
+        if self.buffer_pool:
+            self.buffer_pool.release(sample_tuple[0])
+
+    def encode(self, sample_tuple):
+        samples, number_of_samples, wall_time, monotonic_time = sample_tuple
+        return (_timestamps.pack(wall_time, monotonic_time) +
+                samples[:number_of_samples * self.number_of_ports * 2].tobytes())
+
+    def decode(self, data):
+        wall_time, monotonic_time = _timestamps.unpack_from(data)
+        samples = numpy.frombuffer(data, dtype=numpy.float64, offset=_timestamps.size)
+        return samples, samples.shape[0] // (self.number_of_ports * 2), wall_time, monotonic_time
+
+
+class SampleProcessor(RawSampleWriter):
 
-    def __init__(self, resistor_values, output_directory, labels):
-        super(SampleProcessor, self).__init__()
+    def __init__(self, resistor_values, output_directory, labels, output_format='csv', chunk_size=10000,
+                 buffer_pool=None, max_queue_size=0, overrun_policy='block', downsample=1,
+                 downsample_mode='mean', broadcaster=None, sampling_rate=None, expected_duration=None,
+                 ring_duration=None, ring_storage='memory', trigger=None, pre_trigger=0, post_trigger=0):
+        super(SampleProcessor, self).__init__(len(resistor_values), buffer_pool, max_queue_size=max_queue_size,
+                                              overrun_policy=overrun_policy,
+                                              spill_path=os.path.join(output_directory, SPILL_FILENAME))
+        self.broadcaster = broadcaster
         self.resistor_values = resistor_values
         self.output_directory = output_directory
         self.labels = labels
-        self.number_of_ports = len(resistor_values)
+        self.output_format = output_format
+        self.chunk_size = chunk_size
+        self._resistors = numpy.array(resistor_values, dtype=numpy.float64)
         if len(self.labels) != self.number_of_ports:
             message = 'Number of labels ({}) does not match number of ports ({}).'
             raise SamplePorcessorError(message.format(len(self.labels), self.number_of_ports))
+        if self.output_format not in DeviceConfiguration.valid_output_formats:
+            raise SamplePorcessorError('Invalid output format: {}'.format(self.output_format))
+        if downsample_mode not in DeviceConfiguration.valid_downsample_modes:
+            raise SamplePorcessorError('Invalid downsample mode: {}'.format(downsample_mode))
+        if ring_storage not in DeviceConfiguration.valid_ring_storages:
+            raise SamplePorcessorError('Invalid ring storage: {}'.format(ring_storage))
+        self.downsample = int(downsample)
+        if self.downsample > 1:
+            self.downsampler = Downsampler(self.downsample, extrema=(downsample_mode == 'mean_min_max'))
+            self.columns = self.downsampler.columns
+        else:
+            self.downsampler = None
+            self.columns = list(DEFAULT_COLUMNS)
+        self.sampling_rate = sampling_rate or chunk_size
+        self.expected_duration = expected_duration
+        self.ring_duration = ring_duration
+        self.ring_storage = ring_storage
+        # Triggered capture: rows are only written out from pre_trigger seconds before the
+        # trigger fires until post_trigger seconds after it (or the end of the capture).
+        self.trigger = trigger
+        self.pre_trigger_rows = int(numpy.ceil((pre_trigger or 0) * self.sampling_rate / self.downsample))
+        self.post_trigger_rows = int(numpy.ceil((post_trigger or 0) * self.sampling_rate / self.downsample))
+        self.trigger_sample = None
+        self.trigger_time = None
+        self.first_row_written = None
+        self._history = None
+        self._rows_processed = 0
+        self._stop_row = None
+        self._indexed_rows = 0
+        self.statistics = PortStatistics(self.labels, self.sampling_rate)
         self.port_writers = []
+        self.capture_writer = None
+        self.recorder = None
+        self.timestamp_index = None
+        self.samples_processed = 0
+        self.rows_written = 0
+        self.write_rate = RateMeter()
 
     def do_write(self, sample_tuple):
-        samples, number_of_samples = sample_tuple
-        for i in range(0, number_of_samples * self.number_of_ports * 2, self.number_of_ports * 2):
-            for j in range(self.number_of_ports):
-                V = float(samples[i + 2 * j])
-                DV = float(samples[i + 2 * j + 1])
-                P = V * (DV / self.resistor_values[j])
-                self.port_writers[j].write([P, V])
+        samples, number_of_samples, wall_time, monotonic_time = sample_tuple
+        try:
+            self._process(samples, number_of_samples)
+        finally:
+            self.discard(sample_tuple)
+        if number_of_samples:
+            self.samples_processed += number_of_samples
+            if self.trigger_sample is not None and self.trigger_time is None:
+                self.trigger_time = wall_time - float(self.samples_processed - self.trigger_sample) / self.sampling_rate
+            if self.recorder:
+                self.recorder.mark(self.samples_processed, self.rows_written, wall_time, monotonic_time)
+            elif not self.trigger or self.rows_written != self._indexed_rows:
+                # Samples are counted from the first sample of the first row written out.
+                self.timestamp_index.record(self.samples_processed - self._get_first_sample_written(),
+                                            self.rows_written, wall_time, monotonic_time,
+                                            self._get_port_file_offsets())
+                self._indexed_rows = self.rows_written
+            self.write_rate.update(self.get_bytes_written())
+
+    def _process(self, samples, number_of_samples):
+        if not number_of_samples:
+            return
+        power, voltage = get_power_and_voltage(samples, number_of_samples, self._resistors)
+        self.statistics.update(power)
+        if self.trigger and self.trigger_sample is None:
+            index = self.trigger.find(power)
+            if index is not None:
+                self.trigger_sample = max(self.samples_processed + index, 0)
+                if self.post_trigger_rows:
+                    self._stop_row = self.trigger_sample // self.downsample + self.post_trigger_rows
+        if self.downsampler:
+            self._write_columns(self.downsampler.process(power, voltage))
+        else:
+            self._write_columns([power, voltage])
+
+    def _write_columns(self, columns):
+        if not columns[0].shape[0]:
+            return
+        output = self._gate(columns) if self.trigger else columns
+        if output and output[0].shape[0]:
+            if self.capture_writer:
+                self.capture_writer.write(*output)
+            if self.recorder:
+                self.recorder.write(output)
+            for j, writer in enumerate(self.port_writers):
+                writer.write_block(*[column[:, j] for column in output])
+            self.rows_written += output[0].shape[0]
+        if self.broadcaster:
+            self.broadcaster.publish(columns)
+
+    def _gate(self, columns):
+        """
+        Return the rows of a block that are to be written out in a triggered capture
+        (including, once the trigger has fired, the pre-trigger history), or None.
+        Rows before the trigger are kept as history.
+        """
+        first = self._rows_processed
+        self._rows_processed += columns[0].shape[0]
+        if self.trigger_sample is None:
+            self._history.write(columns)
+            return None
+        if self.first_row_written is None:
+            start = self.trigger_sample // self.downsample - self.pre_trigger_rows
+            history_first, history, _ = self._history.get_window()
+            self._history = None
+            columns = [numpy.concatenate((history[:, :, i], column)) for i, column in enumerate(columns)]
+            first = history_first
+            start = max(start, first)
+            columns = [column[start - first:] for column in columns]
+            first = self.first_row_written = start
+        if self._stop_row is not None:
+            columns = [column[:max(self._stop_row - first, 0)] for column in columns]
+        return columns
+
+    def _get_first_sample_written(self):
+        return (self.first_row_written or 0) * self.downsample
+
+    def _get_port_file_offsets(self):
+        # Flushed, so that the rows are on disk by the time the index points at them.
+        self._flush()
+        return [writer.size for writer in self.port_writers]
+
+    def _flush(self):
+        """
+        Flush the rows written so far out to the files, so that they can be read (and
+        followed) while the capture is running. This is done for every chunk indexed,
+        so at least once per chunk delivered by the driver (i.e. every half a second)
+        while rows are being written.
+        """
+        for writer in self.port_writers:
+            if not writer.closed:
+                writer.flush()
+        if self.capture_writer and not self.capture_writer.fh.closed:
+            self.capture_writer.flush()
 
     def start(self):
-        for label in self.labels:
-            port_file = self.get_port_file_path(label)
-            writer = PortWriter(port_file)
-            self.port_writers.append(writer)
+        if self.trigger:
+            # Enough history for the pre-trigger window, and for a run that started in an earlier chunk.
+            capacity = self.pre_trigger_rows + self.trigger.hold // self.downsample + 1
+            self._history = FlightRecorder(capacity, self.number_of_ports, self.columns, self.sampling_rate,
+                                           self.downsample)
+        if self.ring_duration:
+            # Flight recorder: nothing is written out until snapshot() is called.
+            capacity = max(int(numpy.ceil(self.ring_duration * self.sampling_rate / self.downsample)), 1)
+            path = os.path.join(self.output_directory, RING_FILENAME) if self.ring_storage == 'disk' else None
+            self.recorder = FlightRecorder(capacity, self.number_of_ports, self.columns, self.sampling_rate,
+                                           self.downsample, path)
+            self._start_broadcaster()
+            super(SampleProcessor, self).start()
+            return
+        if self.output_format == 'binary':
+            metadata = {'resistor_values': list(self.resistor_values), 'downsample': self.downsample}
+            chunk_size = max(self.chunk_size // self.downsample, 1)
+            self.capture_writer = CaptureWriter(self.get_capture_file_path(), self.labels,
+                                                chunk_size, metadata, self.columns)
+        elif self.output_format == 'mapped':
+            metadata = {'resistor_values': list(self.resistor_values), 'downsample': self.downsample}
+            expected_rows = 0
+            if self.expected_duration:
+                # Plus a chunk, as a capture stopped right on time still delivers its last chunk.
+                expected_rows = int((self.expected_duration * self.sampling_rate + self.chunk_size) //
+                                    self.downsample) + 1
+            for label in self.labels:
+                writer = MappedPortWriter(self.get_mapped_file_path(label), self.columns, expected_rows, metadata)
+                self.port_writers.append(writer)
+        else:
+            for label in self.labels:
+                port_file = self.get_port_file_path(label)
+                writer = PortWriter(port_file, self.columns)
+                self.port_writers.append(writer)
+        self.timestamp_index = TimestampIndexWriter(os.path.join(self.output_directory, TIMESTAMPS_FILENAME),
+                                                    self.number_of_ports, self.sampling_rate, self.downsample)
+        self.timestamp_index.start(self._get_port_file_offsets())
+        self._start_broadcaster()
         super(SampleProcessor, self).start()
 
+    def _start_broadcaster(self):
+        if self.broadcaster:
+            metadata = {'resistor_values': list(self.resistor_values), 'downsample': self.downsample}
+            self.broadcaster.open(self.labels, self.columns, metadata)
+
     def stop(self):
         super(SampleProcessor, self).stop()
         self.wait()
+        if self.downsampler:
+            remainder = self.downsampler.flush()
+            if remainder:
+                self._write_columns(remainder)
+        if self.timestamp_index and not self.timestamp_index.fh.closed:
+            self.timestamp_index.finish(self.samples_processed - self._get_first_sample_written(), self.rows_written,
+                                        self._get_port_file_offsets())
+            self.timestamp_index.close()
         for writer in self.port_writers:
             writer.close()
+        if self.capture_writer:
+            self.capture_writer.close()
+        if self.recorder:
+            self.recorder.close()
+        if self.broadcaster:
+            self.broadcaster.close()
 
     def get_port_file_path(self, port_id):
-        if port_id in self.labels:
-            return os.path.join(self.output_directory, port_id + '.csv')
+        return get_port_file_path(self.output_directory, self.labels, port_id)
+
+    def get_trigger_status(self):
+        """
+        Return the 'state' of the trigger ('disabled', 'armed', 'triggered' or
+        'complete', once post_trigger has elapsed), and the number and (estimated
+        wall clock) time of the sample at which it fired.
+        """
+        if not self.trigger:
+            state = 'disabled'
+        elif self.trigger_sample is None:
+            state = 'armed'
+        elif self._stop_row is not None and self._rows_processed >= self._stop_row:
+            state = 'complete'
         else:
-            raise SamplePorcessorError('Invalid port ID: {}'.format(port_id))
+            state = 'triggered'
+        return {'state': state,
+                'trigger_sample': str(self.trigger_sample) if self.trigger_sample is not None else None,
+                'trigger_time': self.trigger_time}
+
+    def snapshot(self):
+        """Write the samples held by the flight recorder into the port files; see FlightRecorder.snapshot()."""
+        if not self.recorder:
+            raise SamplePorcessorError('No samples are being recorded.')
+        return self.recorder.snapshot(self.output_directory, self.labels, self.get_port_file_path)
+
+    def get_capture_file_path(self):
+        return os.path.join(self.output_directory, CAPTURE_FILENAME)
+
+    def get_mapped_file_path(self, port_id):
+        return get_port_file_path(self.output_directory, self.labels, port_id, PORT_FILE_SUFFIX)
+
+    def get_port_bytes_written(self):
+        """Bytes written to each port file so far, keyed on label (empty for binary output)."""
+        return dict((label, writer.size) for label, writer in zip(self.labels, self.port_writers))
+
+    def get_bytes_written(self):
+        if self.capture_writer:
+            path = self.get_capture_file_path()
+            return os.path.getsize(path) if os.path.isfile(path) else 0
+        return sum(writer.size for writer in self.port_writers)
+
+    def get_port_stats(self):
+        return self.statistics.get()
+
+    def get_progress(self):
+        """Samples processed, and bytes written (in total, for each port, and per second recently)."""
+        return {'samples_processed': self.samples_processed,
+                'bytes_written': self.get_bytes_written(),
+                'port_bytes_written': self.get_port_bytes_written(),
+                'bytes_per_second': self.write_rate.rate()}
 
     def __del__(self):
         self.stop()
@@ -303,19 +969,64 @@ class DaqRunner(object):
     def number_of_ports(self):
         return self.config.number_of_ports
 
-    def __init__(self, config, output_directory):
+    def __init__(self, config, output_directory, buffer_pool_capacity=16, max_queue_size=0,
+                 overrun_policy='block', broadcaster=None, simulation=None, worker_process=False, task_cache=None):
         self.logger = logging.getLogger("{}.{}".format(__name__, self.__class__.__name__))
         self.config = config
-        self.processor = SampleProcessor(config.resistor_values, output_directory, config.labels)
-        if callbacks_supported:
-            self.task = ReadSamplesCallbackTask(config, self.processor)
+        buffer_size = (config.sampling_rate + 1) * config.number_of_ports * 2
+        self.buffer_pool = BufferPool(buffer_size, buffer_pool_capacity)
+        trigger = None
+        if config.trigger_port:
+            trigger = Trigger(config.labels.index(config.trigger_port), config.trigger_level,
+                              config.trigger_edge, config.trigger_hold)
+        processor_kwargs = dict(resistor_values=config.resistor_values, output_directory=output_directory,
+                                labels=config.labels, output_format=config.output_format,
+                                chunk_size=config.sampling_rate, downsample=config.downsample,
+                                downsample_mode=config.downsample_mode, broadcaster=broadcaster,
+                                sampling_rate=config.sampling_rate, expected_duration=config.expected_duration,
+                                ring_duration=config.ring_duration, ring_storage=config.ring_storage,
+                                trigger=trigger, pre_trigger=config.pre_trigger, post_trigger=config.post_trigger)
+        self.worker_process = worker_process
+        # Buffers are shared between the processor and any analysis stages (see daqpower.pipeline).
+        consumer_pool = self.buffer_pool
+        self.stages = []
+        if config.pipeline:
+            from daqpower.pipeline import SharedBufferPool, FanOut, create_stage  # imports this module
+            consumer_pool = SharedBufferPool(self.buffer_pool)
+            self.stages = [create_stage(stage_type, options, config.resistor_values, config.labels,
+                                        config.sampling_rate, output_directory, buffer_pool=consumer_pool,
+                                        max_queue_size=max_queue_size, overrun_policy=overrun_policy)
+                           for stage_type, options in config.get_pipeline_stages()]
+        if worker_process:
+            from daqpower.worker import ProcessSampleProcessor  # imports this module
+            self.processor = ProcessSampleProcessor(processor_kwargs, consumer_pool, max_queue_size,
+                                                    overrun_policy)
+        else:
+            self.processor = SampleProcessor(buffer_pool=consumer_pool, max_queue_size=max_queue_size,
+                                             overrun_policy=overrun_policy, **processor_kwargs)
+        self.consumer = FanOut(consumer_pool, [self.processor] + self.stages) if self.stages else self.processor
+        if simulation is not None:
+            # simulation is a dict of SimulatedTask arguments (waveform, replay, speed).
+            create_task = lambda: SimulatedTask(config, self.consumer, self.buffer_pool, **simulation)
+        elif callbacks_supported:
+            create_task = lambda: ReadSamplesCallbackTask(config, self.consumer, self.buffer_pool)
         else:
-            self.task = ReadSamplesThreadedTask(config, self.processor)
+            create_task = lambda: ReadSamplesThreadedTask(config, self.consumer, self.buffer_pool)
+        self.task_cache = task_cache
+        self.task_fingerprint = get_task_fingerprint(config, simulation)
+        self.task_reused = False
+        if task_cache:
+            self.task, self.task_reused = task_cache.acquire(config.device_id, self.task_fingerprint, create_task)
+            self.task.attach(self.consumer, self.buffer_pool)
+        else:
+            self.task = create_task()
         self.is_running = False
 
     def start(self):
         self.logger.debug('Starting sample processor.')
         self.processor.start()
+        for stage in self.stages:
+            stage.start()
         self.logger.debug('Starting DAQ Task.')
         self.task.StartTask()
         self.is_running = True
@@ -327,21 +1038,101 @@ class DaqRunner(object):
         self.task.StopTask()
         self.logger.debug('Stopping sample processor.')
         self.processor.stop()
+        for stage in self.stages:
+            self.logger.debug('Stopping pipeline stage %s.', stage.name)
+            stage.stop()
+        overrun_stats = self.processor.get_overrun_stats()
+        for key in ['blocked_samples', 'dropped_samples', 'spilled_samples']:
+            if overrun_stats[key]:
+                self.logger.warning('Writer queue overrun: %s=%d', key, overrun_stats[key])
+        for stage in self.stages:
+            overrun_stats = stage.get_overrun_stats()
+            for key in ['blocked_samples', 'dropped_samples', 'spilled_samples']:
+                if overrun_stats[key]:
+                    self.logger.warning('Pipeline stage %s queue overrun: %s=%d', stage.name, key, overrun_stats[key])
+        pool_stats = self.buffer_pool.get_stats()
+        if pool_stats['exhausted']:
+            self.logger.warning('Sample buffer pool was exhausted %d times (capacity %d).',
+                                pool_stats['exhausted'], pool_stats['capacity'])
         self.logger.debug('Runner stopped.')
 
     def get_port_file_path(self, port_id):
         return self.processor.get_port_file_path(port_id)
 
+    def close(self):
+        """
+        Release the resources of the runner: the sample processing worker process, if
+        any, and the DAQ task (which is kept for reuse if there is a task cache, and
+        cleared otherwise).
+        """
+        if self.worker_process:
+            self.processor.close()
+        if self.task:
+            if self.task_cache:
+                self.task_cache.release(self.config.device_id, self.task_fingerprint, self.task)
+            else:
+                self.task.ClearTask()
+            self.task = None
+
+    def get_first_read_time(self):
+        """Return the (monotonic) time at which the first samples were read from the DAQ, or None."""
+        return self.task.read_timer.first_read if self.task else None
+
+    def snapshot(self):
+        return self.processor.snapshot()
+
+    def get_trigger_status(self):
+        return self.processor.get_trigger_status()
+
+    def get_pipeline_results(self):
+        """Return the results of each analysis stage of the pipeline so far, mapped onto its name."""
+        return dict((stage.name, stage.get_results()) for stage in self.stages)
+
+    def get_buffer_pool_stats(self):
+        return self.buffer_pool.get_stats()
+
+    def get_overrun_stats(self):
+        return self.processor.get_overrun_stats()
+
+    def get_port_stats(self):
+        return self.processor.get_port_stats()
+
+    def get_metrics(self):
+        """Counters, gauges and timings of the pipeline; see daqpower.metrics."""
+        metrics = self.task.read_timer.get()
+        overrun_stats = self.processor.get_overrun_stats()
+        for key in ['queue_depth', 'max_queue_depth', 'blocked_samples', 'dropped_samples', 'spilled_samples']:
+            metrics[key] = float(overrun_stats[key])
+        metrics['buffer_pool_exhausted'] = float(self.buffer_pool.get_stats()['exhausted'])
+        progress = self.processor.get_progress()
+        samples_written = float(progress['samples_processed'])
+        metrics['samples_pending'] = metrics['samples_read'] - samples_written - metrics['dropped_samples']
+        metrics['bytes_written'] = float(progress['bytes_written'])
+        metrics['bytes_per_second'] = progress['bytes_per_second']
+        port_bytes = progress['port_bytes_written']
+        metrics['ports'] = {}
+        for label in self.config.labels:
+            port = {'samples_read': metrics['samples_read'], 'samples_written': samples_written}
+            if label in port_bytes:
+                port['bytes_written'] = float(port_bytes[label])
+            metrics['ports'][label] = port
+        return metrics
+
 
 if __name__ == '__main__':
     from collections import namedtuple
     DeviceConfig = namedtuple('DeviceConfig', ['device_id', 'channel_map', 'resistor_values',
                                                'v_range', 'dv_range', 'sampling_rate',
-                                               'number_of_ports', 'labels'])
+                                               'number_of_ports', 'labels', 'output_format',
+                                               'downsample', 'downsample_mode', 'expected_duration',
+                                               'ring_duration', 'ring_storage', 'trigger_port', 'trigger_level',
+                                               'trigger_edge', 'trigger_hold', 'pre_trigger', 'post_trigger',
+                                               'pipeline'])
     channel_map = (0, 1, 2, 3, 4, 5, 6, 7, 16, 17, 18, 19, 20, 21, 22, 23)
     resistor_values = [0.005]
     labels = ['PORT_0']
-    dev_config = DeviceConfig('Dev1', channel_map, resistor_values, 2.5, 0.2, 10000, len(resistor_values), labels)
+    dev_config = DeviceConfig('Dev1', channel_map, resistor_values, 2.5, 0.2, 10000, len(resistor_values), labels, 'csv',
+                              1, 'mean', 0, 0, 'memory', '', 0, 'rising', 1, 0, 0, [])
     if not len(sys.argv) == 3:
         print('Usage: {} OUTDIR DURATION'.format(os.path.basename(__file__)))
         sys.exit(1)
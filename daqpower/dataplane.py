@@ -0,0 +1,208 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+HTTP data plane for bulk transfer of port files (Python 3 only).
+
+Port files are served at ``/sessions/<session_id>/ports/<port_id>`` (or at
+``/ports/<port_id>`` for the most recently configured session) with ``GET`` and
+``HEAD``. Single byte ranges (``Range: bytes=start-end``) are
+supported, so interrupted downloads may be resumed. File contents are sent
+with ``loop.sendfile()``, which uses ``os.sendfile`` where the platform
+supports it, so data never passes through Python-level reads.
+
+Runtime metrics of the server are served at ``/metrics``, in the Prometheus
+text format.
+
+"""
+import asyncio
+import logging
+import os
+import re
+import threading
+from email.utils import formatdate
+from urllib.parse import unquote
+
+from daqpower.metrics import PROMETHEUS_CONTENT_TYPE
+
+
+_range_regex = re.compile(r'^bytes=(\d*)-(\d*)$')
+_path_regex = re.compile(r'^(?:/sessions/([^/]+))?/ports/([^/]+)$')
+
+_reasons = {
+    200: 'OK',
+    206: 'Partial Content',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    409: 'Conflict',
+    416: 'Range Not Satisfiable',
+    500: 'Internal Server Error',
+}
+
+
+class DataPlaneError(Exception):
+    """Raised by a resolver to reject a request with the specified HTTP status."""
+
+    def __init__(self, status, message):
+        super(DataPlaneError, self).__init__(message)
+        self.status = status
+
+
+def parse_range(header, size):
+    """
+    Parse the value of a Range header for a file of the specified size. Returns
+    (start, end) with end exclusive, or None if the header is absent. Raises
+    DataPlaneError if the range is malformed or not satisfiable.
+    """
+    if not header:
+        return None
+    match = _range_regex.match(header.strip())
+    if not match or not any(match.groups()):
+        raise DataPlaneError(400, 'Unsupported range: {}'.format(header))
+    first, last = match.groups()
+    if not first:  # suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        raise DataPlaneError(416, 'Range {} not satisfiable for size {}'.format(header, size))
+    return start, end
+
+
+class DataServer(threading.Thread):
+    """
+    Serves port files over HTTP from an asyncio event loop running on its own
+    thread. ``resolver`` is called (on an executor thread, as it may block) with a
+    port ID and session ID (None if not specified) and must return the path of the
+    file to serve, or raise DataPlaneError. Similarly, ``metrics_provider`` is
+    called to get the text served at /metrics.
+
+    """
+
+    def __init__(self, port, resolver=None, host=''):
+        super(DataServer, self).__init__(name='DataServer')
+        self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.resolver = resolver
+        self.metrics_provider = None
+        self.loop = asyncio.new_event_loop()
+        self._server = None
+        self._ready = threading.Event()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self._server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host or '0.0.0.0', self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self._server.close()
+            self.loop.run_until_complete(self._server.wait_closed())
+            self.loop.close()
+
+    def start(self):
+        super(DataServer, self).start()
+        self._ready.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            await self._respond(request_line.decode('latin-1').split(), headers, writer)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            self.logger.debug('Data connection dropped: %s', e)
+        finally:
+            writer.close()
+
+    async def _respond(self, request, headers, writer):
+        if len(request) != 3:
+            return self._send_error(writer, 400, 'Malformed request')
+        method, path, _ = request
+        if method not in ('GET', 'HEAD'):
+            return self._send_error(writer, 405, 'Method {} not allowed'.format(method))
+        if path.split('?')[0] == '/metrics' and self.metrics_provider:
+            return await self._respond_metrics(method, writer)
+        match = _path_regex.match(path)
+        if not match or not self.resolver:
+            return self._send_error(writer, 404, 'Not found: {}'.format(path))
+        session_id, port_id = match.group(1), unquote(match.group(2))
+        try:
+            filename = await self.loop.run_in_executor(None, self.resolver, port_id, session_id)
+            port_file = open(filename, 'rb')
+        except DataPlaneError as e:
+            return self._send_error(writer, e.status, str(e))
+        except (IOError, OSError) as e:
+            return self._send_error(writer, 404, str(e))
+        except Exception as e:  # pylint: disable=broad-except
+            self.logger.exception('Failed to resolve %s', port_id)
+            return self._send_error(writer, 500, str(e))
+        with port_file:
+            size = os.fstat(port_file.fileno()).st_size
+            try:
+                byte_range = parse_range(headers.get('range'), size)
+            except DataPlaneError as e:
+                extra = {'Content-Range': 'bytes */{}'.format(size)} if e.status == 416 else {}
+                return self._send_error(writer, e.status, str(e), extra)
+            extra = {'Accept-Ranges': 'bytes', 'Content-Type': 'text/csv'}
+            if byte_range:
+                start, end = byte_range
+                extra['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, size)
+                self._send_headers(writer, 206, end - start, extra)
+            else:
+                start, end = 0, size
+                self._send_headers(writer, 200, size, extra)
+            await writer.drain()
+            if method == 'GET' and end > start:
+                await self.loop.sendfile(writer.transport, port_file, start, end - start)
+
+    async def _respond_metrics(self, method, writer):
+        try:
+            body = (await self.loop.run_in_executor(None, self.metrics_provider)).encode('utf-8')
+        except Exception as e:  # pylint: disable=broad-except
+            self.logger.exception('Failed to collect metrics')
+            return self._send_error(writer, 500, str(e))
+        self._send_headers(writer, 200, len(body), {'Content-Type': PROMETHEUS_CONTENT_TYPE})
+        if method == 'GET':
+            writer.write(body)
+
+    def _send_error(self, writer, status, message, extra=None):
+        body = (message + '\n').encode('utf-8')
+        extra = dict(extra or {}, **{'Content-Type': 'text/plain; charset=utf-8'})
+        self._send_headers(writer, status, len(body), extra)
+        writer.write(body)
+
+    def _send_headers(self, writer, status, length, extra):  # pylint: disable=no-self-use
+        lines = ['HTTP/1.1 {} {}'.format(status, _reasons[status]),
+                 'Date: {}'.format(formatdate(usegmt=True)),
+                 'Content-Length: {}'.format(length),
+                 'Connection: close']
+        lines.extend('{}: {}'.format(name, value) for name, value in extra.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
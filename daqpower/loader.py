@@ -0,0 +1,119 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Loading port data into NumPy arrays, for DaqClient.get_arrays(). Each port is
+loaded into a single array, with a float64 field for each column (``power``,
+``voltage``, ...), allocated up front once the number of rows is known: in
+memory, or as a ``.npy`` file mapped into memory, so that captures larger than
+memory can be loaded (and reopened later with ``numpy.load(path,
+mmap_mode='r')``). Rows transferred in binary are the same little-endian
+float64 values laid out row by row, so they are copied into the array as they
+are; CSV port files are decoded a block of whole lines at a time.
+
+"""
+import numpy
+
+
+BLOCK_SIZE = 1048576
+
+
+class LoaderError(Exception):
+    pass
+
+
+def get_dtype(columns):
+    """Return the dtype of the rows of a port with the specified columns."""
+    return numpy.dtype([(str(column), '<f8') for column in columns])
+
+
+def allocate(columns, rows, path=None):
+    """
+    Return an array of the specified number of rows with a field for each column,
+    backed by a .npy file at path if specified.
+    """
+    dtype = get_dtype(columns)
+    if path:
+        return numpy.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(rows,))
+    return numpy.empty((rows,), dtype=dtype)
+
+
+def load_rows(read_rows, columns, rows, path=None, block_size=BLOCK_SIZE):
+    """
+    Load the specified number of rows into an array (see allocate()), calling
+    read_rows(first_row, count) for the binary data of consecutive blocks of up to
+    block_size bytes.
+    """
+    array = allocate(columns, rows, path)
+    block_rows = max(block_size // array.dtype.itemsize, 1)
+    for first_row in range(0, rows, block_rows):
+        count = min(block_rows, rows - first_row)
+        block = numpy.frombuffer(read_rows(first_row, count), dtype=array.dtype)
+        if block.shape[0] != count:
+            raise LoaderError('Expected {} rows from row {}, got {}.'.format(count, first_row, block.shape[0]))
+        array[first_row:first_row + count] = block
+    return array
+
+
+def load_csv(csv_path, path=None, block_size=BLOCK_SIZE):
+    """
+    Load the rows of a CSV port file into an array (see allocate()). The file is
+    read twice: once to count the rows, so that the array can be allocated, and
+    once to decode them.
+    """
+    with open(csv_path, 'rb') as fh:
+        columns = fh.readline().decode('utf-8').strip().split(',')
+        data_start = fh.tell()
+        rows = 0
+        last = b'\n'
+        for block in iter(lambda: fh.read(block_size), b''):
+            rows += block.count(b'\n')
+            last = block[-1:]
+        if last != b'\n':
+            rows += 1  # no newline after the last row
+        array = allocate(columns, rows, path)
+        # All fields are float64, so the rows can be filled in as a flat run of values.
+        values = array.view(numpy.float64).reshape(-1) if rows else numpy.empty((0,))
+        fh.seek(data_start)
+        position = 0
+        remainder = b''
+        while True:
+            block = fh.read(block_size)
+            if block:
+                block = remainder + block
+                end = block.rfind(b'\n') + 1
+                block, remainder = block[:end], block[end:]
+            else:
+                block, remainder = remainder, b''
+            if not block:
+                if remainder:
+                    continue  # no complete line in this block yet
+                break
+            try:
+                decoded = numpy.fromstring(block.replace(b'\n', b','), sep=',')  # pylint: disable=no-member
+            except ValueError as e:
+                raise LoaderError('{} has a malformed row: {}'.format(csv_path, e))
+            # The block holds whole rows, so a row with a missing or extra value shows up in the count.
+            lines = block.count(b'\n') + (0 if block.endswith(b'\n') else 1)
+            if decoded.shape[0] != lines * len(columns):
+                raise LoaderError('{} has a malformed row (expected {} columns).'.format(csv_path, len(columns)))
+            if position + decoded.shape[0] > values.shape[0]:
+                raise LoaderError('{} has more values than expected.'.format(csv_path))
+            values[position:position + decoded.shape[0]] = decoded
+            position += decoded.shape[0]
+    if position != values.shape[0]:
+        message = '{} has {} values; expected {} ({} rows of {} columns).'
+        raise LoaderError(message.format(csv_path, position, values.shape[0], rows, len(columns)))
+    return array
@@ -0,0 +1,240 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Runtime metrics of the acquisition pipeline. The pipeline components keep
+counters and timings up to date as they go; ``DaqServer.get_metrics()``
+collects them into a dict (all values are floats, as XML-RPC integers are
+limited to 32 bits), which ``format_prometheus()`` renders in the Prometheus
+text exposition format for scraping from the data endpoint.
+
+"""
+import math
+import os
+import threading
+from collections import deque
+
+from daqpower.timeindex import monotonic
+
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Timing(object):
+    """Count, sum, last and maximum of a duration, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.maximum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.last = value
+            self.maximum = max(self.maximum, value)
+
+    def get(self):
+        with self._lock:
+            return {'count': float(self.count), 'sum': self.total, 'last': self.last, 'max': self.maximum}
+
+
+class ReadTimer(object):
+    """
+    Times the reads of a DAQ task: how long each read of the driver buffer takes,
+    and the interval between the starts of consecutive reads (which should be half
+    a second; longer intervals mean callbacks are being delayed).
+    """
+
+    def __init__(self):
+        self.read_latency = Timing()
+        self.callback_interval = Timing()
+        self.samples_read = 0
+        self.first_read = None  # (monotonic) time at which the first read completed
+        self._last_start = None
+
+    def start(self):
+        """Call before a read; returns the token to pass to stop()."""
+        start_time = monotonic()
+        if self._last_start is not None:
+            self.callback_interval.observe(start_time - self._last_start)
+        self._last_start = start_time
+        return start_time
+
+    def stop(self, start_time, samples_read):
+        end_time = monotonic()
+        self.read_latency.observe(end_time - start_time)
+        if self.first_read is None and samples_read:
+            self.first_read = end_time
+        self.samples_read += samples_read
+
+    def get(self):
+        return {'samples_read': float(self.samples_read),
+                'read_latency': self.read_latency.get(),
+                'callback_interval': self.callback_interval.get()}
+
+
+class RateMeter(object):
+    """Rate of increase of a counter over (roughly) the last ``window`` seconds."""
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self._samples = deque()  # (time, value)
+        self._lock = threading.Lock()
+
+    def update(self, value):
+        now = monotonic()
+        with self._lock:
+            self._samples.append((now, value))
+            while len(self._samples) > 2 and self._samples[1][0] <= now - self.window:
+                self._samples.popleft()
+
+    def rate(self):
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            start_time, start_value = self._samples[0]
+            end_value = self._samples[-1][1]
+        # Measured up to now, rather than the last update, so the rate decays once updates stop.
+        elapsed = monotonic() - start_time
+        return (end_value - start_value) / elapsed if elapsed > 0 else 0.0
+
+
+def get_directory_size(path):
+    """Total size in bytes of the files under path."""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass  # removed in the meantime
+    return total
+
+
+def get_disk_free(path):
+    """Bytes available to the server on the file system containing path."""
+    if hasattr(os, 'statvfs'):
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+    import shutil  # Windows; disk_usage() requires Python 3.3
+    return shutil.disk_usage(path).free
+
+
+# (key in the session metrics, name, type, help)
+_SESSION_METRICS = [
+    ('is_running', 'daq_session_running', 'gauge', 'Whether the session is capturing.'),
+    ('queue_depth', 'daq_writer_queue_depth', 'gauge', 'Chunks of samples waiting to be written out.'),
+    ('max_queue_depth', 'daq_writer_max_queue_depth', 'gauge',
+     'Largest number of chunks that have been waiting to be written out.'),
+    ('blocked_samples', 'daq_writer_blocked_samples_total', 'counter',
+     'Samples whose acquisition was stalled because the writer queue was full.'),
+    ('dropped_samples', 'daq_writer_dropped_samples_total', 'counter',
+     'Samples discarded because the writer queue was full.'),
+    ('spilled_samples', 'daq_writer_spilled_samples_total', 'counter',
+     'Samples spilled to disk because the writer queue was full.'),
+    ('buffer_pool_exhausted', 'daq_buffer_pool_exhausted_total', 'counter',
+     'Times a sample buffer had to be allocated because the pool was empty.'),
+    ('samples_pending', 'daq_samples_pending', 'gauge', 'Samples read from the DAQ but not yet written out.'),
+    ('bytes_written', 'daq_writer_bytes_written_total', 'counter', 'Bytes written to the output files.'),
+    ('bytes_per_second', 'daq_writer_bytes_per_second', 'gauge',
+     'Rate at which output files have been written over the last few seconds.'),
+    ('open_port_files', 'daq_open_port_files', 'gauge', 'Port files opened for transfer and not yet closed.'),
+    ('disk_usage', 'daq_output_directory_bytes', 'gauge', 'Size of the output directory of the session.'),
+    ('configure_time', 'daq_configure_seconds', 'gauge', 'Time taken to configure the session.'),
+    ('first_sample_latency', 'daq_configure_to_first_sample_seconds', 'gauge',
+     'Time from the start of configure() to the first samples read from the DAQ (0 until then).'),
+    ('task_reused', 'daq_task_reused', 'gauge', 'Whether the session reuses a cached DAQ task.'),
+]
+
+_TIMING_METRICS = [
+    ('callback_interval', 'daq_callback_interval_seconds', 'Interval between reads of the DAQ buffer.'),
+    ('read_latency', 'daq_read_latency_seconds', 'Time taken by each read of the DAQ buffer.'),
+]
+
+_PORT_METRICS = [
+    ('samples_read', 'daq_port_samples_read_total', 'counter', 'Samples read from the DAQ.'),
+    ('samples_written', 'daq_port_samples_written_total', 'counter', 'Samples processed and written out.'),
+    ('bytes_written', 'daq_port_bytes_written_total', 'counter', 'Bytes written to the port file.'),
+]
+
+
+def format_prometheus(metrics):
+    """Render the metrics returned by ``DaqServer.get_metrics()`` in the Prometheus text format."""
+    families = []
+
+    def add(name, metric_type, help_text, samples):
+        lines = ['# HELP {} {}'.format(name, help_text), '# TYPE {} {}'.format(name, metric_type)]
+        for sample_name, labels, value in samples:
+            lines.append('{}{} {}'.format(sample_name, _format_labels(labels), _format_value(value)))
+        families.append('\n'.join(lines))
+
+    add('daq_sessions', 'gauge', 'Open capture sessions.', [('daq_sessions', {}, len(metrics['sessions']))])
+    add('daq_disk_free_bytes', 'gauge', 'Space available on the file system holding the output directory.',
+        [('daq_disk_free_bytes', {}, metrics['disk_free'])])
+    add('daq_output_bytes', 'gauge', 'Size of the output directory, including uncollected sessions.',
+        [('daq_output_bytes', {}, metrics['disk_usage'])])
+    add('daq_task_cache_hits_total', 'counter', 'Sessions that reused a cached DAQ task.',
+        [('daq_task_cache_hits_total', {}, metrics['task_cache_hits'])])
+    add('daq_task_cache_misses_total', 'counter', 'Sessions that had to create a DAQ task.',
+        [('daq_task_cache_misses_total', {}, metrics['task_cache_misses'])])
+    add('daq_evicted_directories_total', 'counter', 'Output directories removed to keep within the disk quota.',
+        [('daq_evicted_directories_total', {}, metrics['evicted_directories'])])
+    add('daq_evicted_bytes_total', 'counter', 'Bytes removed to keep the output directory within the disk quota.',
+        [('daq_evicted_bytes_total', {}, metrics['evicted_bytes'])])
+
+    sessions = sorted(metrics['sessions'].items())
+    session_labels = dict((session_id, {'session': session_id, 'device': session['device_id']})
+                          for session_id, session in sessions)
+    for key, name, metric_type, help_text in _SESSION_METRICS:
+        add(name, metric_type, help_text,
+            [(name, session_labels[session_id], session[key]) for session_id, session in sessions])
+    for key, name, help_text in _TIMING_METRICS:
+        samples = []
+        for session_id, session in sessions:
+            timing = session[key]
+            samples.append((name + '_count', session_labels[session_id], timing['count']))
+            samples.append((name + '_sum', session_labels[session_id], timing['sum']))
+        add(name, 'summary', help_text, samples)
+        add(name + '_max', 'gauge', 'Maximum of: ' + help_text,
+            [(name + '_max', session_labels[session_id], session[key]['max']) for session_id, session in sessions])
+    for key, name, metric_type, help_text in _PORT_METRICS:
+        samples = []
+        for session_id, session in sessions:
+            for port_id, port in sorted(session['ports'].items()):
+                if key in port:
+                    samples.append((name, dict(session_labels[session_id], port=port_id), port[key]))
+        add(name, metric_type, help_text, samples)
+    return '\n'.join(families) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in sorted(labels.items()))
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
@@ -0,0 +1,307 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Processing pipeline with several stages fed from the same samples. ``FanOut``
+stands in for the consumer of the DAQ task, passing each chunk of raw samples
+on to every stage: the sample processor, which writes out the port files (and
+streams, downsamples and triggers as configured), and the analysis stages
+declared in the ``pipeline`` setting of the device configuration, which work
+out their results while the capture is running rather than in a second pass
+over the port files afterwards. Stages are not handed copies: they all get a
+read-only view of the buffer the samples were read into, which goes back to
+the buffer pool once the last of them is done with it. Each stage has its own
+queue and thread. Chunks are queued for the stages in turn on the thread of the
+DAQ task, so a stage never blocks when its queue is full: under the 'block'
+overrun policy, it drops its oldest chunk instead (counted in the
+``dropped_samples`` of its results), so that a slow stage does not hold up the
+others or the port files. The sample processor, which comes first, does follow
+the configured policy, so if it blocks, so do the stages after it.
+
+"""
+import os
+import threading
+
+import numpy
+
+from daqpower.daq import RawSampleWriter, Trigger, get_power_and_voltage
+
+
+def _address(buffer):
+    return buffer.__array_interface__['data'][0]
+
+
+class SharedBufferPool(object):
+    """
+    Stands in for the BufferPool of each stage, returning a buffer shared between
+    stages to ``buffer_pool`` once every one of them has released it.
+    """
+
+    def __init__(self, buffer_pool):
+        self.buffer_pool = buffer_pool
+        self.buffer_size = buffer_pool.buffer_size
+        self._shared = {}  # buffer address -> [stages yet to release it, buffer]
+        self._lock = threading.Lock()
+
+    def share(self, buffer, count):
+        """Return a read-only view of buffer, which is to be released count times."""
+        view = buffer.view()
+        view.flags.writeable = False
+        with self._lock:
+            self._shared[_address(buffer)] = [count, buffer]
+        return view
+
+    def acquire(self):
+        return self.buffer_pool.acquire()
+
+    def release(self, buffer):
+        with self._lock:
+            entry = self._shared.get(_address(buffer))
+            if entry:
+                entry[0] -= 1
+                if entry[0]:
+                    return
+                del self._shared[_address(buffer)]
+                buffer = entry[1]
+        self.buffer_pool.release(buffer)
+
+    def get_stats(self):
+        return self.buffer_pool.get_stats()
+
+
+class FanOut(object):
+    """Consumer of a DAQ task passing each chunk of samples on to every one of ``stages``."""
+
+    def __init__(self, buffer_pool, stages):
+        self.buffer_pool = buffer_pool
+        self.stages = list(stages)
+
+    def write(self, sample_tuple):
+        samples = self.buffer_pool.share(sample_tuple[0], len(self.stages))
+        sample_tuple = (samples,) + tuple(sample_tuple[1:])
+        for i, stage in enumerate(self.stages):
+            try:
+                stage.write(sample_tuple)
+            except Exception:
+                # Neither this stage nor the ones after it will release the buffer.
+                for _ in self.stages[i:]:
+                    self.buffer_pool.release(samples)
+                raise
+
+
+class PipelineStage(RawSampleWriter):
+    """
+    Base of the analysis stages: works out the power and voltage of each port for
+    every chunk of raw samples, and passes them on to process(). Results are
+    returned by get_results(), which may be called while the capture is running.
+    """
+
+    def __init__(self, name, resistor_values, labels, sampling_rate, output_directory, buffer_pool=None,
+                 max_queue_size=0, overrun_policy='drop_oldest'):
+        super(PipelineStage, self).__init__(len(resistor_values), buffer_pool, max_queue_size=max_queue_size,
+                                            overrun_policy=overrun_policy,
+                                            spill_path=os.path.join(output_directory, '{}.spill'.format(name)))
+        self.name = name
+        self.labels = list(labels)
+        self.sampling_rate = sampling_rate
+        self.samples_processed = 0
+        self._resistors = numpy.array(resistor_values, dtype=numpy.float64)
+        self._lock = threading.Lock()
+
+    def do_write(self, sample_tuple):
+        samples, number_of_samples, wall_time, _ = sample_tuple
+        try:
+            if number_of_samples:
+                power, voltage = get_power_and_voltage(samples, number_of_samples, self._resistors)
+                # Of the first sample of the chunk, extrapolated from the time it was delivered.
+                start_time = wall_time - float(number_of_samples) / self.sampling_rate
+                with self._lock:
+                    self.process(power, voltage, start_time)
+                    self.samples_processed += number_of_samples
+        finally:
+            self.discard(sample_tuple)
+
+    def stop(self):
+        super(PipelineStage, self).stop()
+        self.wait()
+        with self._lock:
+            self.finish()
+
+    def process(self, power, voltage, start_time):
+        """Process the (samples, ports) power and voltage of a chunk, starting at self.samples_processed."""
+        raise NotImplementedError()
+
+    def finish(self):
+        """Called once the last chunk has been processed."""
+        pass
+
+    def get_results(self):
+        with self._lock:
+            results = self.results()
+        results.update(self.get_overrun_stats())
+        results['type'] = self.stage_type
+        results['samples_processed'] = str(self.samples_processed)
+        return results
+
+    def results(self):
+        raise NotImplementedError()
+
+
+class StatisticsStage(PipelineStage):
+    """
+    Mean, minimum and maximum power of each port over consecutive windows of
+    ``window`` seconds: an overview of the whole capture, at a resolution that
+    does not depend on how (or whether) the port files are downsampled.
+    """
+
+    stage_type = 'statistics'
+
+    def __init__(self, name, resistor_values, labels, sampling_rate, output_directory, window=1.0, **kwargs):
+        super(StatisticsStage, self).__init__(name, resistor_values, labels, sampling_rate, output_directory,
+                                              **kwargs)
+        self.window = window
+        self.window_samples = max(int(round(window * sampling_rate)), 1)
+        self.start_time = None
+        self._mean, self._minimum, self._maximum = [], [], []
+        # Of the samples of the window in progress.
+        self._count = 0
+        self._sum = numpy.zeros(len(self.labels))
+        self._window_min = numpy.full(len(self.labels), numpy.inf)
+        self._window_max = numpy.full(len(self.labels), -numpy.inf)
+
+    def process(self, power, voltage, start_time):
+        if self.start_time is None:
+            self.start_time = start_time
+        position = 0
+        if self._count:
+            # Complete the window in progress.
+            position = min(self.window_samples - self._count, power.shape[0])
+            self._accumulate(power[:position])
+            if self._count == self.window_samples:
+                self._close_window()
+        whole = (power.shape[0] - position) // self.window_samples * self.window_samples
+        if whole:
+            windows = power[position:position + whole].reshape((-1, self.window_samples, power.shape[1]))
+            self._mean.extend(windows.mean(axis=1))
+            self._minimum.extend(windows.min(axis=1))
+            self._maximum.extend(windows.max(axis=1))
+            position += whole
+        if position < power.shape[0]:
+            self._accumulate(power[position:])
+
+    def finish(self):
+        if self._count:
+            self._close_window()  # a shorter, final window
+
+    def results(self):
+        return {
+            'window': self.window,
+            'start_time': self.start_time,
+            'windows': len(self._mean),
+            'mean': self._by_label(self._mean),
+            'min': self._by_label(self._minimum),
+            'max': self._by_label(self._maximum),
+        }
+
+    def _accumulate(self, power):
+        if not power.shape[0]:
+            return
+        self._count += power.shape[0]
+        self._sum += power.sum(axis=0)
+        numpy.minimum(self._window_min, power.min(axis=0), out=self._window_min)
+        numpy.maximum(self._window_max, power.max(axis=0), out=self._window_max)
+
+    def _close_window(self):
+        self._mean.append(self._sum / self._count)
+        self._minimum.append(self._window_min.copy())
+        self._maximum.append(self._window_max.copy())
+        self._count = 0
+        self._sum[:] = 0
+        self._window_min[:] = numpy.inf
+        self._window_max[:] = -numpy.inf
+
+    def _by_label(self, rows):
+        if not rows:
+            return dict((label, []) for label in self.labels)
+        columns = numpy.array(rows)
+        return dict((label, columns[:, i].tolist()) for i, label in enumerate(self.labels))
+
+
+class EventStage(PipelineStage):
+    """
+    Detects every point at which the power of ``port`` crosses ``level`` (see
+    Trigger), recording up to ``max_events`` of them. After each event, the power
+    has to go back across the level before the next one can be detected.
+    """
+
+    stage_type = 'events'
+
+    def __init__(self, name, resistor_values, labels, sampling_rate, output_directory, port=None, level=0.0,
+                 edge='rising', hold=1, max_events=10000, **kwargs):
+        super(EventStage, self).__init__(name, resistor_values, labels, sampling_rate, output_directory, **kwargs)
+        self.port = port
+        self.level = level
+        self.edge = edge
+        self.hold = hold
+        self.max_events = max_events
+        self.events = []
+        self.missed_events = 0
+        self._trigger = Trigger(self.labels.index(port), level, edge, hold)
+
+    def process(self, power, voltage, start_time):
+        position = 0
+        while position < power.shape[0]:
+            index = self._trigger.find(power[position:])
+            if index is None:
+                break
+            sample = self.samples_processed + position + index
+            if len(self.events) < self.max_events:
+                self.events.append({'sample': str(sample),
+                                    'time': start_time + float(position + index) / self.sampling_rate})
+            else:
+                self.missed_events += 1
+            # Re-armed after the sample that fired the event.
+            position += index + self._trigger.hold
+            self._trigger = Trigger(self._trigger.port, self.level, self.edge, self.hold)
+
+    def results(self):
+        return {
+            'port': self.port,
+            'level': self.level,
+            'edge': self.edge,
+            'events': list(self.events),
+            'missed_events': self.missed_events,
+        }
+
+
+STAGES = {
+    'statistics': StatisticsStage,
+    'events': EventStage,
+}
+
+
+def create_stage(stage_type, options, resistor_values, labels, sampling_rate, output_directory, **kwargs):
+    """
+    Create a stage of the specified type, with the options parsed from the
+    pipeline setting (see DeviceConfiguration.get_pipeline_stages()). An
+    overrun_policy of 'block' is replaced with 'drop_oldest', as stages must not
+    block the DAQ task.
+    """
+    options = dict(options)
+    if kwargs.get('overrun_policy') == 'block':
+        kwargs['overrun_policy'] = 'drop_oldest'
+    name = options.pop('name')
+    return STAGES[stage_type](name, resistor_values, labels, sampling_rate, output_directory,
+                              **dict(options, **kwargs))
@@ -0,0 +1,196 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Memory-mapped binary port files, for long captures. Each port is written to
+its own file, preallocated for the expected duration of the capture, through
+an ``mmap``; rather than going through buffered writes, samples are copied
+straight into the mapping at a running offset. The file is grown in large
+extents if the capture runs longer than expected, and truncated to the size of
+the data once it is closed::
+
+    +---------------------------------------------------------------+
+    | MAGIC | rows (uint64) | header length (uint32) | JSON header  |
+    +---------------------------------------------------------------+
+    | row 0: power, voltage, ...                                    |
+    | row 1: ...                                                    |
+    +---------------------------------------------------------------+
+    | (preallocated space, while the file is being written)         |
+    +---------------------------------------------------------------+
+
+All numbers are little-endian; columns are float64 and rows start at an 8-byte
+aligned offset, so the data can be mapped as a (rows, columns) array. The
+columns of each row are listed in the header. The number of rows is updated
+after each block has been written, so the file can be read (up to that many
+rows) while the capture is running.
+
+"""
+import os
+import json
+import mmap
+import struct
+
+import numpy
+
+from daqpower.capture import ChecksumFile, save_checksum, format_csv_rows, DEFAULT_COLUMNS
+
+
+PORT_FILE_SUFFIX = '.daqport'
+
+MAGIC = b'DAQPRT1\0'
+DEFAULT_EXTENT = 64 * 1024 * 1024
+
+_rows = struct.Struct('<Q')
+_header_length = struct.Struct('<I')
+_column_dtype = numpy.dtype('<f8')
+
+
+class PortFileFormatError(Exception):
+    pass
+
+
+class MappedPortWriter(object):
+    """
+    Writes blocks of samples for a single port into a memory-mapped file with room
+    for ``expected_rows`` rows (or ``extent`` bytes, if not specified), growing it
+    by (at least) ``extent`` bytes at a time when it runs out.
+    """
+
+    def __init__(self, path, columns=DEFAULT_COLUMNS, expected_rows=0, metadata=None, extent=DEFAULT_EXTENT):
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+        self._row_size = len(self.columns) * _column_dtype.itemsize
+        self.extent = max(extent // self._row_size, 1) * self._row_size
+        header = json.dumps({'columns': self.columns, 'metadata': metadata or {}}).encode('utf-8')
+        # Pad (JSON allows trailing whitespace) so that the rows are aligned.
+        prefix_size = len(MAGIC) + _rows.size + _header_length.size
+        header += b' ' * (-(prefix_size + len(header)) % _column_dtype.itemsize)
+        self.data_offset = prefix_size + len(header)
+        self.fh = open(path, 'w+b')
+        self.fh.write(MAGIC + _rows.pack(0) + _header_length.pack(len(header)) + header)
+        self.fh.flush()
+        self._map = None
+        self._capacity = 0
+        self._reserve(int(expected_rows) * self._row_size or self.extent)
+
+    @property
+    def size(self):
+        """Size the file will have once closed."""
+        return self.data_offset + self.rows * self._row_size
+
+    @property
+    def closed(self):
+        return self.fh.closed
+
+    def write_block(self, *columns):
+        """Write a block of samples; one 1D array of equal length for each column (e.g. power, voltage)."""
+        count = columns[0].shape[0]
+        if not count:
+            return
+        offset = self.rows * self._row_size
+        if offset + count * self._row_size > self._capacity:
+            self._reserve(max(offset + count * self._row_size - self._capacity, self.extent))
+        block = numpy.frombuffer(self._map, dtype=_column_dtype, count=count * len(self.columns),
+                                 offset=self.data_offset + offset).reshape((count, len(self.columns)))
+        for i, column in enumerate(columns):
+            block[:, i] = column
+        del block  # the mapping cannot be closed while there are views of it
+        self.rows += count
+        # After the rows themselves, so that readers never see rows that are not there yet.
+        _rows.pack_into(self._map, len(MAGIC), self.rows)
+
+    def flush(self):
+        """
+        Nothing to do: written samples are visible to readers of the file as soon as
+        they have been copied into the mapping (and the OS writes them out in the
+        background).
+        """
+        pass
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self._map.close()
+        self._map = None
+        self.fh.truncate(self.size)
+        self.fh.close()
+
+    def _reserve(self, size):
+        """Make room for size more bytes of rows, and remap the file."""
+        if self._map:
+            self._map.close()
+        self._capacity += size
+        file_size = self.data_offset + self._capacity
+        try:
+            # Actually allocates the blocks (in as few extents as the file system can),
+            # rather than leaving a sparse file to be filled in piecemeal.
+            os.posix_fallocate(self.fh.fileno(), 0, file_size)
+        except (AttributeError, OSError):  # not supported by the platform or file system
+            self.fh.truncate(file_size)
+        self._map = mmap.mmap(self.fh.fileno(), file_size)
+
+    def __del__(self):
+        if getattr(self, 'fh', None):
+            self.close()
+
+
+class MappedPortReader(object):
+    """Read access to the rows of a port file, including one that is still being written."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise PortFileFormatError('{} is not a port file.'.format(path))
+            self.number_of_samples, = _rows.unpack(fh.read(_rows.size))
+            length, = _header_length.unpack(fh.read(_header_length.size))
+            header = json.loads(fh.read(length).decode('utf-8'))
+            self.data_offset = fh.tell()
+        self.columns = header['columns']
+        self.metadata = header['metadata']
+
+    def memmap(self):
+        """Return a read-only (samples, columns) array mapped onto the file."""
+        shape = (self.number_of_samples, len(self.columns))
+        if not self.number_of_samples:
+            return numpy.empty(shape, dtype=_column_dtype)
+        return numpy.memmap(self.path, dtype=_column_dtype, mode='r', offset=self.data_offset, shape=shape)
+
+    def read(self, start=0, stop=None):
+        """Return a tuple of arrays, one for each of self.columns, for samples in ``[start, stop)``."""
+        data = self.memmap()[start:stop]
+        return tuple(numpy.array(data[:, i]) for i in range(len(self.columns)))
+
+    def iter_blocks(self, block_size=100000):
+        """Yield the column arrays (see read()) for consecutive blocks of samples."""
+        for start in range(0, self.number_of_samples, block_size):
+            yield self.read(start, start + block_size)
+
+
+def transcode_port_file(path, csv_path):
+    """Write the samples of a memory-mapped port file into a CSV port file."""
+    temp_path = csv_path + '.tmp'
+    reader = MappedPortReader(path)
+    wfh = ChecksumFile(temp_path)
+    try:
+        wfh.write(','.join(reader.columns) + '\n')
+        for columns in reader.iter_blocks():
+            wfh.write(format_csv_rows(*columns))
+    finally:
+        wfh.close()
+    save_checksum(csv_path, wfh.hexdigest())
+    # Only expose the CSV once it is complete.
+    os.rename(temp_path, csv_path)
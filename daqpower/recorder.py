@@ -0,0 +1,194 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Flight recorder for long captures. Rather than writing every sample out to
+port files, the processed rows of each port are kept in a fixed-size circular
+buffer holding the last ``ring_duration`` seconds of the capture (in memory,
+or in a file mapped into memory), along with the times at which the chunks
+still in the buffer were delivered. A snapshot freezes the current window into
+CSV port files and a timestamp index, in the same form as those of a regular
+capture, so memory and disk use stay constant however long the capture runs.
+
+"""
+import os
+import shutil
+import threading
+from collections import deque
+
+import numpy
+
+from daqpower.capture import ChecksumFile, save_checksum, format_csv_rows, CHECKSUM_SUFFIX
+from daqpower.timeindex import TimestampIndexWriter, TIMESTAMPS_FILENAME
+
+
+RING_FILENAME = 'ring.buf'
+SNAPSHOT_DIRNAME = 'snapshot.tmp'
+
+# os.rename() does not replace existing files on Windows; os.replace() requires Python 3.3.
+_replace = getattr(os, 'replace', os.rename)
+
+
+class FlightRecorder(object):
+    """
+    Keeps the last ``capacity`` rows of each port (one value for each of
+    ``columns``), in memory or, if ``path`` is specified, in a file of fixed size
+    mapped into memory.
+    """
+
+    def __init__(self, capacity, number_of_ports, columns, sampling_rate, downsample=1, path=None):
+        self.capacity = int(capacity)
+        self.number_of_ports = number_of_ports
+        self.columns = list(columns)
+        self.sampling_rate = sampling_rate
+        self.downsample = downsample
+        self.path = path
+        self._shape = (self.capacity, number_of_ports, len(self.columns))
+        if path:
+            self._data = numpy.memmap(path, dtype=numpy.float64, mode='w+', shape=self._shape)
+        else:
+            self._data = numpy.zeros(self._shape, dtype=numpy.float64)
+        self.rows = 0  # written since the start of the capture
+        # (samples, rows, wall time, monotonic time) at the end of each chunk still in the buffer.
+        self._chunks = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def first_row(self):
+        """Number (within the capture) of the oldest row still in the buffer."""
+        return max(self.rows - self.capacity, 0)
+
+    def write(self, columns):
+        """Write a list of (rows, ports) arrays, one for each column, overwriting the oldest rows."""
+        count = columns[0].shape[0]
+        skip = max(count - self.capacity, 0)  # rows that would be overwritten by this very block
+        with self._lock:
+            position = (self.rows + skip) % self.capacity
+            written = skip
+            while written < count:
+                size = min(count - written, self.capacity - position)
+                for i, column in enumerate(columns):
+                    self._data[position:position + size, :, i] = column[written:written + size]
+                written += size
+                position = (position + size) % self.capacity
+            self.rows += count
+
+    def mark(self, samples, rows, wall, monotonic):  # pylint: disable=redefined-outer-name
+        """Record the time at which the chunk ending at the specified sample (and row) was delivered."""
+        with self._lock:
+            self._chunks.append((samples, rows, wall, monotonic))
+            first_row = self.first_row
+            while self._chunks and self._chunks[0][1] <= first_row:
+                self._chunks.popleft()
+
+    def get_window(self):
+        """
+        Return ``(first_row, data, chunks)``: the number of the oldest row in the
+        buffer, a copy of the rows, oldest first, as a (rows, ports, columns) array,
+        and the chunk records (see mark()) that end after first_row.
+        """
+        with self._lock:
+            first_row = self.first_row
+            buffer = self._data
+            if buffer is None:
+                # Closed: the rows are read back from the file (only for a moment).
+                buffer = numpy.memmap(self.path, dtype=numpy.float64, mode='r', shape=self._shape)
+            if self.rows <= self.capacity:
+                data = numpy.array(buffer[:self.rows])
+            else:
+                position = self.rows % self.capacity
+                data = numpy.concatenate((buffer[position:], buffer[:position]))
+            chunks = list(self._chunks)
+        return first_row, numpy.asarray(data), chunks
+
+    def snapshot(self, output_directory, labels, get_port_file_path):
+        """
+        Write the rows in the buffer into a CSV port file for each port (at the path
+        returned by get_port_file_path(label)), along with a timestamp index in
+        output_directory, replacing those of any previous snapshot. Samples and rows
+        in the index count from the start of the snapshot. Returns a dict with the
+        number (within the capture) of the first sample of the snapshot under
+        'first_sample' and the number of rows written to each port file under
+        'samples' (as strings, as XML-RPC integers are limited to 32 bits), the
+        'start_time' and 'end_time' (wall clock) it covers, and the 'sample_period'
+        (of a row). When downsampling, each row stands for ``downsample`` samples.
+        """
+        first_row, data, chunks = self.get_window()
+        first_sample = first_row * self.downsample
+        temp_directory = os.path.join(output_directory, SNAPSHOT_DIRNAME)
+        if os.path.isdir(temp_directory):
+            shutil.rmtree(temp_directory)
+        os.makedirs(temp_directory)
+        files = [ChecksumFile(os.path.join(temp_directory, os.path.basename(get_port_file_path(label))))
+                 for label in labels]
+        index = TimestampIndexWriter(os.path.join(temp_directory, TIMESTAMPS_FILENAME),
+                                     self.number_of_ports, self.sampling_rate, self.downsample)
+        try:
+            for wfh in files:
+                wfh.write(','.join(self.columns) + '\n')
+            index.start([wfh.size for wfh in files])
+            start = 0
+            for samples, rows, wall, monotonic in chunks:  # pylint: disable=redefined-outer-name
+                stop = rows - first_row
+                self._write_rows(files, data[start:stop])
+                index.record(samples - first_sample, stop, wall, monotonic, [wfh.size for wfh in files])
+                start = stop
+            if start < data.shape[0]:
+                # Rows written after the last chunk (i.e. a final partial downsampling window).
+                self._write_rows(files, data[start:])
+                if chunks:
+                    index.finish(chunks[-1][0] - first_sample, data.shape[0], [wfh.size for wfh in files])
+        finally:
+            index.close()
+            for wfh in files:
+                wfh.close()
+        for wfh in files:
+            save_checksum(wfh.path, wfh.hexdigest())
+        # Moved into place once complete; transfers of a previous snapshot that are under
+        # way carry on reading the files they opened.
+        for wfh, label in zip(files, labels):
+            path = get_port_file_path(label)
+            _replace(wfh.path + CHECKSUM_SUFFIX, path + CHECKSUM_SUFFIX)
+            _replace(wfh.path, path)
+        _replace(index.path, os.path.join(output_directory, TIMESTAMPS_FILENAME))
+        shutil.rmtree(temp_directory)
+        start_time = end_time = None
+        if chunks:
+            # As extrapolated by the index for the first sample.
+            start_time = chunks[0][2] - float(chunks[0][0] - first_sample) / self.sampling_rate
+            end_time = chunks[-1][2]
+        return {
+            'first_sample': str(first_sample),
+            'samples': str(data.shape[0]),
+            'start_time': start_time,
+            'end_time': end_time,
+            'sample_period': float(self.downsample) / self.sampling_rate,
+        }
+
+    def close(self):
+        """
+        Unmap the file the rows are kept in, if on disk, once no more rows are to be
+        written. Snapshots may still be taken; they read the rows back from the file.
+        """
+        with self._lock:
+            if self.path and self._data is not None:
+                self._data.flush()
+                self._data = None
+
+    def _write_rows(self, files, rows):
+        if not rows.shape[0]:
+            return
+        for j, wfh in enumerate(files):
+            wfh.write(format_csv_rows(*[rows[:, j, i] for i in range(len(self.columns))]))
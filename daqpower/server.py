@@ -24,26 +24,51 @@ import shutil
 import socket
 import threading
 import time
+import traceback
 import uuid
+import zlib
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from functools import wraps
 try:
     from xmlrpc.server import SimpleXMLRPCServer
+    from xmlrpc.client import Binary
+    from socketserver import ThreadingMixIn
 except ImportError:
     # In python2 it was packaged as SimpleXMLRPCServer
     from SimpleXMLRPCServer import SimpleXMLRPCServer
+    from xmlrpclib import Binary
+    from SocketServer import ThreadingMixIn
+try:
+    import lzma
+except ImportError:  # python2
+    lzma = None
+
+import numpy
 
 
 if __name__ == "__main__":  # for debugging
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from daqpower.log import start_logging
-from daqpower.config import DeviceConfiguration
+from daqpower.config import DeviceConfiguration, SESSION_METHODS
+from daqpower.capture import (CaptureReader, CaptureWriter, transcode_to_csv, load_checksum, format_csv_rows,
+                              CAPTURE_FILENAME)
+from daqpower.stream import SampleBroadcaster, StreamServer
+from daqpower.stats import PortStatistics
+from daqpower.metrics import Timing, format_prometheus, get_directory_size, get_disk_free
+from daqpower.portfile import MappedPortReader, MappedPortWriter, transcode_port_file, PORT_FILE_SUFFIX
+from daqpower.timeindex import (TimestampIndex, TimestampIndexWriter, TimestampIndexError, read_csv_rows,
+                                monotonic, TIMESTAMPS_FILENAME)
 try:
-    from daqpower.daq import DaqRunner, list_available_devices, CAN_ENUMERATE_DEVICES
-    __import_error = None
-except (ImportError, NotImplementedError) as e:
-    # May be using debug mode.
-    __import_error = e
-    DaqRunner = None
+    from daqpower.dataplane import DataServer, DataPlaneError
+except (ImportError, SyntaxError):  # python2
+    DataServer = None
+    DataPlaneError = None
+from daqpower.daq import (DaqRunner, TaskCache, SamplePorcessorError, list_available_devices,
+                          CAN_ENUMERATE_DEVICES, OVERRUN_POLICIES, PYDAQMX_IMPORT_ERROR)
+from daqpower.simulation import WAVEFORMS
+if PYDAQMX_IMPORT_ERROR:
+    # May be using debug or simulation mode.
     list_available_devices = lambda: ['Dev1']
     CAN_ENUMERATE_DEVICES = True
 
@@ -52,6 +77,62 @@ class ProtocolError(Exception):
     pass
 
 
+class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """XML-RPC server handling each request in its own thread."""
+    daemon_threads = True
+
+
+def synchronized(method):
+    """Serialize calls to a DaqServer method that accesses session state."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _compress_zlib(data, level):
+    return zlib.compress(data, level)
+
+
+def _compress_lzma(data, level):
+    return lzma.compress(data, preset=level)
+
+
+# Maps encodings supported by read_port_file_binary() onto compressor and
+# (default, maximum) levels.
+TRANSFER_ENCODINGS = {
+    'none': (lambda data, level: data, (0, 0)),
+    'zlib': (_compress_zlib, (6, 9)),
+}
+if lzma:
+    TRANSFER_ENCODINGS['lzma'] = (_compress_lzma, (1, 9))
+
+# How often follow_port_file() checks for newly flushed data while it waits.
+FOLLOW_POLL_PERIOD = 0.1
+
+# How long (in seconds) the list of devices returned by list_devices() is cached.
+DEFAULT_DEVICE_CACHE_TTL = 10.0
+
+# How often (in seconds) the size of the output directory is measured (and checked against its quota).
+DEFAULT_QUOTA_CHECK_PERIOD = 10.0
+# While a capture is running, files are removed (and large files shrunk) DELETE_STEP bytes
+# at a time, pausing for DEFAULT_DELETE_PAUSE seconds after each step.
+DELETE_STEP = 64 * 1024 * 1024
+DEFAULT_DELETE_PAUSE = 0.05
+
+
+def encode_chunk(data, encoding, level=None):
+    """Compress a chunk of a port file for transfer as specified by the client."""
+    if encoding not in TRANSFER_ENCODINGS:
+        raise ValueError('Unsupported transfer encoding: {}'.format(encoding))
+    compress, (default_level, max_level) = TRANSFER_ENCODINGS[encoding]
+    level = default_level if level is None else max(0, min(int(level), max_level))
+    if not data:
+        return Binary(b'')
+    return Binary(compress(data, level))
+
+
 class DummyDaqRunner(object):
     """Dummy stub used when running in debug mode."""
 
@@ -61,19 +142,44 @@ class DummyDaqRunner(object):
     def number_of_ports(self):
         return self.config.number_of_ports
 
-    def __init__(self, config, output_directory):
+    def __init__(self, config, output_directory, max_queue_size=0, overrun_policy='block', broadcaster=None,
+                 simulation=None, worker_process=False, task_cache=None):  # pylint: disable=unused-argument
         self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
         self.logger.info('Creating runner with %s %s', config, output_directory)
         self.config = config
         self.output_directory = output_directory
+        self.max_queue_size = max_queue_size
+        self.overrun_policy = overrun_policy
+        self.broadcaster = broadcaster
+        self.statistics = PortStatistics(config.labels, config.sampling_rate)
         self.is_running = False
+        self.task_reused = False
+        self._first_read_time = None
 
     def start(self):
-        import csv, random
+        import csv
         self.logger.info('runner started')
+        if self._first_read_time is None:
+            self._first_read_time = monotonic()
+        shape = (self.num_rows, self.config.number_of_ports)
+        power, voltage = numpy.random.normal(1.0, 1.0, shape), numpy.random.normal(1.0, 0.1, shape)
+        self.statistics.update(power)
+        if self.broadcaster:
+            self._publish(power, voltage)
+        index = TimestampIndexWriter(os.path.join(self.output_directory, TIMESTAMPS_FILENAME),
+                                     self.config.number_of_ports, self.config.sampling_rate)
+        if self.config.output_format in ('binary', 'mapped'):
+            if self.config.output_format == 'binary':
+                self._write_capture(power, voltage)
+            else:
+                self._write_mapped(power, voltage)
+            index.record(self.num_rows, self.num_rows, time.time(), monotonic(), [])
+            index.close()
+            self.is_running = True
+            return
+        header_offsets, offsets = [], []
         for i in range(self.config.number_of_ports):
-            rows = [['power', 'voltage']] + [[random.gauss(1.0, 1.0), random.gauss(1.0, 0.1)]
-                                             for _ in range(self.num_rows)]
+            rows = list(zip(power[:, i].tolist(), voltage[:, i].tolist()))
             if sys.version_info[0] == 3:
                 wfh = open(self.get_port_file_path(self.config.labels[i]), 'w', newline='')
             else:
@@ -81,60 +187,287 @@ class DummyDaqRunner(object):
 
             try:
                 writer = csv.writer(wfh)
+                writer.writerow(['power', 'voltage'])
+                header_offsets.append(wfh.tell())
                 writer.writerows(rows)
+                offsets.append(wfh.tell())
             finally:
                 wfh.close()
+        index.start(header_offsets)
+        index.record(self.num_rows, self.num_rows, time.time(), monotonic(), offsets)
+        index.close()
 
         self.is_running = True
 
     def stop(self):
         self.is_running = False
+        if self.broadcaster:
+            self.broadcaster.close()
         self.logger.info('runner stopped')
 
+    def close(self):
+        pass
+
+    def get_first_read_time(self):
+        return self._first_read_time
+
+    def get_buffer_pool_stats(self):
+        return {'capacity': 0, 'allocated': 0, 'free': 0, 'exhausted': 0}
+
+    def get_overrun_stats(self):
+        return {'max_queue_size': self.max_queue_size, 'overrun_policy': self.overrun_policy,
+                'queue_depth': 0, 'max_queue_depth': 0,
+                'blocked_samples': 0, 'dropped_samples': 0, 'spilled_samples': 0}
+
+    def get_port_stats(self):
+        return self.statistics.get()
+
+    def get_metrics(self):
+        samples = float(self.statistics.count)
+        metrics = dict((key, float(value)) for key, value in self.get_overrun_stats().items()
+                       if key not in ('max_queue_size', 'overrun_policy'))
+        metrics.update({'samples_read': samples, 'samples_pending': 0.0, 'buffer_pool_exhausted': 0.0,
+                        'bytes_written': 0.0, 'bytes_per_second': 0.0,
+                        'read_latency': Timing().get(), 'callback_interval': Timing().get(),
+                        'ports': dict((label, {'samples_read': samples, 'samples_written': samples})
+                                      for label in self.config.labels)})
+        return metrics
+
     def get_port_file_path(self, port_id):
         if port_id not in self.config.labels:
             raise ValueError('Invalid port id: {}'.format(port_id))
         return os.path.join(self.output_directory, '{}.csv'.format(port_id))
 
+    def get_trigger_status(self):
+        if not self.config.trigger_port:
+            return {'state': 'disabled', 'trigger_sample': None, 'trigger_time': None}
+        return {'state': 'triggered', 'trigger_sample': '0', 'trigger_time': None}
+
+    def get_pipeline_results(self):
+        return dict((options['name'], {'type': stage_type, 'samples_processed': '0'})
+                    for stage_type, options in self.config.get_pipeline_stages())
+
+    def snapshot(self):
+        # The port files written by start() stand in for the snapshot.
+        self.logger.info('snapshot taken')
+        return {'first_sample': '0', 'samples': str(self.num_rows), 'start_time': None, 'end_time': None,
+                'sample_period': 1.0 / self.config.sampling_rate}
+
+    def _write_capture(self, power, voltage):
+        writer = CaptureWriter(os.path.join(self.output_directory, CAPTURE_FILENAME),
+                               self.config.labels, self.config.sampling_rate)
+        writer.write(power, voltage)
+        writer.close()
+
+    def _write_mapped(self, power, voltage):
+        for i, label in enumerate(self.config.labels):
+            writer = MappedPortWriter(os.path.join(self.output_directory, label + PORT_FILE_SUFFIX),
+                                      expected_rows=self.num_rows)
+            writer.write_block(power[:, i], voltage[:, i])
+            writer.close()
+
+    def _publish(self, power, voltage):
+        self.broadcaster.open(self.config.labels, ['power', 'voltage'])
+        self.broadcaster.publish([power, voltage])
+
 
 class CleanupDirectoryThread(threading.Thread):
-    """Cleanup old uncollected data files to recover disk space."""
+    """
+    Cleanup old uncollected data files to recover disk space. Session directories
+    are removed ``cleanup_after_days`` after they were created (checked every
+    ``cleanup_period`` seconds) and, if a ``quota`` (in bytes) is set, the least
+    recently used directories are removed as soon as the output directory grows
+    past it. Directories returned by ``get_active_directories()`` (those of open
+    sessions) are never removed.
+
+    The size of the output directory is measured every ``quota_check_period``
+    seconds, whether or not a quota is set (see get_usage()). Only active
+    directories are measured at each check: nothing writes to the others, so each
+    of them is measured once, when the thread first sees it.
+    While ``is_capturing()`` returns True, files are removed a step at a time,
+    pausing for ``delete_pause`` seconds after each step, so that the removal
+    does not compete for disk I/O with the capture.
+
+    """
     def __init__(self, base_output_directory, cleanup_period=24 * 60 * 60,
-                 cleanup_after_days=5):
+                 cleanup_after_days=5, quota=0, quota_check_period=DEFAULT_QUOTA_CHECK_PERIOD,
+                 delete_pause=DEFAULT_DELETE_PAUSE, get_active_directories=None, is_capturing=None):
         super(CleanupDirectoryThread, self).__init__()
         self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
         self.daemon = True
         self.base_output_directory = base_output_directory
         self.cleanup_period = cleanup_period
         self.cleanup_threshold = timedelta(cleanup_after_days)
+        self.quota = quota
+        self.quota_check_period = quota_check_period
+        self.delete_pause = delete_pause
+        self.get_active_directories = get_active_directories or (lambda: [])
+        self.is_capturing = is_capturing or (lambda: False)
+        self.evicted_directories = 0
+        self.evicted_bytes = 0
+        self._usage = {}  # path -> [size, last used] of each inactive directory
+        self._active = set()
+        self._active_size = 0
+        self._pending = []  # directories to be removed as soon as possible
+        self._over_quota = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
         self._stop_signal = threading.Event()
 
+    def remove(self, path):
+        """Remove the directory at path in the background (e.g. once its session has been closed)."""
+        with self._lock:
+            self._pending.append(path)
+        self._wakeup.set()
+
+    def get_usage(self):
+        """Return the size (in bytes) of the output directory, as of the last check."""
+        with self._lock:
+            return self._active_size + sum(size for size, _ in self._usage.values())
+
     def run(self):
-        while not self._stop_signal.wait(timeout=self.cleanup_period):
-            self.logger.info('Performing cleanup of the output directory...')
-            current_time = datetime.now()
-            base_directory = self.base_output_directory
-            for entry in os.listdir(base_directory):
-                entry_path = os.path.join(base_directory, entry)
-                entry_ctime = datetime.fromtimestamp(os.path.getctime(entry_path))
-                existence_time = current_time - entry_ctime
-                if existence_time > self.cleanup_threshold:
-                    self.logger.debug('Removing {} (existed for {})'.format(entry, existence_time))
-                    shutil.rmtree(entry_path)
-                else:
-                    self.logger.debug('Keeping {} (existed for {})'.format(entry, existence_time))
-            self.logger.debug('Cleanup complete.')
+        next_cleanup = monotonic() + self.cleanup_period
+        try:
+            self._update_usage()
+        except Exception:  # pylint: disable=broad-except
+            self.logger.error('Measuring the output directory failed:\n%s', traceback.format_exc())
+        while True:
+            timeout = min(max(next_cleanup - monotonic(), 0), self.quota_check_period)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if self._stop_signal.is_set():
+                break
+            try:
+                self._remove_pending()
+                if monotonic() >= next_cleanup:
+                    self._remove_expired()
+                    next_cleanup = monotonic() + self.cleanup_period
+                self._update_usage()
+                if self.quota:
+                    self._enforce_quota()
+            except Exception:  # pylint: disable=broad-except
+                self.logger.error('Cleanup of the output directory failed:\n%s', traceback.format_exc())
 
     def stop(self):
         self._stop_signal.set()
+        self._wakeup.set()
         self.join()
 
+    def _remove_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for path in pending:
+            self.logger.debug('Removing %s', path)
+            self._remove_tree(path)
+            with self._lock:
+                self._usage.pop(path, None)
+
+    def _remove_expired(self):
+        self.logger.info('Performing cleanup of the output directory...')
+        current_time = datetime.now()
+        base_directory = self.base_output_directory
+        active = set(self.get_active_directories())
+        for entry in os.listdir(base_directory):
+            entry_path = os.path.join(base_directory, entry)
+            entry_ctime = datetime.fromtimestamp(os.path.getctime(entry_path))
+            existence_time = current_time - entry_ctime
+            if existence_time > self.cleanup_threshold and entry_path not in active:
+                self.logger.debug('Removing {} (existed for {})'.format(entry, existence_time))
+                self._remove_tree(entry_path)
+                with self._lock:
+                    self._usage.pop(entry_path, None)
+            else:
+                self.logger.debug('Keeping {} (existed for {})'.format(entry, existence_time))
+        self.logger.debug('Cleanup complete.')
+
+    def _update_usage(self):
+        # Listed before the active directories are, so that the directory of a session
+        # being configured is either not listed yet, or already active.
+        entries = [os.path.join(self.base_output_directory, entry)
+                   for entry in os.listdir(self.base_output_directory)]
+        active = set(self.get_active_directories())
+        active_size = sum(get_directory_size(path) for path in active)
+        with self._lock:
+            for path in set(self._usage) - set(entries):
+                del self._usage[path]  # removed by something else
+            for path in entries:
+                if path in active or path in self._usage or path in self._pending:
+                    continue
+                if path in self._active:
+                    last_used = time.time()  # its session has just been closed
+                else:
+                    last_used = os.path.getmtime(path)
+                self._usage[path] = [get_directory_size(path), last_used]
+            self._active = active
+            self._active_size = active_size
+
+    def _enforce_quota(self):
+        usage = self.get_usage()
+        if usage > self.quota:
+            with self._lock:
+                least_recently_used = sorted(self._usage, key=lambda path: self._usage[path][1])
+            for path in least_recently_used:
+                if usage <= self.quota or self._stop_signal.is_set():
+                    break
+                size = self._usage[path][0]
+                self.logger.info('Removing %s (%d bytes) to keep the output directory within its quota.',
+                                 path, size)
+                self._remove_tree(path)
+                with self._lock:
+                    del self._usage[path]
+                usage -= size
+                self.evicted_directories += 1
+                self.evicted_bytes += size
+        if usage > self.quota and not self._over_quota:
+            message = 'Output directory uses %d bytes (quota %d) even though only open sessions are left.'
+            self.logger.warning(message, usage, self.quota)
+        self._over_quota = usage > self.quota
+
+    def _remove_tree(self, path):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+                    for filename in filenames:
+                        if self._stop_signal.is_set():
+                            return
+                        self._remove_file(os.path.join(dirpath, filename))
+                    for dirname in dirnames:
+                        dirname = os.path.join(dirpath, dirname)
+                        if os.path.islink(dirname):
+                            os.remove(dirname)
+                        else:
+                            os.rmdir(dirname)
+                os.rmdir(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+        except OSError as e:
+            self.logger.error('Could not remove %s: %s', path, e)
+
+    def _remove_file(self, path):
+        if self.is_capturing() and not os.path.islink(path):
+            # Freeing the blocks of a large file in one go can hold up the writes of a capture.
+            size = os.path.getsize(path)
+            if size > DELETE_STEP:
+                with open(path, 'r+b') as fh:
+                    while size > DELETE_STEP and not self._stop_signal.is_set():
+                        size -= DELETE_STEP
+                        fh.truncate(size)
+                        self._pause()
+        os.remove(path)
+        self._pause()
+
+    def _pause(self):
+        if self.delete_pause and self.is_capturing():
+            self._stop_signal.wait(self.delete_pause)
+
 
 class OpenFileInfo(object):
     """Simple structure to track when each file was opened"""
     def __init__(self, port_file):
         self.port_file = port_file
         self.created = time.time()
+        # Reads of different files may proceed concurrently.
+        self.lock = threading.Lock()
 
 
 class OpenFileTracker(object):
@@ -158,7 +491,7 @@ class OpenFileTracker(object):
         Open file and track when we did it. Return a descriptor to be used
         for reading and closing
         """
-        port_file = open(filename)
+        port_file = open(filename, 'rb')
         file_info = OpenFileInfo(port_file)
         port_descriptor = uuid.uuid4().hex
         with self.lock:
@@ -168,23 +501,38 @@ class OpenFileTracker(object):
 
     def read(self, descriptor, size):
         """Read from a file previously opened by self.open()"""
+        data = self.read_bytes(descriptor, size)
+        if sys.version_info[0] == 3:
+            return data.decode('utf-8')
+        return data
+
+    def read_bytes(self, descriptor, size):
+        """Read raw bytes from a file previously opened by self.open()"""
         try:
             with self.lock:
-                port_file = self.opened_files[descriptor].port_file
-                return port_file.read(size)
+                file_info = self.opened_files[descriptor]
         except KeyError:
             raise ProtocolError('Unknown port descriptor {}'.format(descriptor))
+        with file_info.lock:
+            try:
+                return file_info.port_file.read(size)
+            except ValueError:  # closed underneath us (timed out or session terminated)
+                raise ProtocolError('Port descriptor {} has been closed'.format(descriptor))
+
 
+    def __len__(self):
+        with self.lock:
+            return len(self.opened_files)
 
     def close(self, descriptor):
         """Close a file previously opened by self.open()"""
         try:
             with self.lock:
-                port_file = self.opened_files[descriptor].port_file
-                port_file.close()
-                del self.opened_files[descriptor]
+                file_info = self.opened_files.pop(descriptor)
         except KeyError:
             raise ProtocolError('Unknown port descriptor {}'.format(descriptor))
+        with file_info.lock:
+            file_info.port_file.close()
 
     def terminate(self):
         """Tear down this tracker and close all remaining open files"""
@@ -213,38 +561,47 @@ class OpenFileTracker(object):
                         del self.opened_files[descriptor]
 
 
-class DaqServer(object):
-    """Interface between a DaqRunner and a remote client"""
-    def __init__(self, base_output_directory):
+class DaqSession(object):
+    """
+    A capture session on a single DAQ device, with its own runner, output directory
+    and open file tracker. Calls may arrive concurrently from multiple threads;
+    session state is guarded by self.lock, while transfers of already opened port
+    files proceed in parallel.
+    """
+    def __init__(self, session_id, config, output_directory, max_queue_size=0, overrun_policy='block',
+                 broadcaster=None, simulation=None, worker_process=False, task_cache=None, configure_start=None,
+                 cleanup_thread=None):
         self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
-        self.base_output_directory = os.path.abspath(base_output_directory)
-        if os.path.isdir(self.base_output_directory):
-            self.logger.info('Using output directory: %s', self.base_output_directory)
-        else:
-            self.logger.info('Creating new output directory: %s', self.base_output_directory)
-            os.makedirs(self.base_output_directory)
-        self.cleanup_directory_thread = CleanupDirectoryThread(self.base_output_directory)
-        self.cleanup_directory_thread.start()
-        self.runner = None
-        self.opened_files = None
-        self.output_directory = None
-        self.labels = None
-
-    def configure(self, config_kwargs):
-        """Configure the DAQ"""
-        if self.runner:
-            message = 'Configuring a new session before previous session has been terminated.'
-            self.logger.warning(message)
-            if self.runner.is_running:
-                self.runner.stop()
-        config = DeviceConfiguration(**config_kwargs)
-        config.validate()
-        self.output_directory = self._create_output_directory()
+        # (monotonic) time at which configure() was called, for timing the start of the session
+        self.configure_start = configure_start or monotonic()
+        self.session_id = session_id
+        self.config = config
+        self.output_directory = output_directory
+        # Removes the output directory in the background once the session is closed.
+        self.cleanup_thread = cleanup_thread
         self.labels = config.labels
-        self.logger.info('Writing port files to %s', self.output_directory)
+        self.broadcaster = broadcaster
+        self.lock = threading.RLock()
+        self.logger.info('Writing port files for session %s to %s', session_id, self.output_directory)
         self.opened_files = OpenFileTracker()
-        self.runner = DaqRunner(config, self.output_directory)
+        self._transcode_locks = {}
+        self._snapshot_lock = threading.Lock()
+        self.runner = DaqRunner(config, self.output_directory,
+                                max_queue_size=max_queue_size,
+                                overrun_policy=overrun_policy,
+                                broadcaster=self.broadcaster,
+                                simulation=simulation,
+                                worker_process=worker_process,
+                                task_cache=task_cache)
+        self.configure_time = monotonic() - self.configure_start
+        self.logger.info('Session %s configured in %.3fs%s', session_id, self.configure_time,
+                         ' (reusing DAQ task)' if self.runner.task_reused else '')
 
+    @property
+    def is_closed(self):
+        return self.runner is None
+
+    @synchronized
     def start(self):
         """Start capturing. configure() must have been called before"""
         self.logger.info('Start capturing')
@@ -259,6 +616,7 @@ class DaqServer(object):
         else:
             raise ProtocolError('Start called before a session has been configured.')
 
+    @synchronized
     def stop(self):
         """Stop capturing"""
         self.logger.info('Stop capturing')
@@ -271,12 +629,6 @@ class DaqServer(object):
         else:
             raise ProtocolError('Stop called before a session has been configured.')
 
-    def list_devices(self):  # pylint: disable=no-self-use
-        """List all devices attached to the DAQ if it supports enumeration"""
-        if not CAN_ENUMERATE_DEVICES:
-            raise TypeError('Server does not support DAQ device enumeration')
-        return list_available_devices()
-
     def list_ports(self):
         """
         List all the ports for the configured DAQ. You need to call
@@ -284,14 +636,59 @@ class DaqServer(object):
         """
         return self.labels
 
+    @synchronized
+    def get_buffer_pool_stats(self):
+        """
+        Return usage of the sample buffer pool for the configured session. Non-zero
+        'exhausted' means the writer fell behind and extra buffers had to be allocated.
+        """
+        if not self.runner:
+            raise ProtocolError('Attempting to get buffer pool stats before session has been configured.')
+        return self.runner.get_buffer_pool_stats()
+
+    @synchronized
+    def get_overrun_stats(self):
+        """
+        Return writer queue overrun accounting for the configured session. A capture
+        is clean (no samples lost) if 'dropped_samples' is zero; 'blocked_samples'
+        and 'spilled_samples' indicate that the writer fell behind without losing data.
+        """
+        if not self.runner:
+            raise ProtocolError('Attempting to get overrun stats before session has been configured.')
+        return self.runner.get_overrun_stats()
+
+    @synchronized
+    def get_port_stats(self, port_id=None):
+        """
+        Return running power statistics (sample count, duration, energy, mean, min,
+        max, variance and approximate percentiles) for each port of the configured
+        session, keyed on label, or just for the specified port. These are updated
+        as samples are processed, so may be queried while the capture is running.
+        """
+        if not self.runner:
+            raise ProtocolError('Attempting to get port stats before session has been configured.')
+        stats = self.runner.get_port_stats()
+        if port_id is None:
+            return stats
+        if port_id not in stats:
+            raise ProtocolError('Invalid port ID: {}'.format(port_id))
+        return stats[port_id]
+
+    @synchronized
     def list_port_files(self):
         """List port files after a capturing session."""
         if not self.runner:
             raise ProtocolError('Attempting to list port files before session has been configured.')
         ports_with_files = []
+        captured_ports = []
+        capture_path = self._get_capture_file_path()
+        if os.path.isfile(capture_path):
+            with CaptureReader(capture_path) as reader:
+                captured_ports = reader.labels
         for port_id in self.labels:
             path = self._get_port_file_path(port_id)
-            if os.path.isfile(path):
+            if (os.path.isfile(path) or port_id in captured_ports or
+                    os.path.isfile(self._get_mapped_file_path(port_id))):
                 ports_with_files.append(port_id)
         return ports_with_files
 
@@ -302,41 +699,284 @@ class DaqServer(object):
         be used with read_port_file() and close_port_file()
 
         """
-        filename = self._get_port_file_path(port_id)
+        with self.lock:
+            opened_files = self.opened_files
+            if not opened_files:
+                raise ProtocolError('open_port_file called on an unconfigured session')
+        filename = self._prepare_port_file(port_id)
         try:
-            return self.opened_files.open(filename)
+            return opened_files.open(filename)
         except FileNotFoundError:
             raise ValueError('File for port {} does not exist.'.format(port_id))
-        except AttributeError:
-            if not self.opened_files:
-                raise ProtocolError('open_port_file called on an unconfigured session')
-            raise
 
     def read_port_file(self, port_descriptor, size):
         """
         Read from a port file after it has been opened with open_port_file().
         size is the amount of bytes you want to read
         """
-        if not self.opened_files:
+        opened_files = self.opened_files
+        if not opened_files:
             raise ProtocolError('read_port_file called on an unconfigured session')
-        return self.opened_files.read(port_descriptor, size)
+        return opened_files.read(port_descriptor, size)
+
+    def read_port_file_binary(self, port_descriptor, size, encoding='zlib', level=None):
+        """
+        Like read_port_file(), but returns the next (up to) size bytes of the file
+        as binary data compressed with the specified encoding (one of those returned
+        by get_transfer_encodings()). Each chunk is compressed independently. An
+        empty result indicates the end of the file.
+        """
+        opened_files = self.opened_files
+        if not opened_files:
+            raise ProtocolError('read_port_file_binary called on an unconfigured session')
+        return encode_chunk(opened_files.read_bytes(port_descriptor, size), encoding, level)
+
+    def get_port_file_info(self, port_id):
+        """
+        Return the 'size' of the file for the specified port, and its 'sha256' (computed
+        while it was written; None while it is still being written). The size is returned
+        as a string, as XML-RPC integers are limited to 32 bits.
+        """
+        with self.lock:
+            if not self.runner:
+                raise ProtocolError('get_port_file_info called on an unconfigured session')
+            is_running = self.runner.is_running
+        filename = self._prepare_port_file(port_id)
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            raise ValueError('File for port {} does not exist.'.format(port_id))
+        return {'size': str(size), 'sha256': None if is_running else load_checksum(filename)}
+
+    def read_port_file_at(self, port_id, offset, size, encoding='none', level=None):
+        """
+        Read up to size bytes from the file for the specified port, starting at offset
+        (which may be passed as a string, for offsets beyond 2GB). Unlike
+        read_port_file(), this does not require the file to be opened first, so a
+        transfer can be resumed at any point. The data is returned as binary, compressed
+        as specified (see read_port_file_binary()).
+        """
+        with self.lock:
+            if not self.runner:
+                raise ProtocolError('read_port_file_at called on an unconfigured session')
+        filename = self._prepare_port_file(port_id)
+        try:
+            with open(filename, 'rb') as fh:
+                fh.seek(int(offset))
+                data = fh.read(int(size))
+        except (IOError, OSError):
+            raise ValueError('File for port {} does not exist.'.format(port_id))
+        return encode_chunk(data, encoding, level)
+
+    def follow_port_file(self, port_id, offset, size, timeout=1.0, encoding='none', level=None):
+        """
+        Like read_port_file_at(), but for following the file of a port while the
+        capture is running: if there is no data past offset yet, wait up to timeout
+        seconds for more to be flushed (port files are flushed after every chunk of
+        samples delivered by the driver). Returns a dict with the 'data' (compressed as
+        specified; see read_port_file_binary()), and whether the session has 'ended',
+        i.e. the capture has stopped and the data reaches the end of the file, in which
+        case the 'sha256' of the complete file is returned too. Files of binary and
+        mapped captures are only available once the capture has stopped, so no data is
+        returned for them until then.
+        """
+        offset, size = int(offset), int(size)
+        deadline = time.time() + float(timeout)
+        while True:
+            with self.lock:
+                if not self.runner:
+                    raise ProtocolError('follow_port_file called on an unconfigured session')
+                if port_id not in self.labels:
+                    raise ProtocolError('Invalid port ID: {}'.format(port_id))
+                # stop() holds the lock until the port files have been closed.
+                running = self.runner.is_running
+                filename = self._get_port_file_path(port_id)
+            if not running:
+                filename = self._prepare_port_file(port_id)
+            data = b''
+            try:
+                with open(filename, 'rb') as fh:
+                    fh.seek(offset)
+                    data = fh.read(size)
+            except (IOError, OSError):
+                if not running:
+                    raise ValueError('File for port {} does not exist.'.format(port_id))
+            if data or not running or time.time() >= deadline:
+                break
+            time.sleep(FOLLOW_POLL_PERIOD)
+        ended = not running and len(data) < size
+        return {
+            'data': encode_chunk(data, encoding, level),
+            'ended': ended,
+            'sha256': load_checksum(filename) if ended else None,
+        }
+
+    def read_port_window(self, port_id, start_time, end_time, clock='wall'):
+        """
+        Return the samples of the specified port acquired between start_time
+        (inclusive) and end_time (exclusive), in seconds since the epoch for the
+        'wall' clock, or as given by time.monotonic() on the server for the
+        'monotonic' clock. The result is a dict with the samples as CSV text
+        (including the header) under 'data', the number of the first returned sample
+        within the session (as a string) under 'first_sample', the estimated time of
+        that sample under 'start_time', and the time between samples under
+        'sample_period'. Times are those at which chunks of samples were delivered
+        by the driver, interpolated for individual samples, so are accurate to
+        within the host's scheduling latency. This may be used while the capture is
+        running.
+        """
+        with self.lock:
+            if not self.runner:
+                raise ProtocolError('read_port_window called on an unconfigured session')
+            if port_id not in self.labels:
+                raise ProtocolError('Invalid port ID: {}'.format(port_id))
+            port = self.labels.index(port_id)
+            index_path = os.path.join(self.output_directory, TIMESTAMPS_FILENAME)
+            port_path = self._get_port_file_path(port_id)
+            capture_path = self._get_capture_file_path()
+            mapped_path = self._get_mapped_file_path(port_id)
+        try:
+            index = TimestampIndex(index_path)
+            first_row, stop_row = index.rows_for_window(float(start_time), float(end_time), clock)
+            start_time = index.time_of_row(first_row, clock) if len(index.records) else float(start_time)
+        except (IOError, OSError):
+            raise ProtocolError('No samples have been captured in this session.')
+        except TimestampIndexError as e:
+            raise ProtocolError(str(e))
+        if os.path.isfile(capture_path):
+            with CaptureReader(capture_path) as reader:
+                lines = [','.join(reader.columns)]
+                rows = format_csv_rows(*reader.read(port, first_row, stop_row))
+                lines.extend(rows.splitlines())
+        elif os.path.isfile(mapped_path):
+            reader = MappedPortReader(mapped_path)
+            lines = [','.join(reader.columns)]
+            lines.extend(format_csv_rows(*reader.read(first_row, stop_row)).splitlines())
+        else:
+            with open(port_path) as fh:
+                lines = [fh.readline().rstrip('\r\n')]
+            lines.extend(read_csv_rows(port_path, index, port, first_row, stop_row))
+        return {
+            'first_sample': str(first_row),
+            'start_time': start_time,
+            'sample_period': index.sample_period,
+            'data': '\n'.join(lines) + '\n',
+        }
+
+    def snapshot(self):
+        """
+        Freeze the samples held by the flight recorder (the last ring_duration
+        seconds of the capture) into the port files of the session, replacing those
+        of any previous snapshot, so that they may be downloaded with get_data() and
+        queried with read_port_window(). This may be called while capturing, or after
+        stop(). Returns a dict with the number of the first sample of the snapshot
+        within the session under 'first_sample' and the number of rows in each port
+        file under 'samples' (both as strings; when downsampling, each row stands for
+        ``downsample`` samples), the wall clock 'start_time' and 'end_time' it
+        covers, and the 'sample_period' (of a row).
+        """
+        with self.lock:
+            if not self.runner:
+                raise ProtocolError('snapshot called on an unconfigured session')
+            if not self.config.ring_duration:
+                raise ProtocolError('Session {} was not configured with a ring duration.'.format(self.session_id))
+            runner = self.runner
+        # Outside of self.lock, so that stats and transfers are not held up while the files are written.
+        with self._snapshot_lock:
+            try:
+                return runner.snapshot()
+            except SamplePorcessorError as e:
+                raise ProtocolError('Cannot take a snapshot before start(): {}'.format(e))
+
+    @synchronized
+    def get_trigger_status(self):
+        """
+        Return the 'state' of the trigger of the session: 'disabled' (if it was not
+        configured with a trigger_port), 'armed' (waiting for the trigger to fire;
+        nothing is written out until it does), 'triggered', or 'complete' (once
+        post_trigger seconds have been written out). Once it has fired, the number of
+        the sample at which it did (as a string) is under 'trigger_sample', and its
+        estimated wall clock time under 'trigger_time'.
+        """
+        if not self.runner:
+            raise ProtocolError('get_trigger_status called on an unconfigured session')
+        return self.runner.get_trigger_status()
+
+    @synchronized
+    def get_pipeline_results(self):
+        """
+        Return the results so far of each analysis stage declared in the 'pipeline'
+        setting of the session, mapped onto the name of the stage; see
+        daqpower.pipeline. Those of every stage include its 'type', the number of
+        'samples_processed' (as a string) and its overrun counters; a 'statistics'
+        stage adds the 'mean', 'min' and 'max' power of each port over each 'window'
+        (in seconds) since 'start_time', and an 'events' stage the 'sample' (as a
+        string) and 'time' of each of the 'events' detected on its 'port'.
+        """
+        if not self.runner:
+            raise ProtocolError('get_pipeline_results called on an unconfigured session')
+        return self.runner.get_pipeline_results()
+
+    def get_port_layout(self, port_id):
+        """
+        Return the 'columns' of the samples of the specified port and whether they can
+        be read as 'binary' rows with read_port_rows() (they can if the session was
+        recorded in the binary or mapped output format; otherwise, they are only
+        available as a CSV port file). If they can, the number of 'rows' available
+        is returned too, as a string.
+        """
+        source = self._get_binary_source(port_id)
+        if source is None:
+            with open(self._prepare_port_file(port_id)) as fh:
+                columns = fh.readline().strip().split(',')
+            return {'columns': columns, 'binary': False, 'rows': None}
+        if source == self._get_capture_file_path():
+            with CaptureReader(source) as reader:
+                return {'columns': reader.columns, 'binary': True, 'rows': str(reader.number_of_samples)}
+        reader = MappedPortReader(source)
+        return {'columns': reader.columns, 'binary': True, 'rows': str(reader.number_of_samples)}
+
+    def read_port_rows(self, port_id, first_row, count, encoding='none', level=None):
+        """
+        Return up to count rows of the samples of the specified port, starting at
+        first_row (both may be passed as strings), as binary data: the values of the
+        columns listed by get_port_layout() for each row in turn, as little-endian
+        float64, compressed as specified (see read_port_file_binary()). This is only
+        available for sessions recorded in the binary or mapped output format.
+        """
+        source = self._get_binary_source(port_id)
+        if source is None:
+            raise ProtocolError('Samples of port {} are only available as CSV.'.format(port_id))
+        start = int(first_row)
+        stop = start + int(count)
+        if source == self._get_capture_file_path():
+            with CaptureReader(source) as reader:
+                rows = numpy.stack(reader.read(port_id, start, stop), axis=1)
+        else:
+            rows = MappedPortReader(source).memmap()[start:stop]
+        return encode_chunk(numpy.ascontiguousarray(rows, dtype='<f8').tobytes(), encoding, level)
 
     def close_port_file(self, port_descriptor):
         """
         Close a port file opened by open_port_file(). After calling this, any
         call to read_port_file() for this port_descriptor will fail.
         """
-        if not self.opened_files:
+        opened_files = self.opened_files
+        if not opened_files:
             raise ProtocolError('close_port_file called on an unconfigured session')
-        self.opened_files.close(port_descriptor)
-
-    def _get_port_file_path(self, port_id):
-        if not self.runner:
-            raise ProtocolError('Attepting to get port file path before session has been configured.')
-        return self.runner.get_port_file_path(port_id)
+        opened_files.close(port_descriptor)
 
     def close(self):
-        """Close a session, stopping the DAQ and removing all temporary files"""
+        """Close the session, stopping the DAQ and removing all temporary files"""
+        self.terminate()
+
+    @synchronized
+    def terminate(self, remove_files=True):
+        """
+        Stop the DAQ and release the resources of the session. Unless remove_files is
+        False, its output directory is removed too (otherwise it is left to the
+        cleanup thread).
+        """
         if not self.runner:
             message = 'Attempting to close session before it has been configured.'
             self.logger.warning(message)
@@ -345,13 +985,333 @@ class DaqServer(object):
             message = 'Terminating session before runner has been stopped.'
             self.logger.warning(message)
             self.runner.stop()
+        self.runner.close()
         self.runner = None
+        if self.broadcaster:
+            self.broadcaster.close()
+            self.broadcaster = None
         self.opened_files.terminate()
         self.opened_files = None
-        if self.output_directory and os.path.isdir(self.output_directory):
-            shutil.rmtree(self.output_directory)
+        if remove_files and self.output_directory and os.path.isdir(self.output_directory):
+            if self.cleanup_thread:
+                self.cleanup_thread.remove(self.output_directory)
+            else:
+                shutil.rmtree(self.output_directory)
             self.output_directory = None
-        self.logger.info('Session terminated.')
+        self.logger.info('Session %s terminated.', self.session_id)
+
+    def _get_port_file_path(self, port_id):
+        if not self.runner:
+            raise ProtocolError('Attepting to get port file path before session has been configured.')
+        return self.runner.get_port_file_path(port_id)
+
+    def _get_capture_file_path(self):
+        return os.path.join(self.output_directory, CAPTURE_FILENAME)
+
+    def _get_mapped_file_path(self, port_id):
+        return os.path.join(self.output_directory, port_id + PORT_FILE_SUFFIX)
+
+    def _get_binary_source(self, port_id):
+        """Return the path to the capture container or mapped port file holding the samples of a port, if any."""
+        with self.lock:
+            if not self.runner:
+                raise ProtocolError('Attempting to read samples before session has been configured.')
+            if port_id not in self.labels:
+                raise ProtocolError('Invalid port ID: {}'.format(port_id))
+            for path in (self._get_capture_file_path(), self._get_mapped_file_path(port_id)):
+                if os.path.isfile(path):
+                    return path
+        return None
+
+    def _prepare_port_file(self, port_id):
+        """
+        Return the path to the CSV file for the specified port, transcoding it from
+        the binary capture or mapped port file first, if that is how the session was
+        recorded.
+        """
+        with self.lock:
+            filename = self._get_port_file_path(port_id)
+            capture_path = self._get_capture_file_path()
+            mapped_path = self._get_mapped_file_path(port_id)
+            source = None
+            if not os.path.isfile(filename):
+                if os.path.isfile(capture_path):
+                    source = capture_path
+                elif os.path.isfile(mapped_path):
+                    source = mapped_path
+            if source and self.runner.is_running:
+                raise ProtocolError('Port files for binary captures are available only after stop().')
+            transcode_lock = self._transcode_locks.setdefault(port_id, threading.Lock())
+        if source:
+            # Outside of self.lock, so that ports can be transcoded in parallel.
+            with transcode_lock:
+                if not os.path.isfile(filename):
+                    self.logger.debug('Transcoding %s from %s', filename, source)
+                    if source == capture_path:
+                        transcode_to_csv(capture_path, port_id, filename)
+                    else:
+                        transcode_port_file(mapped_path, filename)
+        return filename
+
+    def get_metrics(self):
+        """Runtime metrics of the session (see DaqServer.get_metrics())."""
+        runner = self.runner  # not synchronized, so as not to wait for transfers or a stop() in progress
+        if not runner:
+            raise ProtocolError('Session {} has been closed.'.format(self.session_id))
+        metrics = runner.get_metrics()
+        metrics['device_id'] = self.config.device_id
+        metrics['is_running'] = float(runner.is_running)
+        metrics['open_port_files'] = float(len(self.opened_files))
+        metrics['disk_usage'] = float(get_directory_size(self.output_directory))
+        metrics['configure_time'] = self.configure_time
+        first_read_time = runner.get_first_read_time()
+        metrics['first_sample_latency'] = first_read_time - self.configure_start if first_read_time else 0.0
+        metrics['task_reused'] = float(runner.task_reused)
+        return metrics
+
+    def _resolve_port_file(self, port_id):
+        """Map a request to the HTTP data endpoint onto a port file."""
+        with self.lock:
+            if not self.runner or port_id not in self.labels:
+                raise DataPlaneError(404, 'No port {} in session {}'.format(port_id, self.session_id))
+        try:
+            return self._prepare_port_file(port_id)
+        except ProtocolError as e:
+            raise DataPlaneError(409, str(e))
+
+    def __del__(self):
+        if getattr(self, 'runner', None):
+            self.runner.stop()
+
+
+class DaqServer(object):
+    """
+    Interface between DAQ sessions and a remote client. Each call to configure()
+    creates a new session (replacing any session on the same device) and returns
+    its ID. Sessions on different devices may capture concurrently.
+
+    Session methods (see SESSION_METHODS) are called over XML-RPC as
+    ``<session_id>.<method>``, e.g. ``'1f0e...c4.start'``; called without a
+    session ID, they apply to the most recently configured session, as they did
+    when the server supported only one session at a time.
+
+    Unless ``cache_tasks`` is False, the DAQ task of a closed session is kept, and
+    reused by the next session configured on the same device with the same
+    channels, ranges and sampling rate, which saves setting it up again. The list of
+    devices returned by list_devices() is cached for ``device_cache_ttl`` seconds.
+
+    The output directories of sessions left uncollected are removed after
+    ``cleanup_after_days`` (checked every ``cleanup_period`` seconds) or, if
+    ``disk_quota`` (in bytes) is set, least recently used first whenever the
+    base output directory grows past it; see CleanupDirectoryThread.
+    """
+    def __init__(self, base_output_directory, max_queue_size=0, overrun_policy='block', stream_server=None,
+                 stream_buffer_frames=64, data_server=None, simulation=None, worker_process=False,
+                 cache_tasks=True, device_cache_ttl=DEFAULT_DEVICE_CACHE_TTL, cleanup_period=24 * 60 * 60,
+                 cleanup_after_days=5, disk_quota=0):
+        self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
+        self.base_output_directory = os.path.abspath(base_output_directory)
+        if os.path.isdir(self.base_output_directory):
+            self.logger.info('Using output directory: %s', self.base_output_directory)
+        else:
+            self.logger.info('Creating new output directory: %s', self.base_output_directory)
+            os.makedirs(self.base_output_directory)
+        self.max_queue_size = max_queue_size
+        self.overrun_policy = overrun_policy
+        self.stream_server = stream_server
+        self.stream_buffer_frames = stream_buffer_frames
+        if self.stream_server:
+            self.stream_server.resolver = self._resolve_broadcaster
+        self.data_server = data_server
+        if self.data_server:
+            self.data_server.resolver = self._resolve_port_file
+            self.data_server.metrics_provider = self._get_prometheus_metrics
+        self.simulation = simulation
+        self.worker_process = worker_process
+        self.task_cache = TaskCache() if cache_tasks else None
+        self.device_cache_ttl = device_cache_ttl
+        self._devices = None
+        self._devices_time = None
+        self._devices_lock = threading.Lock()
+        self.lock = threading.RLock()
+        self.sessions = OrderedDict()
+        self.cleanup_directory_thread = CleanupDirectoryThread(self.base_output_directory, cleanup_period,
+                                                               cleanup_after_days, disk_quota,
+                                                               get_active_directories=self._get_active_directories,
+                                                               is_capturing=self._is_capturing)
+        self.cleanup_directory_thread.start()
+
+    @synchronized
+    def configure(self, config_kwargs):
+        """Configure the DAQ, returning the ID of the new session."""
+        configure_start = monotonic()
+        config = DeviceConfiguration(**config_kwargs)
+        config.validate()
+        for session in self._get_open_sessions():
+            if session.config.device_id == config.device_id:
+                message = 'Configuring a new session on {} before previous session {} has been terminated.'
+                self.logger.warning(message.format(config.device_id, session.session_id))
+                session.terminate(remove_files=False)
+        broadcaster = SampleBroadcaster(self.stream_buffer_frames) if self.stream_server else None
+        session_id = uuid.uuid4().hex
+        self.sessions[session_id] = DaqSession(session_id, config, self._create_output_directory(),
+                                               self.max_queue_size, self.overrun_policy, broadcaster,
+                                               self.simulation, self.worker_process, self.task_cache,
+                                               configure_start, self.cleanup_directory_thread)
+        return session_id
+
+    @synchronized
+    def list_sessions(self):
+        """List the open sessions, most recently configured last."""
+        return [{'session_id': session.session_id,
+                 'device_id': session.config.device_id,
+                 'labels': session.labels,
+                 'is_running': bool(session.runner and session.runner.is_running)}
+                for session in self._get_open_sessions()]
+
+    def list_devices(self):
+        """List all devices attached to the DAQ if it supports enumeration"""
+        if not CAN_ENUMERATE_DEVICES:
+            raise TypeError('Server does not support DAQ device enumeration')
+        with self._devices_lock:
+            now = monotonic()
+            if self._devices is None or now - self._devices_time >= self.device_cache_ttl:
+                self._devices = list_available_devices()
+                self._devices_time = now
+            return list(self._devices)
+
+    def get_stream_port(self):
+        """
+        Return the TCP port on which processed samples of the sessions are streamed
+        to subscribers while capturing, or None if streaming is disabled.
+        """
+        if not self.stream_server:
+            return None
+        return self.stream_server.port
+
+    def get_data_port(self):
+        """
+        Return the TCP port of the HTTP data endpoint, from which port files can be
+        downloaded at /sessions/<session_id>/ports/<port_id> (or /ports/<port_id>
+        for the most recently configured session), with support for Range
+        requests, or None if it is not enabled.
+        """
+        if not self.data_server:
+            return None
+        return self.data_server.port
+
+    def get_metrics(self):
+        """
+        Return runtime metrics of the acquisition pipeline of each open session, keyed
+        on session ID: writer queue depth and overrun counters, the interval between
+        reads of the DAQ buffer and how long they take (count, sum, last and max, in
+        seconds), samples read from the DAQ and written out for each port, samples
+        pending, bytes written (and the current rate), port files open for transfer,
+        output directory size, the time taken by configure() and from its start to the
+        first samples read from the DAQ, and whether the DAQ task was reused; plus the
+        size of the base output directory (as of the last time the cleanup thread
+        measured it), the disk space left, the number of sessions
+        that did and did not reuse a cached DAQ task, and the number of output
+        directories (and bytes) removed to keep within the disk quota. All values are
+        floats. The same metrics are served in the Prometheus text format at /metrics
+        on the HTTP data endpoint.
+        """
+        with self.lock:
+            sessions = self._get_open_sessions()
+        session_metrics = {}
+        for session in sessions:
+            try:
+                session_metrics[session.session_id] = session.get_metrics()
+            except ProtocolError:
+                pass  # closed in the meantime
+        task_cache_stats = self.task_cache.get_stats() if self.task_cache else {'hits': 0, 'misses': 0}
+        return {'sessions': session_metrics,
+                'disk_usage': float(self.cleanup_directory_thread.get_usage()),
+                'disk_free': float(get_disk_free(self.base_output_directory)),
+                'task_cache_hits': float(task_cache_stats['hits']),
+                'task_cache_misses': float(task_cache_stats['misses']),
+                'evicted_directories': float(self.cleanup_directory_thread.evicted_directories),
+                'evicted_bytes': float(self.cleanup_directory_thread.evicted_bytes)}
+
+    def get_transfer_encodings(self):  # pylint: disable=no-self-use
+        """
+        Return the encodings supported by read_port_file_binary(), mapped onto their
+        (default, maximum) compression levels.
+        """
+        return dict((name, list(levels)) for name, (_, levels) in TRANSFER_ENCODINGS.items())
+
+    def close(self):
+        """Close the most recently configured session."""
+        try:
+            session = self._get_session()
+        except ProtocolError:
+            self.logger.warning('Attempting to close session before it has been configured.')
+            return
+        session.close()
+
+    def _dispatch(self, method, params):
+        session_id, _, name = method.rpartition('.')
+        if session_id:
+            if name not in SESSION_METHODS:
+                raise Exception('method "{}" is not supported'.format(method))
+            func = getattr(self._get_session(session_id), name)
+        else:
+            if name.startswith('_'):
+                raise Exception('method "{}" is not supported'.format(method))
+            func = getattr(self, name, None)
+            if not callable(func):
+                raise Exception('method "{}" is not supported'.format(method))
+        return func(*params)
+
+    def __getattr__(self, name):
+        if name not in SESSION_METHODS:
+            raise AttributeError(name)
+        return getattr(self._get_session(), name)
+
+    @synchronized
+    def _get_session(self, session_id=None):
+        sessions = self._get_open_sessions()
+        if session_id:
+            for session in sessions:
+                if session.session_id == session_id:
+                    return session
+            raise ProtocolError('Unknown session: {}'.format(session_id))
+        if not sessions:
+            raise ProtocolError('No session has been configured.')
+        return sessions[-1]
+
+    @synchronized
+    def _get_open_sessions(self):
+        for session_id, session in list(self.sessions.items()):
+            if session.is_closed:
+                del self.sessions[session_id]
+        return list(self.sessions.values())
+
+    @synchronized
+    def _get_active_directories(self):
+        return [session.output_directory for session in self._get_open_sessions() if session.output_directory]
+
+    @synchronized
+    def _is_capturing(self):
+        return any(session.runner and session.runner.is_running for session in self._get_open_sessions())
+
+    def _resolve_broadcaster(self, session_id=None):
+        """Map a stream subscription onto the broadcaster of a session."""
+        try:
+            return self._get_session(session_id).broadcaster
+        except ProtocolError:
+            return None
+
+    def _resolve_port_file(self, port_id, session_id=None):
+        """Map a request to the HTTP data endpoint onto a port file."""
+        try:
+            session = self._get_session(session_id)
+        except ProtocolError as e:
+            raise DataPlaneError(404, str(e))
+        return session._resolve_port_file(port_id)  # pylint: disable=protected-access
+
+    def _get_prometheus_metrics(self):
+        return format_prometheus(self.get_metrics())
 
     def _create_output_directory(self):
         basename = datetime.now().strftime('%Y-%m-%d_%H%M%S%f')
@@ -359,9 +1319,18 @@ class DaqServer(object):
         os.makedirs(dirname)
         return dirname
 
+    def _shutdown(self):
+        """Close all sessions and clear the cached DAQ tasks, e.g. when the server exits."""
+        for session in self._get_open_sessions():
+            session.terminate(remove_files=False)
+        if self.task_cache:
+            self.task_cache.clear()
+        self.cleanup_directory_thread.stop()
+
     def __del__(self):
-        if self.runner:
-            self.runner.stop()
+        for session in self.__dict__.get('sessions', {}).values():
+            if session.runner:
+                session.runner.stop()
 
     def __str__(self):
         return '({})'.format(self.base_output_directory)
@@ -375,6 +1344,11 @@ def run_server():
                         default='daq_server_tmpfiles')
     parser.add_argument('-p', '--port', help='port the server will listen on.',
                         metavar='PORT', default=45677, type=int)
+    parser.add_argument('--host', default='', metavar='HOST',
+                        help="""
+                        Address of the interface the server (and its stream and data ports) listens
+                        on. By default, all interfaces.
+                        """)
     parser.add_argument('-c', '--cleanup-after', type=int, default=5, metavar='DAYS',
                         help="""
                         Sever will perodically clean up data files that are older than the number of
@@ -382,18 +1356,73 @@ def run_server():
                         """)
     parser.add_argument('--cleanup-period', type=int, default=1, metavar='DAYS',
                         help='Specifies how ofte the server will attempt to clean up old files.')
-    parser.add_argument('--debug', help='Run in debug mode (no DAQ connected).',
-                        action='store_true', default=False)
+    parser.add_argument('--disk-quota', type=float, default=0, metavar='GB',
+                        help="""
+                        Maximum size of the working directory. Once it grows past this, the data
+                        files of the least recently used closed sessions are removed (those of open
+                        sessions never are). 0 means no quota.
+                        """)
+    parser.add_argument('--max-queue-size', type=int, default=0, metavar='CHUNKS',
+                        help="""
+                        Maximum number of sample chunks (about half a second of samples each)
+                        waiting to be written out. 0 means unbounded.
+                        """)
+    parser.add_argument('--overrun-policy', choices=OVERRUN_POLICIES, default='block',
+                        help='What to do with new samples when the writer queue is full (by default, block).')
+    parser.add_argument('--worker-process', action='store_true', default=False,
+                        help="""
+                        Process samples in a separate worker process (one for each capture session),
+                        so that processing does not hold up reading samples from the DAQ.
+                        """)
+    parser.add_argument('--no-task-cache', action='store_true', default=False,
+                        help="""
+                        Do not keep the DAQ task of a closed session for reuse by the next
+                        session with the same device, channels, ranges and sampling rate.
+                        """)
+    parser.add_argument('--device-cache-ttl', type=float, default=DEFAULT_DEVICE_CACHE_TTL, metavar='SECONDS',
+                        help='How long the list of devices returned by list_devices is cached (0 disables it).')
+    parser.add_argument('--stream-port', type=int, default=0, metavar='PORT',
+                        help="""
+                        Port on which samples are streamed live to subscribers (without any
+                        authentication). By default (0), streaming is disabled.
+                        """)
+    parser.add_argument('--stream-buffer', type=int, default=64, metavar='FRAMES',
+                        help='Number of sample blocks buffered for each stream subscriber.')
+    parser.add_argument('--data-port', type=int, default=0, metavar='PORT',
+                        help="""
+                        Port of the HTTP endpoint serving port files and /metrics (without any
+                        authentication). By default (0), it is disabled.
+                        """)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--debug', help='Run in debug mode (no DAQ connected).',
+                      action='store_true', default=False)
+    mode.add_argument('--simulate', choices=WAVEFORMS, metavar='WAVEFORM',
+                      help="""
+                      Run the full capture pipeline on simulated samples following the
+                      specified waveform (one of {}) instead of a DAQ.
+                      """.format(', '.join(WAVEFORMS)))
+    mode.add_argument('--replay', metavar='PATH',
+                      help="""
+                      Run the full capture pipeline on samples replayed from a previous capture
+                      (a capture.daqbin file, or a directory of port files) instead of a DAQ.
+                      """)
+    parser.add_argument('--simulation-speed', type=float, default=1.0, metavar='FACTOR',
+                        help="""
+                        Rate at which simulated samples are delivered, relative to real time.
+                        0 delivers them as fast as they can be processed.
+                        """)
     parser.add_argument('--verbose', help='Produce verobose output.', action='store_true',
                         default=False)
     args = parser.parse_args()
 
+    simulation = None
     if args.debug:
         global DaqRunner  # pylint: disable=W0603
         DaqRunner = DummyDaqRunner
-    else:
-        if not DaqRunner:
-            raise __import_error  # pylint: disable=raising-bad-type
+    elif args.simulate or args.replay:
+        simulation = {'waveform': args.simulate or 'sine', 'replay': args.replay, 'speed': args.simulation_speed}
+    elif PYDAQMX_IMPORT_ERROR:
+        raise PYDAQMX_IMPORT_ERROR  # pylint: disable=raising-bad-type
     if args.verbose or args.debug:
         start_logging('DEBUG',
                       '%(asctime)s %(name)-30s %(levelname)-7s: %(message)s')
@@ -403,19 +1432,41 @@ def run_server():
     # days to seconds
     cleanup_period = args.cleanup_period * 24 * 60 * 60
 
-    daq_server = DaqServer(args.directory)
+    stream_server = None
+    if args.stream_port:
+        stream_server = StreamServer(args.stream_port, args.host)
+        stream_server.start()
+
+    data_server = None
+    if args.data_port and DataServer:
+        data_server = DataServer(args.data_port, host=args.host)
+        data_server.start()
+
+    daq_server = DaqServer(args.directory, args.max_queue_size, args.overrun_policy,
+                           stream_server, args.stream_buffer, data_server, simulation, args.worker_process,
+                           not args.no_task_cache, args.device_cache_ttl, cleanup_period, args.cleanup_after,
+                           int(args.disk_quota * 1024 ** 3))
     logger = logging.getLogger(__name__)
 
-    server = SimpleXMLRPCServer(('', args.port), allow_none=True)
+    server = ThreadedXMLRPCServer((args.host, args.port), allow_none=True)
     server.register_instance(daq_server)
 
-    try:
-        hostname = socket.gethostbyname(socket.gethostname())
-    except socket.gaierror:
-        hostname = 'localhost'
+    hostname = args.host
+    if not hostname:
+        try:
+            hostname = socket.gethostbyname(socket.gethostname())
+        except socket.gaierror:
+            hostname = 'localhost'
     logger.info('Listening on %s:%d', hostname, args.port)
+    if stream_server:
+        logger.info('Streaming samples on %s:%d', hostname, stream_server.port)
+    if data_server:
+        logger.info('Serving port files over HTTP on %s:%d', hostname, data_server.port)
 
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    finally:
+        daq_server._shutdown()  # pylint: disable=protected-access
 
 if __name__ == "__main__":
     run_server()
@@ -0,0 +1,245 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Simulated DAQ backend. ``SimulatedTask`` stands in for the PyDAQmx based
+``ReadSamplesCallbackTask``/``ReadSamplesThreadedTask``, delivering buffers of
+interleaved voltage and voltage drop readings (grouped by scan, as the driver
+does) to the sample processor, so that the whole capture pipeline can be
+exercised without a DAQ (or the NI-DAQmx driver). Samples are either generated
+from synthetic waveforms or replayed from a previous capture, and delivered in
+real time, or at any multiple of it.
+
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy
+
+from daqpower.capture import CaptureReader, CAPTURE_FILENAME
+from daqpower.metrics import ReadTimer
+from daqpower.portfile import MappedPortReader, PORT_FILE_SUFFIX
+from daqpower.timeindex import monotonic
+
+
+WAVEFORMS = ['sine', 'square', 'sawtooth', 'constant']
+
+
+class SimulationError(Exception):
+    pass
+
+
+class SyntheticSource(object):
+    """
+    Generates readings for a rail at ``voltage`` Volts drawing up to ``current``
+    Amps, varying with the specified waveform at ``frequency`` Hz (with the phase
+    shifted for each port), plus Gaussian noise relative to ``noise``.
+    """
+
+    def __init__(self, config, waveform='sine', voltage=5.0, current=0.5, frequency=1.0, noise=0.01, seed=None):
+        if waveform not in WAVEFORMS:
+            raise SimulationError('Invalid waveform: {} (must be one of {})'.format(waveform, WAVEFORMS))
+        self.sampling_rate = config.sampling_rate
+        self.number_of_ports = config.number_of_ports
+        self.resistors = numpy.array(config.resistor_values, dtype=numpy.float64)
+        self.waveform = waveform
+        self.voltage = voltage
+        self.current = current
+        self.frequency = frequency
+        self.noise = noise
+        self._phases = numpy.arange(self.number_of_ports, dtype=numpy.float64) / self.number_of_ports
+        self._random = numpy.random.RandomState(seed)
+
+    def fill(self, scans, first_sample):
+        """Fill a (samples, ports, 2) array with readings, starting at the specified sample."""
+        number_of_samples = scans.shape[0]
+        t = (first_sample + numpy.arange(number_of_samples)) / float(self.sampling_rate)
+        cycles = numpy.add.outer(t * self.frequency, self._phases)
+        if self.waveform == 'sine':
+            level = 0.5 + 0.5 * numpy.sin(2 * numpy.pi * cycles)
+        elif self.waveform == 'square':
+            level = (cycles % 1.0 < 0.5).astype(numpy.float64)
+        elif self.waveform == 'sawtooth':
+            level = cycles % 1.0
+        else:
+            level = numpy.ones_like(cycles)
+        current = self.current * (0.2 + 0.8 * level)
+        if self.noise:
+            current *= 1 + self._random.normal(0, self.noise, current.shape)
+            scans[:, :, 0] = self.voltage * (1 + self._random.normal(0, self.noise, current.shape))
+        else:
+            scans[:, :, 0] = self.voltage
+        scans[:, :, 1] = current * self.resistors
+        return number_of_samples
+
+
+class ReplaySource(object):
+    """
+    Replays the power and voltage recorded in a previous capture: either a binary
+    capture container, or a session directory (containing a capture container, or
+    one mapped or CSV file per port). Recorded ports are matched to the configured ports by
+    label, or else by position. Unless ``loop`` is False, the capture is repeated
+    once its end has been reached.
+    """
+
+    def __init__(self, config, path, loop=True):
+        self.number_of_ports = config.number_of_ports
+        self.resistors = numpy.array(config.resistor_values, dtype=numpy.float64)
+        self.loop = loop
+        self._reader = None
+        self._columns = None
+        if os.path.isdir(path) and os.path.isfile(os.path.join(path, CAPTURE_FILENAME)):
+            path = os.path.join(path, CAPTURE_FILENAME)
+        if os.path.isdir(path):
+            self._columns = self._load_port_files(path, config.labels)
+            self.number_of_samples = self._columns.shape[1]
+        else:
+            self._reader = CaptureReader(path)
+            self._ports = self._match_ports(self._reader.labels, config.labels)
+            self.number_of_samples = self._reader.number_of_samples
+        if not self.number_of_samples:
+            raise SimulationError('No samples to replay in {}'.format(path))
+
+    def fill(self, scans, first_sample):
+        """Fill a (samples, ports, 2) array with readings, starting at the specified sample."""
+        if first_sample >= self.number_of_samples and not self.loop:
+            return 0
+        start = first_sample % self.number_of_samples
+        count = min(scans.shape[0], self.number_of_samples - start)
+        power, voltage = self._read(start, start + count)
+        scans[:count, :, 0] = voltage
+        # Invert power = voltage * drop / resistor to recover the drop across the resistor.
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            drop = numpy.where(voltage != 0, power * self.resistors / voltage, 0.0)
+        scans[:count, :, 1] = drop
+        if count < scans.shape[0] and self.loop:
+            # Wrap around to the start of the capture.
+            count += self.fill(scans[count:], first_sample + count)
+        return count
+
+    def close(self):
+        if self._reader:
+            self._reader.close()
+
+    def _read(self, start, stop):
+        if self._columns is not None:
+            return self._columns[0, start:stop], self._columns[1, start:stop]
+        power = numpy.empty((stop - start, self.number_of_ports))
+        voltage = numpy.empty((stop - start, self.number_of_ports))
+        for i, port in enumerate(self._ports):
+            columns = self._reader.read(port, start, stop)
+            power[:, i], voltage[:, i] = columns[0], columns[1]
+        return power, voltage
+
+    def _match_ports(self, recorded_labels, labels):
+        if all(label in recorded_labels for label in labels):
+            return [recorded_labels.index(label) for label in labels]
+        if len(recorded_labels) < len(labels):
+            message = 'Capture has {} ports, but {} are configured.'
+            raise SimulationError(message.format(len(recorded_labels), len(labels)))
+        return list(range(len(labels)))
+
+    def _load_port_files(self, directory, labels):
+        mapped_files = sorted(f for f in os.listdir(directory) if f.endswith(PORT_FILE_SUFFIX))
+        if mapped_files:
+            recorded_labels = [f[:-len(PORT_FILE_SUFFIX)] for f in mapped_files]
+            ports = self._match_ports(recorded_labels, labels)
+            data = [numpy.stack(MappedPortReader(os.path.join(directory, mapped_files[p])).read()[:2], axis=1)
+                    for p in ports]
+        else:
+            # Port files as written by the server (<label>.csv), or as downloaded by DaqClient.get_data() (<label>).
+            port_files = sorted(f for f in os.listdir(directory)
+                                if f.endswith('.csv') or (not os.path.splitext(f)[1] and
+                                                          os.path.isfile(os.path.join(directory, f))))
+            recorded_labels = [os.path.splitext(f)[0] for f in port_files]
+            ports = self._match_ports(recorded_labels, labels)
+            data = [numpy.loadtxt(os.path.join(directory, port_files[p]), delimiter=',', skiprows=1,
+                                  usecols=(0, 1), ndmin=2) for p in ports]
+        length = min(d.shape[0] for d in data)
+        # (column, sample, port)
+        return numpy.stack([d[:length] for d in data], axis=-1).transpose(1, 0, 2).copy()
+
+
+class SimulatedTask(object):
+    """
+    Delivers simulated readings to the consumer every half a second's worth of
+    samples (as ReadSamplesCallbackTask does), from a synthetic ``waveform`` or,
+    if ``replay`` is specified, from the capture at that path. ``speed`` scales the
+    rate at which samples are delivered relative to real time; 0 delivers them
+    as fast as the consumer accepts them.
+    """
+
+    def __init__(self, config, consumer, buffer_pool, waveform='sine', replay=None, speed=1.0):
+        self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
+        self.config = config
+        self.consumer = consumer
+        self.buffer_pool = buffer_pool
+        self.speed = speed
+        self.chunk_size = max(self.config.sampling_rate // 2, 1)
+        if replay:
+            self.source = ReplaySource(config, replay)
+        else:
+            self.source = SyntheticSource(config, waveform)
+        self.samples_delivered = 0
+        self.read_timer = ReadTimer()
+        self._thread = None
+        self._stop_signal = threading.Event()
+
+    def StartTask(self):  # pylint: disable=invalid-name
+        self._stop_signal.clear()
+        self.samples_delivered = 0
+        self._thread = threading.Thread(target=self._run, name='SimulatedTask')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def StopTask(self):  # pylint: disable=invalid-name
+        self._stop_signal.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def ClearTask(self):  # pylint: disable=invalid-name
+        self.StopTask()
+        if isinstance(self.source, ReplaySource):
+            self.source.close()
+
+    def attach(self, consumer, buffer_pool):
+        """Deliver samples to another consumer, e.g. when the task is reused by a new runner."""
+        self.consumer = consumer
+        self.buffer_pool = buffer_pool
+        self.read_timer = ReadTimer()
+
+    def _run(self):
+        start_time = monotonic()
+        number_of_ports = self.config.number_of_ports
+        while not self._stop_signal.is_set():
+            if self.speed:
+                # Deliver each chunk once the last of its samples would have been acquired.
+                due = start_time + (self.samples_delivered + self.chunk_size) / (self.config.sampling_rate * self.speed)
+                if self._stop_signal.wait(max(due - monotonic(), 0)):
+                    break
+            read_start = self.read_timer.start()
+            samples_buffer = self.buffer_pool.acquire()
+            scans = samples_buffer[:self.chunk_size * number_of_ports * 2].reshape((self.chunk_size, number_of_ports, 2))
+            samples_read = self.source.fill(scans, self.samples_delivered)
+            if not samples_read:
+                self.buffer_pool.release(samples_buffer)
+                self.logger.info('Replay finished after %d samples.', self.samples_delivered)
+                break
+            self.read_timer.stop(read_start, samples_read)
+            self.consumer.write((samples_buffer, samples_read, time.time(), monotonic()))
+            self.samples_delivered += samples_read
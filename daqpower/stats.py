@@ -0,0 +1,146 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Running statistics of the power measured on each port, updated incrementally
+as chunks of samples are processed, so that they can be queried at any point
+during a capture without going through the port files.
+
+"""
+import math
+import threading
+
+import numpy
+
+
+class QuantileSketch(object):
+    """
+    Log-bucketed histogram of values for each port (along the lines of DDSketch).
+    Quantiles are accurate to within ``relative_accuracy`` for magnitudes between
+    ``min_value`` and ``max_value``; smaller magnitudes are treated as zero.
+
+    """
+
+    def __init__(self, number_of_ports, relative_accuracy=0.01, min_value=1e-9, max_value=1e9):
+        self.number_of_ports = number_of_ports
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self._offset = int(math.ceil(math.log(min_value) / self._log_gamma))
+        self._buckets = int(math.ceil(math.log(max_value) / self._log_gamma)) - self._offset + 1
+        # For each port: negative buckets (largest magnitude first), zero, positive buckets.
+        self._width = 2 * self._buckets + 1
+        self.counts = numpy.zeros((number_of_ports, self._width), dtype=numpy.int64)
+
+    def add(self, values):
+        """Add a (samples, ports) array of values."""
+        magnitude = numpy.maximum(numpy.abs(values), self.min_value)
+        index = numpy.ceil(numpy.log(magnitude) / self._log_gamma).astype(numpy.int64) - self._offset
+        numpy.clip(index, 0, self._buckets - 1, out=index)
+        sign = (values > self.min_value).astype(numpy.int64) - (values < -self.min_value)
+        bucket = sign * (index + 1)
+        bucket += numpy.arange(self.number_of_ports) * self._width + self._buckets
+        counts = numpy.bincount(bucket.ravel(), minlength=self.number_of_ports * self._width)
+        self.counts += counts.reshape((self.number_of_ports, self._width))
+
+    def quantile(self, q):
+        """Return the q-quantile (0 <= q <= 1) of each port (NaN for ports without values)."""
+        cumulative = numpy.cumsum(self.counts, axis=1)
+        total = cumulative[:, -1]
+        rank = q * (total - 1)
+        bucket = numpy.argmax(cumulative > rank[:, numpy.newaxis], axis=1)
+        result = numpy.array([self._bucket_value(b) for b in bucket])
+        result[total == 0] = numpy.nan
+        return result
+
+    def _bucket_value(self, bucket):
+        if bucket == self._buckets:
+            return 0.0
+        if bucket > self._buckets:
+            return self._representative(bucket - self._buckets - 1)
+        return -self._representative(self._buckets - 1 - bucket)
+
+    def _representative(self, index):
+        return 2 * self.gamma ** (index + self._offset) / (self.gamma + 1)
+
+
+class PortStatistics(object):
+    """
+    Sample count, energy, mean, min, max, variance and percentiles of the power
+    on each port, updated a chunk at a time.
+
+    """
+
+    percentiles = (1, 5, 25, 50, 75, 95, 99)
+
+    def __init__(self, labels, sampling_rate):
+        self.labels = list(labels)
+        self.sampling_rate = sampling_rate
+        number_of_ports = len(self.labels)
+        self.count = 0
+        self.sum = numpy.zeros(number_of_ports)
+        self.mean = numpy.zeros(number_of_ports)
+        self.m2 = numpy.zeros(number_of_ports)
+        self.minimum = numpy.full(number_of_ports, numpy.inf)
+        self.maximum = numpy.full(number_of_ports, -numpy.inf)
+        self.sketch = QuantileSketch(number_of_ports)
+        self._lock = threading.Lock()
+
+    def update(self, power):
+        """Add a (samples, ports) array of power values."""
+        count = power.shape[0]
+        if not count:
+            return
+        chunk_sum = power.sum(axis=0)
+        chunk_mean = chunk_sum / count
+        chunk_m2 = ((power - chunk_mean) ** 2).sum(axis=0)
+        chunk_min = power.min(axis=0)
+        chunk_max = power.max(axis=0)
+        with self._lock:
+            # Combine with the running values (Chan et al. parallel variance).
+            total = self.count + count
+            delta = chunk_mean - self.mean
+            self.mean += delta * count / total
+            self.m2 += chunk_m2 + delta ** 2 * self.count * count / total
+            self.count = total
+            self.sum += chunk_sum
+            numpy.minimum(self.minimum, chunk_min, out=self.minimum)
+            numpy.maximum(self.maximum, chunk_max, out=self.maximum)
+            self.sketch.add(power)
+
+    def get(self):
+        """
+        Return statistics for each port, keyed on label. All values are floats
+        (XML-RPC integers are limited to 32 bits); energy is in Joules, assuming
+        power values in Watts.
+        """
+        with self._lock:
+            percentiles = dict(('p{}'.format(p), self.sketch.quantile(p / 100.0)) for p in self.percentiles)
+            result = {}
+            for i, label in enumerate(self.labels):
+                if not self.count:
+                    result[label] = {'samples': 0.0}
+                    continue
+                result[label] = {
+                    'samples': float(self.count),
+                    'duration': float(self.count) / self.sampling_rate,
+                    'energy': float(self.sum[i]) / self.sampling_rate,
+                    'mean': float(self.mean[i]),
+                    'min': float(self.minimum[i]),
+                    'max': float(self.maximum[i]),
+                    'variance': float(self.m2[i] / self.count),
+                    'percentiles': dict((name, float(values[i])) for name, values in percentiles.items()),
+                }
+            return result
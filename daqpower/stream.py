@@ -0,0 +1,301 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Live streaming of processed samples to subscribed clients.
+
+A subscriber connects to the server's stream port, optionally sends a
+SUBSCRIBE frame naming a session, and then receives a sequence of frames. A
+subscriber that sends nothing for ``StreamServer.subscribe_timeout`` seconds
+(as those written before the server supported several sessions do) gets the
+most recently configured session. Each frame consists of a 5-byte preamble
+(frame type as uint8, payload length as uint32, little-endian) followed by the
+payload:
+
+:SUBSCRIBE: UTF-8 ID of the session to subscribe to; if empty, the most
+            recently configured session.
+:HEADER: JSON object with ``labels``, ``columns`` and ``metadata`` of the
+         session. Sent when the capture starts (or on connection, if it
+         already has).
+:DATA: uint64 index of the first sample in the block and uint32 number of
+       samples, followed by float64 values laid out as
+       ``[sample][port][column]``.
+:END: Empty payload; the capture has stopped and the connection will be
+      closed.
+
+Each subscriber has its own bounded queue of frames. If a subscriber cannot
+keep up, blocks for it are dropped (which it can detect as a jump in the
+sample index) rather than holding up the writer.
+
+"""
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+
+import numpy
+if sys.version_info[0] == 3:
+    from queue import Queue, Empty, Full
+else:
+    from Queue import Queue, Empty, Full
+
+
+FRAME_HEADER = 0
+FRAME_DATA = 1
+FRAME_END = 2
+FRAME_SUBSCRIBE = 3
+
+_preamble = struct.Struct('<BI')
+_block_header = struct.Struct('<QI')
+
+
+def encode_frame(frame_type, payload=b''):
+    return _preamble.pack(frame_type, len(payload)) + payload
+
+
+END_FRAME = encode_frame(FRAME_END)
+
+
+class StreamSubscriber(object):
+    """A connected client with its own bounded queue of frames to send."""
+
+    def __init__(self, connection, address, max_frames):
+        self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
+        self.connection = connection
+        self.address = address
+        self.dropped_frames = 0
+        self.closed = threading.Event()
+        self._queue = Queue(max_frames)
+        self._thread = threading.Thread(target=self._send_loop, name='StreamSubscriber')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, frame, force=False):
+        """Queue a frame without blocking; data frames are dropped if the queue is full."""
+        if self.closed.is_set():
+            return
+        try:
+            self._queue.put_nowait(frame)
+        except Full:
+            if not force:
+                self.dropped_frames += 1
+                return
+            # Control frames must get through; make room by discarding the oldest frame.
+            try:
+                self._queue.get_nowait()
+                self.dropped_frames += 1
+            except Empty:
+                pass
+            self._queue.put_nowait(frame)
+
+    def close(self):
+        self.closed.set()
+
+    def _send_loop(self):
+        try:
+            while True:
+                try:
+                    frame = self._queue.get(timeout=1)
+                except Empty:
+                    if self.closed.is_set():
+                        break
+                    continue
+                self.connection.sendall(frame)
+                if frame == END_FRAME:
+                    break
+        except socket.error as e:
+            self.logger.info('Stream subscriber %s disconnected: %s', self.address, e)
+        finally:
+            self.closed.set()
+            self.connection.close()
+            if self.dropped_frames:
+                self.logger.warning('Dropped %d frames for slow stream subscriber %s',
+                                    self.dropped_frames, self.address)
+
+
+class SampleBroadcaster(object):
+    """Fans out processed sample blocks of a capture session to all current subscribers."""
+
+    def __init__(self, max_frames=64):
+        self.max_frames = max_frames
+        self.header_frame = None
+        self.samples_published = 0
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, connection, address):
+        subscriber = StreamSubscriber(connection, address, self.max_frames)
+        with self._lock:
+            if self.header_frame:
+                subscriber.send(self.header_frame, force=True)
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def open(self, labels, columns, metadata=None):
+        header = {'labels': list(labels), 'columns': list(columns), 'metadata': metadata or {}}
+        with self._lock:
+            self.header_frame = encode_frame(FRAME_HEADER, json.dumps(header).encode('utf-8'))
+            self.samples_published = 0
+            for subscriber in self._subscribers:
+                subscriber.send(self.header_frame, force=True)
+
+    def publish(self, columns):
+        """Publish a block given as a list of (samples, ports) arrays, one per column."""
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if not s.closed.is_set()]
+            number_of_samples = columns[0].shape[0]
+            if self._subscribers:
+                # Encoded once and shared by all subscribers.
+                block = numpy.stack(columns, axis=-1).astype('<f8')
+                frame = encode_frame(FRAME_DATA, _block_header.pack(self.samples_published, number_of_samples) +
+                                     block.tobytes())
+                for subscriber in self._subscribers:
+                    subscriber.send(frame)
+            self.samples_published += number_of_samples
+
+    def close(self):
+        """Signal the end of the session to all subscribers."""
+        with self._lock:
+            for subscriber in self._subscribers:
+                subscriber.send(END_FRAME, force=True)
+            self._subscribers = []
+            self.header_frame = None
+
+    @property
+    def number_of_subscribers(self):
+        with self._lock:
+            return len([s for s in self._subscribers if not s.closed.is_set()])
+
+
+class StreamServer(threading.Thread):
+    """
+    Accepts stream subscribers and attaches them to the broadcaster of the session
+    they subscribe to. ``resolver`` is called with the session ID (None if not
+    specified) and must return the broadcaster of that session, or None if there
+    is no such session. Subscribers that do not send a SUBSCRIBE frame within
+    ``subscribe_timeout`` seconds get the most recently configured session.
+
+    """
+
+    subscribe_timeout = 1
+
+    def __init__(self, port, host='', resolver=None):
+        super(StreamServer, self).__init__(name='StreamServer')
+        self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
+        self.daemon = True
+        self.resolver = resolver
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(5)
+        self.port = self._socket.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                connection, address = self._socket.accept()
+            except socket.error:
+                break  # listening socket closed
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # On its own thread, so that a slow subscriber does not hold up others.
+            thread = threading.Thread(target=self._attach, args=(connection, address), name='StreamSubscribe')
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self._socket.close()
+
+    def _attach(self, connection, address):
+        session_id = ''
+        try:
+            connection.settimeout(self.subscribe_timeout)
+            frame_type, payload = read_frame(connection)
+            if frame_type == FRAME_SUBSCRIBE:
+                session_id = payload.decode('utf-8')
+        except socket.timeout:
+            pass  # subscribes to the most recently configured session
+        except (socket.error, EOFError) as e:
+            self.logger.info('Stream subscriber %s did not subscribe: %s', address, e)
+            connection.close()
+            return
+        connection.settimeout(None)
+        broadcaster = self.resolver(session_id or None) if self.resolver else None
+        if broadcaster is None:
+            self.logger.info('Rejecting stream subscriber %s: no session %s', address, session_id)
+            connection.sendall(END_FRAME)
+            connection.close()
+            return
+        self.logger.info('New stream subscriber %s', address)
+        broadcaster.subscribe(connection, address)
+
+
+class StreamReceiver(object):
+    """
+    Client side of the stream protocol. Iterating over a receiver yields
+    ``(first_sample, block)`` tuples, where block is a
+    ``[sample][port][column]`` numpy array, until the capture ends. ``labels``
+    and ``columns`` are available once the first block has been received.
+
+    """
+
+    def __init__(self, host, port, timeout=None, session_id=None):
+        self.labels = None
+        self.columns = None
+        self.metadata = None
+        self._socket = socket.create_connection((host, port), timeout)
+        self._socket.settimeout(None)
+        # Sent even without a session ID, so as not to wait for the server's subscribe_timeout.
+        self._socket.sendall(encode_frame(FRAME_SUBSCRIBE, (session_id or '').encode('utf-8')))
+
+    def __iter__(self):
+        try:
+            while True:
+                frame_type, payload = read_frame(self._socket)
+                if frame_type == FRAME_HEADER:
+                    header = json.loads(payload.decode('utf-8'))
+                    self.labels = header['labels']
+                    self.columns = header['columns']
+                    self.metadata = header['metadata']
+                elif frame_type == FRAME_DATA:
+                    first_sample, number_of_samples = _block_header.unpack_from(payload)
+                    block = numpy.frombuffer(payload, dtype='<f8', offset=_block_header.size)
+                    shape = (number_of_samples, len(self.labels), len(self.columns))
+                    yield first_sample, block.reshape(shape)
+                elif frame_type == FRAME_END:
+                    break
+        finally:
+            self.close()
+
+    def close(self):
+        self._socket.close()
+
+
+def read_frame(connection):
+    """Read a frame from a socket; returns (frame type, payload)."""
+    frame_type, length = _preamble.unpack(_read_exactly(connection, _preamble.size))
+    return frame_type, _read_exactly(connection, length)
+
+
+def _read_exactly(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(min(size, 1048576))
+        if not chunk:
+            raise EOFError('Stream connection closed unexpectedly.')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
@@ -0,0 +1,181 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Timestamp index of a capture session. Port files do not contain timestamps;
+instead, the host wall-clock and monotonic time at which each chunk of samples
+was delivered by the driver is recorded, along with how far into the port
+files that chunk extends::
+
+    +-------------------------------------------------------------------+
+    | MAGIC | number of ports (uint32) | sampling rate | downsample     |
+    +-------------------------------------------------------------------+
+    | record: samples, rows, wall time, monotonic time, byte offset of  |
+    |         the end of the chunk in each CSV port file                |
+    | ...                                                               |
+    +-------------------------------------------------------------------+
+
+``samples`` is the number of samples acquired up to the end of the chunk and
+``rows`` the number of rows written to each port file (these differ if the
+session is downsampled). The first record is the origin of the session (the
+time of its first sample is extrapolated from the first chunk). Times of
+individual samples are interpolated between records, and a time window is
+mapped onto a row range, and from there onto a byte range of a port file, with
+a binary search rather than a scan.
+
+"""
+import struct
+import time
+
+import numpy
+
+
+TIMESTAMPS_FILENAME = 'timestamps.idx'
+CLOCKS = ['wall', 'monotonic']
+
+MAGIC = b'DAQTS1\0\0'
+
+_header = struct.Struct('<IdI')
+
+# time.monotonic() is not available on Python 2, where wall clock time is used instead.
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class TimestampIndexError(Exception):
+    pass
+
+
+def _record_dtype(number_of_ports):
+    return numpy.dtype([('samples', '<u8'), ('rows', '<u8'), ('wall', '<f8'), ('monotonic', '<f8'),
+                        ('offsets', '<u8', (number_of_ports,))])
+
+
+class TimestampIndexWriter(object):
+    """Appends a record for each processed chunk; flushed as it goes, so it can be read during a capture."""
+
+    def __init__(self, path, number_of_ports, sampling_rate, downsample=1):
+        self.path = path
+        self.number_of_ports = number_of_ports
+        self.sampling_rate = sampling_rate
+        self._dtype = _record_dtype(number_of_ports)
+        self._origin_offsets = None
+        self._last = None
+        self.fh = open(path, 'wb')
+        self.fh.write(MAGIC)
+        self.fh.write(_header.pack(number_of_ports, sampling_rate, downsample))
+        self.fh.flush()
+
+    def start(self, offsets):
+        """Set the offsets at which samples start in each port file (i.e. after the headers)."""
+        self._origin_offsets = offsets
+
+    def record(self, samples, rows, wall, monotonic, offsets):  # pylint: disable=redefined-outer-name
+        if self._last is None:
+            # The chunk was delivered as its last sample was acquired; extrapolate back
+            # to get the time of the first sample of the session.
+            elapsed = float(samples) / self.sampling_rate
+            self._write(0, 0, wall - elapsed, monotonic - elapsed, self._origin_offsets)
+        self._write(samples, rows, wall, monotonic, offsets)
+
+    def finish(self, samples, rows, offsets):
+        """Record any rows written after the last chunk (e.g. a final partial downsampling window)."""
+        if self._last is not None and rows != self._last['rows']:
+            self._write(samples, rows, self._last['wall'], self._last['monotonic'], offsets)
+
+    def close(self):
+        if not self.fh.closed:
+            self.fh.close()
+
+    def _write(self, samples, rows, wall, monotonic, offsets):  # pylint: disable=redefined-outer-name
+        record = numpy.zeros((1,), dtype=self._dtype)
+        record['samples'] = samples
+        record['rows'] = rows
+        record['wall'] = wall
+        record['monotonic'] = monotonic
+        record['offsets'] = offsets or [0] * self.number_of_ports
+        self.fh.write(record.tobytes())
+        self.fh.flush()
+        self._last = record[0]
+
+    def __del__(self):
+        self.close()
+
+
+class TimestampIndex(object):
+    """Maps time windows onto row ranges of the port files of a session."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise TimestampIndexError('{} is not a timestamp index.'.format(path))
+            self.number_of_ports, self.sampling_rate, self.downsample = _header.unpack(fh.read(_header.size))
+            data = fh.read()
+        dtype = _record_dtype(self.number_of_ports)
+        # Ignore a partially written trailing record, if the session is still running.
+        self.records = numpy.frombuffer(data[:len(data) - len(data) % dtype.itemsize], dtype=dtype)
+        self.rows = int(self.records['rows'][-1]) if len(self.records) else 0
+
+    @property
+    def sample_period(self):
+        """Time covered by each row of the port files."""
+        return float(self.downsample) / self.sampling_rate
+
+    def rows_for_window(self, start_time, end_time, clock='wall'):
+        """Return ``(first_row, stop_row)`` of the rows whose first sample was acquired in ``[start_time, end_time)``."""
+        if len(self.records) < 2:
+            return 0, 0
+        times, positions = self._clock(clock), self.records['samples'].astype(numpy.float64)
+        # Sample k (counting from zero) is the (k+1)th sample of the session.
+        first, stop = (numpy.interp([start_time, end_time], times, positions) - 1) / self.downsample
+        first_row = min(max(int(numpy.ceil(first)), 0), self.rows)
+        if end_time > times[-1]:
+            stop_row = self.rows  # including any final partial window
+        else:
+            stop_row = min(max(int(numpy.ceil(stop)), first_row), self.rows)
+        return first_row, stop_row
+
+    def time_of_row(self, row, clock='wall'):
+        """Estimated time at which the first sample of the specified row was acquired."""
+        times, positions = self._clock(clock), self.records['samples'].astype(numpy.float64)
+        return float(numpy.interp(row * self.downsample + 1, positions, times))
+
+    def byte_range(self, port, first_row, stop_row):
+        """
+        Return ``(start, end, skip)``: the range of bytes in the CSV file of the
+        specified port (index) that contains the rows, and the number of rows in
+        that range before first_row.
+        """
+        rows = self.records['rows']
+        first = max(int(numpy.searchsorted(rows, first_row, side='right')) - 1, 0)
+        last = min(int(numpy.searchsorted(rows, stop_row, side='left')), len(rows) - 1)
+        offsets = self.records['offsets'][:, port]
+        return int(offsets[first]), int(offsets[last]), first_row - int(rows[first])
+
+    def _clock(self, clock):
+        if clock not in CLOCKS:
+            raise TimestampIndexError('Invalid clock: {} (must be one of {})'.format(clock, CLOCKS))
+        # Wall clock time may be stepped back (e.g. by NTP); interpolation needs it non-decreasing.
+        return numpy.maximum.accumulate(self.records[clock])
+
+
+def read_csv_rows(path, index, port, first_row, stop_row):
+    """Return the lines of rows ``[first_row, stop_row)`` of a CSV port file, using the index to seek to them."""
+    if stop_row <= first_row:
+        return []
+    start, end, skip = index.byte_range(port, first_row, stop_row)
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        lines = fh.read(end - start).decode('utf-8').splitlines()
+    return lines[skip:skip + stop_row - first_row]
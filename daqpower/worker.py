@@ -0,0 +1,271 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Sample processing in a worker process. The driver callbacks, processing and
+formatting of samples and the XML-RPC server otherwise all compete for the
+GIL of a single interpreter, so a processing stall can delay the reads of the
+driver buffer until it overflows. ``ProcessSampleProcessor`` stands in for
+``SampleProcessor`` in the server process: its writer thread only copies each
+chunk of raw samples into a free slot of a ring of shared memory and passes the
+slot number (and the chunk's timestamps) on to a worker process, where a
+regular ``SampleProcessor`` does the rest on another core. The samples are
+never pickled. Queries (port stats, metrics, snapshots, ...) are forwarded to
+the worker over a pipe, and blocks published for streaming are sent back.
+
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import traceback
+try:
+    from queue import Empty
+except ImportError:  # python2
+    from Queue import Empty
+
+import numpy
+
+from daqpower.daq import RawSampleWriter, SampleProcessor, SamplePorcessorError, get_port_file_path, SPILL_FILENAME
+
+
+DEFAULT_SLOTS = 8
+
+# Started afresh rather than forked (as it must be on Windows anyway), as forking a
+# process with other threads running (e.g. those of the XML-RPC server) is not safe.
+_context = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+
+class SharedSampleRing(object):
+    """``slots`` buffers of ``slot_size`` float64 values in memory shared with the worker process."""
+
+    def __init__(self, slot_size, slots, array=None):
+        self.slot_size = slot_size
+        self.slots = slots
+        # Not synchronized: each slot is only ever accessed by one side at a time.
+        self.array = array if array is not None else _context.RawArray('d', slot_size * slots)
+        self._data = numpy.frombuffer(self.array, dtype=numpy.float64)
+        self._address = self._data.__array_interface__['data'][0]
+
+    def get_slot(self, slot):
+        return self._data[slot * self.slot_size:(slot + 1) * self.slot_size]
+
+    def get_slot_number(self, buffer):
+        return (buffer.__array_interface__['data'][0] - self._address) // (self.slot_size * self._data.itemsize)
+
+
+class _SlotPool(object):
+    """Stands in for the BufferPool of the worker's SampleProcessor, returning processed slots to the server."""
+
+    def __init__(self, ring, free_slots):
+        self.ring = ring
+        self.free_slots = free_slots
+
+    def release(self, buffer):
+        self.free_slots.put(self.ring.get_slot_number(buffer))
+
+
+class _BroadcastForwarder(object):
+    """Stands in for the SampleBroadcaster of the worker's SampleProcessor, sending calls to the server."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def open(self, *args):
+        self.queue.put(('open', args))
+
+    def publish(self, *args):
+        self.queue.put(('publish', args))
+
+    def close(self):
+        self.queue.put(('close', ()))
+
+
+def _run_worker(processor_kwargs, ring_array, slot_size, slots, free_slots, filled_slots, connection, broadcasts):
+    """Entry point of the worker process."""
+    ring = SharedSampleRing(slot_size, slots, ring_array)
+    processor_kwargs = dict(processor_kwargs, buffer_pool=_SlotPool(ring, free_slots), max_queue_size=0,
+                            overrun_policy='block')
+    if broadcasts is not None:
+        processor_kwargs['broadcaster'] = _BroadcastForwarder(broadcasts)
+    try:
+        processor = SampleProcessor(**processor_kwargs)
+        processor.start()
+    except Exception as e:  # pylint: disable=broad-except
+        connection.send((False, str(e)))
+        return
+    connection.send((True, None))
+    stopped = threading.Event()
+
+    def process():
+        while True:
+            item = filled_slots.get()
+            if item is None:
+                break
+            slot, number_of_samples, wall_time, monotonic_time = item
+            processor.write((ring.get_slot(slot), number_of_samples, wall_time, monotonic_time))
+        processor.stop()
+        stopped.set()
+
+    thread = threading.Thread(target=process, name='SampleProcessorWorker')
+    thread.daemon = True
+    thread.start()
+    while True:
+        try:
+            name, args = connection.recv()
+        except EOFError:
+            break  # the server went away
+        if name == 'exit':
+            break
+        try:
+            if name == 'wait_stopped':
+                stopped.wait()
+                result = None
+            else:
+                result = getattr(processor, name)(*args)
+            connection.send((True, result))
+        except Exception as e:  # pylint: disable=broad-except
+            connection.send((False, '{}: {}'.format(e.__class__.__name__, e)))
+
+
+class ProcessSampleProcessor(RawSampleWriter):
+    """
+    Hands chunks of samples over to a SampleProcessor (constructed from
+    ``processor_kwargs``) running in a worker process, through a ring of
+    ``slots`` shared buffers of ``buffer_pool.buffer_size`` values. Overrun
+    handling (``max_queue_size`` and ``overrun_policy``) applies to the chunks
+    waiting for a free slot.
+
+    """
+
+    def __init__(self, processor_kwargs, buffer_pool, max_queue_size=0, overrun_policy='block',
+                 slots=DEFAULT_SLOTS):
+        super(ProcessSampleProcessor, self).__init__(
+            len(processor_kwargs['resistor_values']), buffer_pool, max_queue_size=max_queue_size,
+            overrun_policy=overrun_policy,
+            spill_path=os.path.join(processor_kwargs['output_directory'], SPILL_FILENAME))
+        self.logger = logging.getLogger('{}.{}'.format(__name__, self.__class__.__name__))
+        processor_kwargs = dict(processor_kwargs)
+        self.broadcaster = processor_kwargs.pop('broadcaster', None)
+        self.processor_kwargs = processor_kwargs
+        self.output_directory = processor_kwargs['output_directory']
+        self.labels = processor_kwargs['labels']
+        self.ring = SharedSampleRing(buffer_pool.buffer_size, slots)
+        self._free_slots = _context.Queue()
+        for slot in range(slots):
+            self._free_slots.put(slot)
+        self._filled_slots = _context.Queue()
+        self._broadcasts = _context.Queue() if self.broadcaster else None
+        self._connection, worker_connection = _context.Pipe()
+        self._call_lock = threading.Lock()
+        self._process = _context.Process(target=_run_worker, name='SampleProcessor',
+                                         args=(processor_kwargs, self.ring.array, self.ring.slot_size, slots,
+                                               self._free_slots, self._filled_slots, worker_connection,
+                                               self._broadcasts))
+        self._process.daemon = True
+        self._forwarder = None
+
+    def start(self):
+        self._process.start()
+        ok, error = self._connection.recv()
+        if not ok:
+            raise SamplePorcessorError('Could not start sample processing worker: {}'.format(error))
+        if self._broadcasts is not None:
+            self._forwarder = threading.Thread(target=self._forward_broadcasts, name='BroadcastForwarder')
+            self._forwarder.daemon = True
+            self._forwarder.start()
+        super(ProcessSampleProcessor, self).start()
+
+    def do_write(self, sample_tuple):
+        samples, number_of_samples, wall_time, monotonic_time = sample_tuple
+        try:
+            slot = self._acquire_slot()
+            if slot is None:
+                self.dropped_samples += number_of_samples
+                return
+            size = number_of_samples * self.number_of_ports * 2
+            self.ring.get_slot(slot)[:size] = samples[:size]
+        finally:
+            self.discard(sample_tuple)
+        self._filled_slots.put((slot, number_of_samples, wall_time, monotonic_time))
+
+    def stop(self):
+        if not self._process.is_alive():
+            return
+        super(ProcessSampleProcessor, self).stop()
+        self.wait()
+        self._filled_slots.put(None)
+        # Returns once the worker has written out everything, and closed its files.
+        self._call('wait_stopped')
+        if self._forwarder:
+            self._forwarder.join()
+            self._forwarder = None
+
+    def close(self):
+        """Stop the worker process (after which it can no longer be queried)."""
+        process = getattr(self, '_process', None)
+        if not process or not process.is_alive():
+            return
+        self.stop()
+        with self._call_lock:
+            self._connection.send(('exit', ()))
+        self._process.join()
+
+    def get_port_file_path(self, port_id):
+        return get_port_file_path(self.output_directory, self.labels, port_id)
+
+    def get_port_stats(self):
+        return self._call('get_port_stats')
+
+    def get_progress(self):
+        return self._call('get_progress')
+
+    def get_trigger_status(self):
+        return self._call('get_trigger_status')
+
+    def snapshot(self):
+        return self._call('snapshot')
+
+    def _acquire_slot(self):
+        while True:
+            try:
+                return self._free_slots.get(timeout=self.wait_period)
+            except Empty:
+                if not self._process.is_alive():
+                    self.logger.error('Sample processing worker has exited; dropping samples.')
+                    return None
+
+    def _call(self, name, *args):
+        with self._call_lock:
+            if not self._process.is_alive():
+                raise SamplePorcessorError('Sample processing worker is not running.')
+            self._connection.send((name, args))
+            ok, result = self._connection.recv()
+        if not ok:
+            raise SamplePorcessorError(result)
+        return result
+
+    def _forward_broadcasts(self):
+        while True:
+            name, args = self._broadcasts.get()
+            try:
+                getattr(self.broadcaster, name)(*args)
+            except Exception:  # pylint: disable=broad-except
+                self.logger.error('Could not forward %s to the broadcaster:\n%s', name, traceback.format_exc())
+            if name == 'close':
+                break
+
+    def __del__(self):
+        self.close()
@@ -31,6 +31,7 @@ params = dict(
     scripts=[
         'scripts/run-daq-server',
         'scripts/send-daq-command',
+        'scripts/run-daq-benchmark',
     ],
     url='https://github.com/ARM-software/daq-server',
     maintainer='ARM Device Lab',
@@ -0,0 +1,120 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from daqpower.capture import (CaptureFormatError, CaptureReader, CaptureWriter, format_csv_rows,
+                              load_checksum, transcode_to_csv, CHECKSUM_SUFFIX)
+
+
+LABELS = ['A', 'B', 'C']
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'capture.daqbin')
+        # 25 samples of 3 ports; each value tells its port and sample apart.
+        self.power = numpy.arange(75, dtype=numpy.float64).reshape((25, 3))
+        self.voltage = -self.power
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, block_sizes, chunk_size=10, close=True):
+        writer = CaptureWriter(self.path, LABELS, chunk_size, metadata={'downsample': 1})
+        start = 0
+        for size in block_sizes:
+            writer.write(self.power[start:start + size], self.voltage[start:start + size])
+            start += size
+        if close:
+            writer.close()
+        else:
+            writer.flush()
+        return writer
+
+    def test_round_trip(self):
+        for block_sizes in ([25], [3, 7, 15], [10, 10, 5], [1] * 25):
+            self.write(block_sizes)
+            with CaptureReader(self.path) as reader:
+                self.assertEqual(reader.labels, LABELS)
+                self.assertEqual(reader.columns, ['power', 'voltage'])
+                self.assertEqual(reader.metadata, {'downsample': 1})
+                self.assertEqual(reader.number_of_samples, 25)
+                self.assertEqual(reader.index['samples'].tolist(), [10, 10, 5])
+                for port, label in enumerate(LABELS):
+                    power, voltage = reader.read(label)
+                    numpy.testing.assert_array_equal(power, self.power[:, port])
+                    numpy.testing.assert_array_equal(voltage, self.voltage[:, port])
+
+    def test_read_range_across_chunks(self):
+        self.write([25])
+        with CaptureReader(self.path) as reader:
+            for start, stop in [(0, 1), (9, 11), (5, 25), (12, 18), (20, 100), (25, 30)]:
+                power, voltage = reader.read(1, start, stop)
+                numpy.testing.assert_array_equal(power, self.power[start:stop, 1])
+                numpy.testing.assert_array_equal(voltage, self.voltage[start:stop, 1])
+
+    def test_iter_chunks(self):
+        self.write([25])
+        with CaptureReader(self.path) as reader:
+            chunks = [power for power, _ in reader.iter_chunks('C')]
+        self.assertEqual([chunk.shape[0] for chunk in chunks], [10, 10, 5])
+        numpy.testing.assert_array_equal(numpy.concatenate(chunks), self.power[:, 2])
+
+    def test_unclosed_container_is_read_up_to_last_complete_chunk(self):
+        writer = self.write([13, 12], close=False)
+        try:
+            with CaptureReader(self.path) as reader:
+                self.assertEqual(reader.index['sample_offset'].tolist(), [0, 10])
+                self.assertEqual(reader.number_of_samples, 20)
+                power, _ = reader.read('B', 5, 25)
+                numpy.testing.assert_array_equal(power, self.power[5:20, 1])
+        finally:
+            writer.close()
+        with CaptureReader(self.path) as reader:
+            self.assertEqual(reader.number_of_samples, 25)
+
+    def test_invalid_port(self):
+        self.write([25])
+        with CaptureReader(self.path) as reader:
+            self.assertRaises(CaptureFormatError, reader.read, 'D')
+            self.assertRaises(CaptureFormatError, reader.read, 3)
+
+    def test_not_a_capture(self):
+        with open(self.path, 'wb') as fh:
+            fh.write(b'power,voltage\n')
+        self.assertRaises(CaptureFormatError, CaptureReader, self.path)
+
+    def test_transcode_to_csv(self):
+        self.write([25])
+        csv_path = os.path.join(self.directory, 'B.csv')
+        transcode_to_csv(self.path, 'B', csv_path)
+        with open(csv_path) as fh:
+            self.assertEqual(fh.read(), 'power,voltage\n' + format_csv_rows(self.power[:, 1], self.voltage[:, 1]))
+        self.assertTrue(os.path.isfile(csv_path + CHECKSUM_SUFFIX))
+        recorded = load_checksum(csv_path)
+        os.remove(csv_path + CHECKSUM_SUFFIX)
+        self.assertEqual(load_checksum(csv_path), recorded)
+
+
+if __name__ == '__main__':
+    unittest.main()
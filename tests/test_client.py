@@ -0,0 +1,247 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from daqpower.capture import load_checksum
+from daqpower.client import DaqClient, _Download, DECOMPRESSORS, DOWNLOAD_SUFFIX
+from daqpower.config import DeviceConfiguration
+from daqpower.server import DaqServer, DataServer, ThreadedXMLRPCServer
+
+
+SOURCE = {'server': 'localhost:45677', 'session_id': 'abc', 'remote_file': 'A.csv'}
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.local_file = os.path.join(self.directory, 'A.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def interrupted_download(self, data, source=SOURCE):
+        download = _Download(self.local_file, source)
+        download.write(data)
+        download.close()
+
+    def test_existing_file_is_not_resumed(self):
+        with open(self.local_file, 'wb') as fh:
+            fh.write(b'left by an earlier capture')
+        download = _Download(self.local_file, SOURCE)
+        self.assertFalse(download.can_resume())
+        download.write(b'new')
+        download.close()
+        download.finish()
+        with open(self.local_file, 'rb') as fh:
+            self.assertEqual(fh.read(), b'new')
+
+    def test_interrupted_download_is_resumed(self):
+        self.interrupted_download(b'power,')
+        download = _Download(self.local_file, dict(SOURCE))
+        self.assertTrue(download.can_resume(max_size=100))
+        download.resume()
+        self.assertEqual(download.offset, 6)
+        download.write(b'voltage')
+        download.close()
+        self.assertEqual(download.hexdigest(), hashlib.sha256(b'power,voltage').hexdigest())
+        download.finish()
+        self.assertFalse(os.path.exists(self.local_file + DOWNLOAD_SUFFIX))
+        with open(self.local_file, 'rb') as fh:
+            self.assertEqual(fh.read(), b'power,voltage')
+
+    def test_completed_download_is_not_resumed(self):
+        self.interrupted_download(b'power,voltage')
+        _Download(self.local_file, SOURCE).finish()
+        self.assertFalse(_Download(self.local_file, SOURCE).can_resume())
+
+    def test_download_of_another_source_is_not_resumed(self):
+        self.interrupted_download(b'power,')
+        for key, value in [('session_id', 'def'), ('remote_file', 'B.csv'), ('server', 'otherhost:45677')]:
+            self.assertFalse(_Download(self.local_file, dict(SOURCE, **{key: value})).can_resume())
+
+    def test_download_larger_than_remote_file_is_not_resumed(self):
+        self.interrupted_download(b'power,voltage')
+        self.assertFalse(_Download(self.local_file, SOURCE).can_resume(max_size=6))
+
+    def test_discard(self):
+        self.interrupted_download(b'power,')
+        _Download(self.local_file, SOURCE).discard()
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class _IgnoreRangeHandler(BaseHTTPRequestHandler):
+    """Serves the whole of the file given by the server's ``path``, whatever the Range header."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        with open(self.server.path, 'rb') as fh:
+            data = fh.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@unittest.skipUnless(DataServer, 'the HTTP data endpoint requires Python 3')
+class TransferTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.data_server = DataServer(0, host='127.0.0.1')
+        cls.data_server.start()
+        cls.daq_server = DaqServer(os.path.join(cls.directory, 'server'), data_server=cls.data_server,
+                                   simulation={'waveform': 'sine', 'replay': None, 'speed': 1})
+        cls.rpc_server = ThreadedXMLRPCServer(('127.0.0.1', 0), allow_none=True, logRequests=False)
+        cls.rpc_server.register_instance(cls.daq_server)
+        threading.Thread(target=cls.rpc_server.serve_forever).start()
+        cls.port = cls.rpc_server.server_address[1]
+        client = DaqClient('127.0.0.1', cls.port)
+        config = DeviceConfiguration(device_id='Dev1', v_range=2.5, dv_range=0.2, sampling_rate=50000,
+                                     channel_map=None, resistor_values=[0.005], labels=['A'])
+        client.configure(config.__dict__)
+        client.start()
+        time.sleep(1.5)
+        client.stop()
+        with open(cls.daq_server._resolve_port_file('A'), 'rb') as fh:  # pylint: disable=protected-access
+            cls.expected = fh.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.rpc_server.shutdown()
+        cls.rpc_server.server_close()
+        cls.daq_server._shutdown()  # pylint: disable=protected-access
+        cls.data_server.stop()
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp(dir=self.directory)
+        self.local_file = os.path.join(self.output_directory, 'A')
+
+    def read_local_file(self):
+        with open(self.local_file, 'rb') as fh:
+            return fh.read()
+
+    def partial_download(self, client, size):
+        download = _Download(self.local_file, client._get_download_source('A'))  # pylint: disable=protected-access
+        download.write(self.expected[:size])
+        download.close()
+
+    def test_downloads_are_identical(self):
+        self.assertGreater(len(self.expected), 1048576)  # more than one read of each protocol
+        clients = [DaqClient('127.0.0.1', self.port),  # HTTP
+                   DaqClient('127.0.0.1', self.port, encoding=None, use_data_plane=False)]
+        self.assertIsNotNone(clients[0]._get_data_url())  # pylint: disable=protected-access
+        clients.extend(DaqClient('127.0.0.1', self.port, encoding=encoding, use_data_plane=False)
+                       for encoding in sorted(DECOMPRESSORS) if encoding != 'none')
+        for client in clients:
+            client.pull('A', self.local_file)
+            self.assertEqual(self.read_local_file(), self.expected)
+            self.assertFalse(os.path.exists(self.local_file + DOWNLOAD_SUFFIX))
+            os.remove(self.local_file)
+
+    def test_http_range_resumes_download(self):
+        client = DaqClient('127.0.0.1', self.port)
+        self.partial_download(client, 1000)
+        download = _Download(self.local_file, client._get_download_source('A'))  # pylint: disable=protected-access
+        self.assertTrue(download.can_resume())
+        download.resume()
+        client._download_http(client._get_data_url(), 'A', download)  # pylint: disable=protected-access
+        download.close()
+        self.assertEqual(download.offset, len(self.expected))
+        self.assertEqual(download.hexdigest(), hashlib.sha256(self.expected).hexdigest())
+        download.finish()
+        self.assertEqual(self.read_local_file(), self.expected)
+
+    def test_ignored_range_falls_back_to_rpc(self):
+        http_server = HTTPServer(('127.0.0.1', 0), _IgnoreRangeHandler)
+        http_server.path = self.daq_server._resolve_port_file('A')  # pylint: disable=protected-access
+        threading.Thread(target=http_server.serve_forever).start()
+        try:
+            client = DaqClient('127.0.0.1', self.port)
+            data_url = 'http://127.0.0.1:{}'.format(http_server.server_address[1])
+            client._data_url = data_url  # pylint: disable=protected-access
+            self.partial_download(client, 1000)
+            with self.assertLogs('daqpower.client', 'WARNING') as logs:
+                client.pull('A', self.local_file)
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+        self.assertIn('Server ignored range request', '\n'.join(logs.output))
+        self.assertEqual(self.read_local_file(), self.expected)
+
+
+class FollowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.daq_server = DaqServer(os.path.join(self.directory, 'server'),
+                                    simulation={'waveform': 'sine', 'replay': None, 'speed': 1})
+        self.rpc_server = ThreadedXMLRPCServer(('127.0.0.1', 0), allow_none=True, logRequests=False)
+        self.rpc_server.register_instance(self.daq_server)
+        threading.Thread(target=self.rpc_server.serve_forever).start()
+        self.client = DaqClient('127.0.0.1', self.rpc_server.server_address[1])
+
+    def tearDown(self):
+        self.rpc_server.shutdown()
+        self.rpc_server.server_close()
+        self.daq_server._shutdown()  # pylint: disable=protected-access
+        shutil.rmtree(self.directory)
+
+    def test_follow_during_capture(self):
+        config = DeviceConfiguration(device_id='Dev1', v_range=2.5, dv_range=0.2, sampling_rate=20000,
+                                     channel_map=None, resistor_values=[0.005], labels=['A'])
+        self.client.configure(config.__dict__)
+        self.client.start()
+        local_file = os.path.join(self.directory, 'A')
+        sizes_while_running = []
+
+        def stop_later():
+            time.sleep(1.5)
+            if os.path.exists(local_file):
+                sizes_while_running.append(os.path.getsize(local_file))
+            DaqClient('127.0.0.1', self.rpc_server.server_address[1]).stop()
+
+        stopper = threading.Thread(target=stop_later)
+        stopper.start()
+        try:
+            self.client.pull('A', local_file, follow=True)
+        finally:
+            stopper.join()
+        self.assertTrue(sizes_while_running and sizes_while_running[0] > 0)  # followed, not pulled at the end
+        remote_file = self.daq_server._resolve_port_file('A')  # pylint: disable=protected-access
+        with open(local_file, 'rb') as fh, open(remote_file, 'rb') as expected:
+            data = fh.read()
+            self.assertEqual(data, expected.read())
+        self.assertEqual(hashlib.sha256(data).hexdigest(), load_checksum(remote_file))
+        self.assertFalse(os.path.exists(local_file + DOWNLOAD_SUFFIX))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from daqpower.capture import CaptureWriter
+from daqpower.config import DeviceConfiguration
+from daqpower.daq import (BufferPool, DaqRunner, Downsampler, RawSampleWriter, SampleProcessor,
+                          SamplePorcessorError, TaskCache, Trigger, get_port_file_path)
+from daqpower.portfile import PORT_FILE_SUFFIX
+
+
+def get_config(**kwargs):
+    settings = dict(device_id='Dev1', v_range=2.5, dv_range=0.2, sampling_rate=1000, channel_map=None,
+                    resistor_values=[0.005], labels=['A'])
+    settings.update(kwargs)
+    config = DeviceConfiguration(**settings)
+    config.validate()
+    return config
+
+
+class BufferPoolTest(unittest.TestCase):
+
+    def test_released_buffer_is_reused(self):
+        pool = BufferPool(8, 2)
+        buffer = pool.acquire()
+        pool.release(buffer)
+        self.assertIs(pool.acquire(), buffer)
+
+    def test_buffer_of_another_size_is_not_pooled(self):
+        pool = BufferPool(8, 2)
+        pool.release(numpy.empty((4,)))
+        self.assertEqual(pool.get_stats()['free'], 0)
+
+    def test_chunk_read_back_from_spill_file_is_not_pooled(self):
+        # A spilled chunk of exactly buffer_size values decodes to a buffer of the
+        # same size, but one backed by the (immutable) bytes read from the file.
+        number_of_ports = 2
+        pool = BufferPool(8, 2)
+        writer = RawSampleWriter(number_of_ports, pool)
+        samples = numpy.arange(8, dtype=numpy.float64)
+        decoded = writer.decode(writer.encode((samples, 2, 1.0, 2.0)))
+        self.assertEqual(decoded[0].shape[0], pool.buffer_size)
+        writer.discard(decoded)
+        self.assertEqual(pool.get_stats()['free'], 0)
+
+
+class DownsamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        # 23 samples of 2 ports, downsampled by 5 whatever the chunks they arrive in.
+        self.power = numpy.arange(46, dtype=numpy.float64).reshape((23, 2))
+        self.voltage = self.power * 0.5 + 1
+
+    def process(self, downsampler, chunk_sizes):
+        results = []
+        start = 0
+        for size in chunk_sizes:
+            results.append(downsampler.process(self.power[start:start + size], self.voltage[start:start + size]))
+            start += size
+        final = downsampler.flush()
+        if final is not None:
+            results.append(final)
+        return [numpy.concatenate(columns) for columns in zip(*results)]
+
+    def test_windows_are_carried_over_between_chunks(self):
+        expected = self.process(Downsampler(5), [23])
+        for chunk_sizes in ([1] * 23, [3, 4, 9, 7], [5, 5, 5, 5, 3], [22, 1]):
+            result = self.process(Downsampler(5), chunk_sizes)
+            for column, expected_column in zip(result, expected):
+                numpy.testing.assert_allclose(column, expected_column)
+
+    def test_mean_of_each_window_and_final_partial_window(self):
+        power, voltage = self.process(Downsampler(5), [7, 16])
+        self.assertEqual(power.shape, (5, 2))
+        numpy.testing.assert_allclose(power[:4], self.power[:20].reshape((4, 5, 2)).mean(axis=1))
+        numpy.testing.assert_allclose(power[4], self.power[20:].mean(axis=0))
+        numpy.testing.assert_allclose(voltage[1], self.voltage[5:10].mean(axis=0))
+
+    def test_extrema(self):
+        downsampler = Downsampler(5, extrema=True)
+        columns = self.process(downsampler, [8, 15])
+        self.assertEqual(len(columns), len(downsampler.columns))
+        result = dict(zip(downsampler.columns, columns))
+        numpy.testing.assert_allclose(result['power_min'][1], self.power[5])
+        numpy.testing.assert_allclose(result['power_max'][1], self.power[9])
+        numpy.testing.assert_allclose(result['voltage_max'][4], self.voltage[22])
+
+    def test_carry_over_does_not_alias_recycled_buffer(self):
+        downsampler = Downsampler(5)
+        power = self.power[:7].copy()
+        downsampler.process(power, self.voltage[:7])
+        power[:] = -1  # the buffer is recycled for the next chunk
+        result = downsampler.process(self.power[7:10], self.voltage[7:10])
+        numpy.testing.assert_allclose(result[0][0], self.power[5:10].mean(axis=0))
+
+
+class TriggerTest(unittest.TestCase):
+
+    def find(self, trigger, power, chunk_sizes):
+        """Feed the power of port 1 in chunks; return the (capture) index of the run that fires the trigger."""
+        power = numpy.column_stack((numpy.zeros(len(power)), numpy.array(power, dtype=numpy.float64)))
+        start = 0
+        for size in chunk_sizes:
+            index = trigger.find(power[start:start + size])
+            if index is not None:
+                return start + index
+            start += size
+        return None
+
+    def test_rising_edge(self):
+        power = [0, 1, 2, 3, 4, 5, 4, 3]
+        self.assertEqual(self.find(Trigger(1, 2.5), power, [8]), 3)
+        self.assertIsNone(self.find(Trigger(1, 5), power, [8]))
+
+    def test_falling_edge(self):
+        power = [5, 4, 3, 2, 1, 0]
+        self.assertEqual(self.find(Trigger(1, 2.5, edge='falling'), power, [6]), 3)
+
+    def test_power_must_first_be_on_the_other_side(self):
+        power = [3, 3, 3, 3, 1, 1, 3, 3]
+        for chunk_sizes in ([8], [2, 2, 2, 2], [4, 4], [1] * 8):
+            self.assertEqual(self.find(Trigger(1, 2), power, chunk_sizes), 6)
+
+    def test_crossing_at_chunk_boundary(self):
+        power = [0, 0, 0, 0, 5, 5, 5, 5]
+        for chunk_sizes in ([4, 4], [3, 5], [5, 3], [1] * 8):
+            self.assertEqual(self.find(Trigger(1, 2), power, chunk_sizes), 4)
+
+    def test_hold_spans_chunks(self):
+        power = [0, 0, 5, 5, 0, 5, 5, 5, 5, 0]
+        for chunk_sizes in ([10], [6, 4], [3, 3, 4], [1] * 10):
+            self.assertEqual(self.find(Trigger(1, 2, hold=3), power, chunk_sizes), 5)
+
+    def test_run_started_in_earlier_chunk_gives_negative_index(self):
+        trigger = Trigger(1, 2, hold=3)
+        self.assertIsNone(trigger.find(numpy.array([[0, 0], [0, 0], [0, 5], [0, 5]], dtype=numpy.float64)))
+        self.assertEqual(trigger.find(numpy.array([[0, 5], [0, 5]], dtype=numpy.float64)), -2)
+
+
+class TriggeredCaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def capture(self, chunk_size, **kwargs):
+        """Capture power 0 to 99 (one port, at 100 samples per second) in chunks; return the power written out."""
+        processor = SampleProcessor([1.0], self.directory, ['A'], sampling_rate=100, trigger=Trigger(0, 50),
+                                    **kwargs)
+        processor.start()
+        power = numpy.arange(100, dtype=numpy.float64)
+        for start in range(0, 100, chunk_size):
+            chunk = power[start:start + chunk_size]
+            # With a 1 ohm resistor and 1 V across the port, the power is the voltage across the resistor.
+            samples = numpy.column_stack((numpy.ones(chunk.shape[0]), chunk)).ravel()
+            processor.write((samples, chunk.shape[0], 1.0 + start, 1.0 + start))
+        processor.stop()
+        self.assertEqual(processor.trigger_sample, 51)
+        with open(processor.get_port_file_path('A')) as fh:
+            return [float(line.split(',')[0]) for line in fh.read().splitlines()[1:]]
+
+    def test_pre_and_post_trigger_rows(self):
+        for chunk_size in (100, 7, 1):
+            self.assertEqual(self.capture(chunk_size, pre_trigger=0.03, post_trigger=0.05), list(range(48, 56)))
+
+    def test_pre_trigger_rows_of_earlier_chunks(self):
+        self.assertEqual(self.capture(2, pre_trigger=0.1), list(range(41, 100)))
+
+    def test_downsampled_rows(self):
+        power = self.capture(7, downsample=10, pre_trigger=0.1, post_trigger=0.2)
+        # The trigger fires in the sixth row; one row before it, two after it.
+        self.assertEqual(power, [44.5, 54.5, 64.5])
+
+
+class PortFilePathTest(unittest.TestCase):
+
+    def test_port_file_path(self):
+        self.assertEqual(get_port_file_path('out', ['A', 'B'], 'B'), os.path.join('out', 'B.csv'))
+        self.assertEqual(get_port_file_path('out', ['A'], 'A', PORT_FILE_SUFFIX),
+                         os.path.join('out', 'A' + PORT_FILE_SUFFIX))
+        self.assertRaises(SamplePorcessorError, get_port_file_path, 'out', ['A'], 'C')
+
+    def test_processor_paths(self):
+        processor = SampleProcessor([1.0, 1.0], 'out', ['A', 'B'])
+        self.assertEqual(processor.get_port_file_path('A'), get_port_file_path('out', ['A', 'B'], 'A'))
+        self.assertEqual(processor.get_mapped_file_path('B'), os.path.join('out', 'B' + PORT_FILE_SUFFIX))
+        self.assertRaises(SamplePorcessorError, processor.get_port_file_path, 'C')
+
+
+class DaqRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.replay = os.path.join(self.directory, 'replay.daqbin')
+        writer = CaptureWriter(self.replay, ['A'], chunk_size=100)
+        writer.write(numpy.full((250, 1), 2.0), numpy.full((250, 1), 5.0))
+        writer.close()
+        self.simulation = {'waveform': 'sine', 'replay': self.replay, 'speed': 0}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_runner(self, task_cache=None):
+        output_directory = tempfile.mkdtemp(dir=self.directory)
+        return DaqRunner(get_config(), output_directory, simulation=self.simulation, task_cache=task_cache)
+
+    def test_close_clears_task_without_cache(self):
+        runner = self.create_runner()
+        replay_source = runner.task.source
+        runner.close()
+        self.assertIsNone(runner.task)
+        self.assertTrue(replay_source._reader.fh.closed)  # pylint: disable=protected-access
+
+    def test_close_keeps_cached_task_until_cache_is_cleared(self):
+        task_cache = TaskCache()
+        runner = self.create_runner(task_cache)
+        task = runner.task
+        runner.close()
+        self.assertFalse(task.source._reader.fh.closed)  # pylint: disable=protected-access
+        runner = self.create_runner(task_cache)
+        self.assertIs(runner.task, task)
+        runner.close()
+        task_cache.clear()
+        self.assertTrue(task.source._reader.fh.closed)  # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+    unittest.main()
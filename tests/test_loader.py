@@ -0,0 +1,102 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import numpy
+
+from daqpower.capture import format_csv_rows
+from daqpower.loader import LoaderError, load_csv, load_rows
+
+
+class LoadCsvTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, 'A.csv')
+        random = numpy.random.RandomState(0)
+        self.power = random.lognormal(0, 1, 500)
+        self.voltage = random.normal(5, 0.1, 500)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_csv(self, text):
+        with open(self.csv_path, 'w') as fh:
+            fh.write(text)
+
+    def test_matches_loadtxt_whatever_the_block_size(self):
+        self.write_csv('power,voltage\n' + format_csv_rows(self.power, self.voltage))
+        expected = numpy.loadtxt(self.csv_path, delimiter=',', skiprows=1)
+        # Block sizes that split rows (and, for the smallest, numbers) in every possible place.
+        for block_size in (1, 7, 40, 41, 1000, 1048576):
+            array = load_csv(self.csv_path, block_size=block_size)
+            self.assertEqual(array.dtype.names, ('power', 'voltage'))
+            numpy.testing.assert_array_equal(array['power'], expected[:, 0])
+            numpy.testing.assert_array_equal(array['voltage'], expected[:, 1])
+
+    def test_last_row_without_newline(self):
+        self.write_csv('power,voltage\n' + format_csv_rows(self.power[:3], self.voltage[:3]).rstrip('\n'))
+        for block_size in (5, 1048576):
+            array = load_csv(self.csv_path, block_size=block_size)
+            numpy.testing.assert_array_equal(array['power'], self.power[:3])
+
+    def test_header_only(self):
+        self.write_csv('power,voltage,power_min\n')
+        array = load_csv(self.csv_path)
+        self.assertEqual(array.shape, (0,))
+        self.assertEqual(array.dtype.names, ('power', 'voltage', 'power_min'))
+
+    def test_into_npy_file(self):
+        self.write_csv('power,voltage\n' + format_csv_rows(self.power, self.voltage))
+        path = os.path.join(self.directory, 'A.npy')
+        load_csv(self.csv_path, path, block_size=64)
+        array = numpy.load(path, mmap_mode='r')
+        numpy.testing.assert_array_equal(array['voltage'], self.voltage)
+        del array
+
+    def test_malformed_row(self):
+        for row in ('1.0,abc\n', '1.0\n', '1.0,2.0,3.0\n'):
+            self.write_csv('power,voltage\n1.0,2.0\n' + row + '3.0,4.0\n')
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)  # numpy.fromstring stopping short
+                for block_size in (8, 1048576):
+                    self.assertRaises(LoaderError, load_csv, self.csv_path, block_size=block_size)
+
+
+class LoadRowsTest(unittest.TestCase):
+
+    def test_blocks(self):
+        data = numpy.arange(20, dtype='<f8').tobytes()
+        requests = []
+
+        def read_rows(first_row, count):
+            requests.append((first_row, count))
+            return data[first_row * 16:(first_row + count) * 16]
+
+        array = load_rows(read_rows, ['power', 'voltage'], 10, block_size=48)
+        self.assertEqual(requests, [(0, 3), (3, 3), (6, 3), (9, 1)])
+        numpy.testing.assert_array_equal(array['voltage'], numpy.arange(1, 20, 2))
+
+    def test_short_read(self):
+        self.assertRaises(LoaderError, load_rows, lambda first_row, count: b'\0' * 16, ['power', 'voltage'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from daqpower.daq import BufferPool
+from daqpower.pipeline import EventStage, FanOut, SharedBufferPool, StatisticsStage, create_stage
+
+
+class SharedBufferPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer_pool = BufferPool(8, 4)
+        self.shared_pool = SharedBufferPool(self.buffer_pool)
+
+    def test_buffer_is_returned_once_released_by_every_stage(self):
+        buffer = self.shared_pool.acquire()
+        view = self.shared_pool.share(buffer, 3)
+        for _ in range(2):
+            self.shared_pool.release(view)
+            self.assertEqual(self.buffer_pool.get_stats()['free'], 0)
+        self.shared_pool.release(view)
+        self.assertEqual(self.buffer_pool.get_stats()['free'], 1)
+        # The buffer itself goes back to the pool, not the read-only view.
+        self.assertIs(self.shared_pool.acquire(), buffer)
+
+    def test_view_is_read_only(self):
+        buffer = self.shared_pool.acquire()
+        view = self.shared_pool.share(buffer, 2)
+        self.assertFalse(view.flags.writeable)
+        self.assertTrue(buffer.flags.writeable)
+        with self.assertRaises(ValueError):
+            view[0] = 1.0
+
+    def test_buffers_are_counted_separately(self):
+        first, second = self.shared_pool.acquire(), self.shared_pool.acquire()
+        first_view = self.shared_pool.share(first, 2)
+        second_view = self.shared_pool.share(second, 1)
+        self.shared_pool.release(second_view)
+        self.shared_pool.release(first_view)
+        self.assertEqual(self.buffer_pool.get_stats()['free'], 1)
+        self.assertIs(self.shared_pool.acquire(), second)
+
+    def test_buffer_that_is_not_shared_is_passed_through(self):
+        buffer = self.shared_pool.acquire()
+        self.shared_pool.release(buffer)
+        self.assertIs(self.buffer_pool.acquire(), buffer)
+
+    def test_fan_out_shares_buffer_between_stages(self):
+        stages = [_Stage(self.shared_pool) for _ in range(3)]
+        buffer = self.shared_pool.acquire()
+        FanOut(self.shared_pool, stages).write((buffer, 2, 1.0, 1.0))
+        views = [stage.sample_tuples[0][0] for stage in stages]
+        self.assertTrue(all(view is views[0] for view in views))
+        for stage in stages:
+            stage.release()
+        self.assertIs(self.buffer_pool.acquire(), buffer)
+
+    def test_fan_out_releases_buffer_for_stages_not_reached(self):
+        stages = [_Stage(self.shared_pool), _Stage(self.shared_pool, fail=True), _Stage(self.shared_pool)]
+        buffer = self.shared_pool.acquire()
+        with self.assertRaises(IOError):
+            FanOut(self.shared_pool, stages).write((buffer, 2, 1.0, 1.0))
+        self.assertEqual(self.buffer_pool.get_stats()['free'], 0)
+        stages[0].release()
+        self.assertIs(self.buffer_pool.acquire(), buffer)
+
+
+class CreateStageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_stage(self, overrun_policy):
+        return create_stage('statistics', {'name': 'statistics'}, [0.005], ['A'], 1000, self.directory,
+                            max_queue_size=4, overrun_policy=overrun_policy)
+
+    def test_stages_do_not_block(self):
+        self.assertEqual(self.create_stage('block').overrun_policy, 'drop_oldest')
+        self.assertEqual(self.create_stage('drop_oldest').overrun_policy, 'drop_oldest')
+        self.assertEqual(self.create_stage('spill').overrun_policy, 'spill')
+
+
+class StageTest(unittest.TestCase):
+
+    sampling_rate = 10
+    start_time = 100.0
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def feed(self, stage, power, chunk_sizes):
+        """Pass power on to the stage in chunks of the specified sizes, as its do_write() does."""
+        start = 0
+        for size in chunk_sizes:
+            chunk = power[start:start + size]
+            stage.process(chunk, numpy.ones_like(chunk), self.start_time + float(start) / self.sampling_rate)
+            stage.samples_processed += size
+            start += size
+        self.assertEqual(start, power.shape[0])
+
+
+class StatisticsStageTest(StageTest):
+
+    def setUp(self):
+        super(StatisticsStageTest, self).setUp()
+        self.power = numpy.random.RandomState(0).lognormal(0, 1, (37, 2))
+
+    def create_stage(self):
+        return StatisticsStage('statistics', [0.005, 0.005], ['A', 'B'], self.sampling_rate, self.directory)
+
+    def test_windows_carry_over_between_chunks(self):
+        # Windows of 10 samples: chunks that end short of, on, and past window boundaries.
+        for chunk_sizes in ([37], [3, 14, 6, 14], [10, 10, 10, 7], [1] * 37, [29, 8]):
+            stage = self.create_stage()
+            self.feed(stage, self.power, chunk_sizes)
+            results = stage.results()
+            self.assertEqual(results['windows'], 3)  # the last 7 samples are still in progress
+            stage.finish()
+            results = stage.results()
+            self.assertEqual(results['windows'], 4)
+            self.assertEqual(results['window'], 1.0)
+            self.assertEqual(results['start_time'], self.start_time)
+            for i, label in enumerate(['A', 'B']):
+                windows = [self.power[start:start + 10, i] for start in range(0, 37, 10)]
+                self.assertEqual(len(windows[-1]), 7)  # a shorter, final window
+                numpy.testing.assert_allclose(results['mean'][label], [w.mean() for w in windows], rtol=1e-12)
+                self.assertEqual(results['min'][label], [w.min() for w in windows])
+                self.assertEqual(results['max'][label], [w.max() for w in windows])
+
+    def test_no_partial_window(self):
+        stage = self.create_stage()
+        self.feed(stage, self.power[:30], [15, 15])
+        stage.finish()
+        self.assertEqual(stage.results()['windows'], 3)
+
+
+class EventStageTest(StageTest):
+
+    def setUp(self):
+        super(EventStageTest, self).setUp()
+        # A run of 3 samples over the level fires an event. With chunks of [5, 8, 4, 7] samples, the first
+        # run starts in the first chunk and fires in the second, and the third goes on into the last chunk
+        # (where it must not fire again, until the power has gone back below the level).
+        port_power = [0, 0, 0, 2, 2,
+                      2, 0, 2, 2, 2, 2, 0, 0,
+                      2, 2, 2, 2,
+                      2, 2, 2, 0, 2, 2, 2]
+        self.power = numpy.column_stack((port_power, numpy.zeros(len(port_power))))
+        self.events = [3, 7, 13, 21]
+
+    def create_stage(self, **kwargs):
+        return EventStage('events', [0.005, 0.005], ['A', 'B'], self.sampling_rate, self.directory, port='A',
+                          level=1.0, hold=3, **kwargs)
+
+    def test_events_across_chunks(self):
+        for chunk_sizes in ([24], [5, 8, 4, 7], [1] * 24, [4, 1, 1, 7, 11]):
+            stage = self.create_stage()
+            self.feed(stage, self.power, chunk_sizes)
+            events = stage.results()['events']
+            self.assertEqual([int(event['sample']) for event in events], self.events, chunk_sizes)
+            for event in events:
+                self.assertAlmostEqual(event['time'], self.start_time + int(event['sample']) / 10.0)
+
+    def test_max_events(self):
+        stage = self.create_stage(max_events=2)
+        self.feed(stage, self.power, [5, 8, 4, 7])
+        results = stage.results()
+        self.assertEqual([int(event['sample']) for event in results['events']], self.events[:2])
+        self.assertEqual(results['missed_events'], 2)
+
+
+class _Stage(object):
+
+    def __init__(self, buffer_pool, fail=False):
+        self.buffer_pool = buffer_pool
+        self.fail = fail
+        self.sample_tuples = []
+
+    def write(self, sample_tuple):
+        if self.fail:
+            raise IOError('Attempting to write to a stage after it has been closed.')
+        self.sample_tuples.append(sample_tuple)
+
+    def release(self):
+        for sample_tuple in self.sample_tuples:
+            self.buffer_pool.release(sample_tuple[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
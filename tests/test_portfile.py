@@ -0,0 +1,107 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from daqpower.capture import CHECKSUM_SUFFIX
+from daqpower.daq import PortWriter
+from daqpower.portfile import (MappedPortReader, MappedPortWriter, PortFileFormatError, transcode_port_file,
+                               PORT_FILE_SUFFIX)
+
+
+class MappedPortFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'A' + PORT_FILE_SUFFIX)
+        random = numpy.random.RandomState(0)
+        self.power = random.lognormal(0, 1, 1000)
+        self.voltage = random.normal(5, 0.1, 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, block_sizes, **kwargs):
+        writer = MappedPortWriter(self.path, **kwargs)
+        start = 0
+        for size in block_sizes:
+            writer.write_block(self.power[start:start + size], self.voltage[start:start + size])
+            start += size
+        return writer
+
+    def test_file_is_preallocated_then_truncated_on_close(self):
+        writer = self.write([100], expected_rows=1000, metadata={'downsample': 1})
+        row_size = 2 * 8
+        self.assertEqual(os.path.getsize(self.path), writer.data_offset + 1000 * row_size)
+        self.assertEqual(writer.data_offset % 8, 0)
+        writer.close()
+        self.assertEqual(os.path.getsize(self.path), writer.data_offset + 100 * row_size)
+        self.assertEqual(writer.size, os.path.getsize(self.path))
+        reader = MappedPortReader(self.path)
+        self.assertEqual(reader.metadata, {'downsample': 1})
+        self.assertEqual(reader.number_of_samples, 100)
+
+    def test_grows_past_preallocation(self):
+        # Room for 10 rows, then extents of 64 rows.
+        writer = self.write([7, 5, 200, 1, 787], expected_rows=10, extent=64 * 16)
+        self.assertGreaterEqual(os.path.getsize(self.path), writer.data_offset + 1000 * 16)
+        writer.close()
+        power, voltage = MappedPortReader(self.path).read()
+        numpy.testing.assert_array_equal(power, self.power)
+        numpy.testing.assert_array_equal(voltage, self.voltage)
+
+    def test_rows_are_readable_while_writing(self):
+        writer = self.write([300, 200], expected_rows=1000)
+        try:
+            reader = MappedPortReader(self.path)
+            self.assertEqual(reader.number_of_samples, 500)
+            power, _ = reader.read(250, 400)
+            numpy.testing.assert_array_equal(power, self.power[250:400])
+        finally:
+            writer.close()
+
+    def test_transcode_gives_csv_of_port_writer(self):
+        self.write([333, 667]).close()
+        csv_path = os.path.join(self.directory, 'A.csv')
+        transcode_port_file(self.path, csv_path)
+        expected_path = os.path.join(self.directory, 'expected.csv')
+        writer = PortWriter(expected_path)
+        writer.write_block(self.power, self.voltage)
+        writer.close()
+        for suffix in ('', CHECKSUM_SUFFIX):
+            with open(csv_path + suffix, 'rb') as fh, open(expected_path + suffix, 'rb') as expected:
+                self.assertEqual(fh.read(), expected.read())
+        self.assertFalse(os.path.exists(csv_path + '.tmp'))
+
+    def test_transcode_empty_file(self):
+        self.write([]).close()
+        csv_path = os.path.join(self.directory, 'A.csv')
+        transcode_port_file(self.path, csv_path)
+        with open(csv_path) as fh:
+            self.assertEqual(fh.read(), 'power,voltage\n')
+
+    def test_not_a_port_file(self):
+        with open(self.path, 'wb') as fh:
+            fh.write(b'power,voltage\n')
+        self.assertRaises(PortFileFormatError, MappedPortReader, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
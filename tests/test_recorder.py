@@ -0,0 +1,118 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from daqpower.recorder import FlightRecorder, RING_FILENAME
+from daqpower.timeindex import TimestampIndex, TIMESTAMPS_FILENAME
+
+
+LABELS = ['A', 'B']
+
+
+class FlightRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_port_file_path(self, label):
+        return os.path.join(self.directory, label + '.csv')
+
+    def record(self, recorder, chunk_rows, downsample=1):
+        """Write chunks of rows numbered from the start of the capture, power in port A, -power in port B."""
+        for count in chunk_rows:
+            power = numpy.arange(recorder.rows, recorder.rows + count, dtype=numpy.float64)
+            recorder.write([numpy.column_stack((power, -power)), numpy.ones((count, 2))])
+            rows = recorder.rows
+            recorder.mark(rows * downsample, rows, 100.0 + rows * downsample / 1000.0, float(rows))
+
+    def read_power(self, label):
+        with open(self.get_port_file_path(label)) as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(lines[0], 'power,voltage')
+        return [float(line.split(',')[0]) for line in lines[1:]]
+
+    def test_window_before_buffer_is_full(self):
+        recorder = FlightRecorder(10, 2, ['power', 'voltage'], 1000)
+        self.record(recorder, [3, 4])
+        first_row, data, chunks = recorder.get_window()
+        self.assertEqual(first_row, 0)
+        self.assertEqual(data.shape, (7, 2, 2))
+        self.assertEqual(data[:, 0, 0].tolist(), list(range(7)))
+        self.assertEqual([chunk[1] for chunk in chunks], [3, 7])
+
+    def test_window_wraps_around(self):
+        recorder = FlightRecorder(10, 2, ['power', 'voltage'], 1000)
+        self.record(recorder, [4, 4, 4, 3])
+        first_row, data, chunks = recorder.get_window()
+        self.assertEqual(first_row, 5)
+        self.assertEqual(data[:, 0, 0].tolist(), list(range(5, 15)))
+        self.assertEqual(data[:, 1, 0].tolist(), [-x for x in range(5, 15)])
+        # Chunks that ended before the first row in the buffer are dropped.
+        self.assertEqual([chunk[1] for chunk in chunks], [8, 12, 15])
+
+    def test_block_larger_than_buffer(self):
+        recorder = FlightRecorder(10, 2, ['power', 'voltage'], 1000)
+        self.record(recorder, [3, 25])
+        first_row, data, _ = recorder.get_window()
+        self.assertEqual(first_row, 18)
+        self.assertEqual(data[:, 0, 0].tolist(), list(range(18, 28)))
+
+    def test_snapshot(self):
+        recorder = FlightRecorder(10, 2, ['power', 'voltage'], 1000)
+        self.record(recorder, [4, 4, 4, 3])
+        result = recorder.snapshot(self.directory, LABELS, self.get_port_file_path)
+        self.assertEqual(result['first_sample'], '5')
+        self.assertEqual(result['samples'], '10')
+        self.assertEqual(self.read_power('A'), list(range(5, 15)))
+        self.assertEqual(self.read_power('B'), [-x for x in range(5, 15)])
+        self.assertAlmostEqual(result['start_time'], 100.005)
+        self.assertAlmostEqual(result['end_time'], 100.015)
+
+    def test_snapshot_of_downsampled_rows(self):
+        downsample = 10
+        recorder = FlightRecorder(10, 2, ['power', 'voltage'], 1000, downsample=downsample)
+        self.record(recorder, [4, 4, 4, 3], downsample)
+        result = recorder.snapshot(self.directory, LABELS, self.get_port_file_path)
+        # The first row of the snapshot is the fifth of the capture, i.e. stands for samples 50 to 59.
+        self.assertEqual(result['first_sample'], '50')
+        self.assertEqual(result['samples'], '10')
+        self.assertAlmostEqual(result['sample_period'], 0.01)
+        self.assertAlmostEqual(result['start_time'], 100.05)
+        index = TimestampIndex(os.path.join(self.directory, TIMESTAMPS_FILENAME))
+        self.assertEqual(index.rows, 10)
+        self.assertAlmostEqual(index.time_of_row(3) - index.time_of_row(0), 0.03)
+
+    def test_snapshot_after_close_reads_file(self):
+        recorder = FlightRecorder(10, 2, ['power', 'voltage'], 1000,
+                                  path=os.path.join(self.directory, RING_FILENAME))
+        self.record(recorder, [8, 8])
+        recorder.close()
+        self.assertIsNone(recorder._data)  # pylint: disable=protected-access
+        result = recorder.snapshot(self.directory, LABELS, self.get_port_file_path)
+        self.assertEqual(result['first_sample'], '6')
+        self.assertEqual(self.read_power('A'), list(range(6, 16)))
+
+
+if __name__ == '__main__':
+    unittest.main()
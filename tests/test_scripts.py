@@ -0,0 +1,110 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from daqpower.client import DaqClient
+from daqpower.config import DeviceConfiguration
+
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'scripts')
+
+
+def get_free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class RunDaqServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.port = get_free_port()
+        self.log = open(os.path.join(self.directory, 'server.log'), 'w+')
+        self.server = None
+
+    def tearDown(self):
+        if self.server and self.server.poll() is None:
+            self.server.terminate()
+            self.server.wait()
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def start_server(self, *args):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([ROOT_DIRECTORY] + [p for p in [env.get('PYTHONPATH')] if p])
+        self.server = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIRECTORY, 'run-daq-server'),
+                                        '-d', os.path.join(self.directory, 'server'), '-p', str(self.port),
+                                        '--host', '127.0.0.1', '--simulate', 'sine'] + list(args),
+                                       env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self.wait_for_server()
+
+    def get_log(self):
+        self.log.seek(0)
+        return self.log.read()
+
+    def wait_for_server(self):
+        deadline = time.time() + 30
+        while True:
+            self.assertIsNone(self.server.poll(), 'run-daq-server exited:\n' + self.get_log())
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except socket.error:
+                self.assertLess(time.time(), deadline, 'run-daq-server did not start:\n' + self.get_log())
+                time.sleep(0.1)
+
+    def test_stream_and_data_ports_are_disabled_by_default(self):
+        self.start_server()
+        client = DaqClient('127.0.0.1', self.port)
+        self.assertIsNone(client.get_stream_port())
+        self.assertIsNone(client.get_data_port())
+
+    def test_worker_process_session(self):
+        self.start_server('--worker-process')
+        client = DaqClient('127.0.0.1', self.port)
+        config = DeviceConfiguration(device_id='Dev1', v_range=2.5, dv_range=0.2, sampling_rate=1000,
+                                     channel_map=None, resistor_values=[0.005], labels=['A'])
+        client.configure(config.__dict__)
+        client.start()
+        time.sleep(1)
+        client.stop()
+        output_directory = os.path.join(self.directory, 'output')
+        os.makedirs(output_directory)
+        client.get_data(output_directory)
+        client.close()
+        with open(os.path.join(output_directory, 'A')) as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(lines[0], 'power,voltage')
+        self.assertGreater(len(lines), 1)
+        # The worker process did not start a second server of its own.
+        self.assertNotIn('Address already in use', self.get_log())
+        self.assertIsNone(self.server.poll())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from daqpower import client, server
+from daqpower.config import SESSION_METHODS
+
+
+class SessionMethodsTest(unittest.TestCase):
+
+    def test_client_and_server_share_session_methods(self):
+        self.assertIs(client.SESSION_METHODS, server.SESSION_METHODS)
+
+    def test_session_methods_exist(self):
+        for name in SESSION_METHODS:
+            self.assertTrue(callable(getattr(server.DaqSession, name, None)), name)
+
+
+class CleanupDirectoryThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.active = []
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread:
+            self.thread.stop()
+        shutil.rmtree(self.directory)
+
+    def add_session(self, name, size):
+        path = os.path.join(self.directory, name)
+        os.makedirs(path)
+        with open(os.path.join(path, 'A.csv'), 'wb') as fh:
+            fh.write(b'0' * size)
+        return path
+
+    def start_thread(self, quota=0):
+        self.thread = server.CleanupDirectoryThread(self.directory, quota=quota, quota_check_period=0.05,
+                                                    get_active_directories=lambda: list(self.active))
+        self.thread.start()
+
+    def wait_for_usage(self, usage):
+        deadline = time.time() + 5
+        while self.thread.get_usage() != usage:
+            self.assertLess(time.time(), deadline, 'usage is {}, not {}'.format(self.thread.get_usage(), usage))
+            time.sleep(0.01)
+
+    def test_usage_is_measured_without_quota(self):
+        self.add_session('old', 1000)
+        self.start_thread()
+        self.wait_for_usage(1000)
+        self.active.append(self.add_session('new', 200))
+        self.wait_for_usage(1200)
+        with open(os.path.join(self.active[0], 'B.csv'), 'wb') as fh:
+            fh.write(b'0' * 300)
+        self.wait_for_usage(1500)
+
+    def test_quota_removes_least_recently_used_sessions(self):
+        for i, name in enumerate(['oldest', 'older', 'old']):
+            path = self.add_session(name, 1000)
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+        self.active.append(self.add_session('new', 1000))
+        self.start_thread(quota=2500)
+        self.wait_for_usage(2000)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['new', 'old'])
+        self.assertEqual(self.thread.evicted_directories, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
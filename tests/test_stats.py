@@ -0,0 +1,94 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+import numpy
+
+from daqpower.stats import PortStatistics, QuantileSketch
+
+
+class PortStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        # Two ports: one around 1 W, one with a large offset, which a naive variance would lose precision on.
+        self.power = numpy.column_stack((random.lognormal(0, 0.5, 20000), 1e6 + random.normal(0, 1, 20000)))
+
+    def update(self, statistics, chunk_sizes):
+        start = 0
+        for size in chunk_sizes:
+            statistics.update(self.power[start:start + size])
+            start += size
+        self.assertEqual(start, self.power.shape[0])
+
+    def test_chunks_merged_match_whole_capture(self):
+        for chunk_sizes in ([20000], [1, 19999], [7000, 3, 12997], [1000] * 20):
+            statistics = PortStatistics(['A', 'B'], 1000)
+            self.update(statistics, chunk_sizes)
+            result = statistics.get()
+            for i, label in enumerate(['A', 'B']):
+                self.assertEqual(result[label]['samples'], 20000.0)
+                self.assertAlmostEqual(result[label]['duration'], 20.0)
+                self.assertAlmostEqual(result[label]['mean'] / numpy.mean(self.power[:, i]), 1.0, places=12)
+                self.assertAlmostEqual(result[label]['variance'] / numpy.var(self.power[:, i]), 1.0, places=8)
+                self.assertEqual(result[label]['min'], self.power[:, i].min())
+                self.assertEqual(result[label]['max'], self.power[:, i].max())
+
+    def test_energy(self):
+        statistics = PortStatistics(['A', 'B'], 1000)
+        self.update(statistics, [5000, 15000])
+        result = statistics.get()
+        # Joules, from the power of each sample held for a sample period.
+        self.assertAlmostEqual(result['A']['energy'] / (self.power[:, 0].sum() / 1000), 1.0, places=12)
+
+    def test_percentiles_within_relative_accuracy(self):
+        statistics = PortStatistics(['A', 'B'], 1000)
+        self.update(statistics, [3000, 17000])
+        percentiles = statistics.get()['A']['percentiles']
+        ordered = numpy.sort(self.power[:, 0])
+        for p in PortStatistics.percentiles:
+            expected = numpy.percentile(self.power[:, 0], p)
+            # numpy interpolates between the samples either side of the percentile.
+            rank = int(p / 100.0 * (len(ordered) - 1))
+            tolerance = 0.01 * expected + (ordered[rank + 1] - ordered[rank])
+            self.assertLessEqual(abs(percentiles['p{}'.format(p)] - expected), tolerance, p)
+
+    def test_no_samples(self):
+        statistics = PortStatistics(['A'], 1000)
+        statistics.update(numpy.empty((0, 1)))
+        self.assertEqual(statistics.get(), {'A': {'samples': 0.0}})
+
+
+class QuantileSketchTest(unittest.TestCase):
+
+    def test_negative_and_zero_values(self):
+        sketch = QuantileSketch(1)
+        sketch.add(numpy.array([[-100.0], [-1.0], [0.0], [0.0], [0.0], [2.0], [50.0]]))
+        self.assertAlmostEqual(sketch.quantile(0)[0], -100.0, delta=1.0)
+        self.assertAlmostEqual(sketch.quantile(0.5)[0], 0.0)
+        self.assertAlmostEqual(sketch.quantile(1)[0], 50.0, delta=0.5)
+
+    def test_ports_are_independent(self):
+        sketch = QuantileSketch(2)
+        sketch.add(numpy.array([[1.0, 10.0], [1.0, 10.0]]))
+        numpy.testing.assert_allclose(sketch.quantile(0.5), [1.0, 10.0], rtol=0.01)
+
+    def test_empty(self):
+        self.assertTrue(numpy.isnan(QuantileSketch(1).quantile(0.5)[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#    Copyright 2014-2015 ARM Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import socket
+import time
+import unittest
+
+import numpy
+
+from daqpower.stream import (SampleBroadcaster, StreamReceiver, StreamServer, read_frame,
+                             FRAME_DATA, FRAME_END, FRAME_HEADER)
+
+
+class StreamServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broadcasters = {'old': SampleBroadcaster(), 'new': SampleBroadcaster()}
+        self.requested = []
+        self.server = StreamServer(0, host='127.0.0.1', resolver=self.resolve)
+        self.server.subscribe_timeout = 0.2
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def resolve(self, session_id):
+        self.requested.append(session_id)
+        return self.broadcasters.get(session_id or 'new')
+
+    def wait_for_subscriber(self, broadcaster):
+        deadline = time.time() + 5
+        while not broadcaster.number_of_subscribers:
+            self.assertLess(time.time(), deadline, 'subscriber was not attached')
+            time.sleep(0.01)
+
+    def publish(self, broadcaster, labels):
+        broadcaster.open(labels, ['power', 'voltage'])
+        broadcaster.publish([numpy.ones((3, len(labels))), numpy.zeros((3, len(labels)))])
+        broadcaster.close()
+
+    def test_subscriber_names_session(self):
+        receiver = StreamReceiver('127.0.0.1', self.server.port, timeout=5, session_id='old')
+        self.wait_for_subscriber(self.broadcasters['old'])
+        self.publish(self.broadcasters['old'], ['A', 'B'])
+        blocks = list(receiver)
+        self.assertEqual(self.requested, ['old'])
+        self.assertEqual(receiver.labels, ['A', 'B'])
+        self.assertEqual([first_sample for first_sample, _ in blocks], [0])
+        self.assertEqual(blocks[0][1].shape, (3, 2, 2))
+
+    def test_subscriber_without_session_gets_most_recent(self):
+        receiver = StreamReceiver('127.0.0.1', self.server.port, timeout=5)
+        self.wait_for_subscriber(self.broadcasters['new'])
+        self.publish(self.broadcasters['new'], ['C'])
+        self.assertEqual(len(list(receiver)), 1)
+        self.assertEqual(self.requested, [None])
+
+    def test_subscriber_that_does_not_subscribe_gets_most_recent(self):
+        # As subscribers written before SUBSCRIBE frames were introduced do.
+        connection = socket.create_connection(('127.0.0.1', self.server.port), 5)
+        try:
+            self.wait_for_subscriber(self.broadcasters['new'])
+            self.publish(self.broadcasters['new'], ['C'])
+            frame_types = []
+            while not frame_types or frame_types[-1] != FRAME_END:
+                frame_type, payload = read_frame(connection)
+                frame_types.append(frame_type)
+                if frame_type == FRAME_HEADER:
+                    self.assertEqual(json.loads(payload.decode('utf-8'))['labels'], ['C'])
+        finally:
+            connection.close()
+        self.assertEqual(frame_types, [FRAME_HEADER, FRAME_DATA, FRAME_END])
+        self.assertEqual(self.requested, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()